@@ -1,244 +1,3626 @@
+import ast
+import collections
+import contextlib
+import copy
+import filecmp
+import functools
+import gc
+import hashlib
+import heapq
+import importlib.util
+import io
+import itertools
+import os
 import sys
 import json
+import marshal
 import math
+import mmap
+import operator
+import random
+import shutil
+import socket
+import struct
+import tempfile
+import threading
+import time
+import tracemalloc
+import types
+import zlib
 import xml.etree.ElementTree as ET
+from array import array
 
-CMD_LOAD = 0    # Загрузка константы в регистр
-CMD_READ = 2    # Чтение из памяти в регистр
-CMD_WRITE = 6   # Запись регистра в память со смещением
-CMD_SQRT = 7    # Квадратный корень
+@functools.lru_cache(maxsize=None)
+def load_numpy():
+    """Пакет numpy или None, если он не установлен
+    
+    Импорт numpy стоит десятков миллисекунд запуска, поэтому пакет
+    загружается только при первом обращении к хранилищу или дампу numpy.
+    """
+    try:
+        import numpy
+    except ImportError:
+        return None
+    return numpy
+
+def is_ndarray(value):
+    """Проверка на массив numpy без импорта пакета (массив есть только после импорта)"""
+    numpy = sys.modules.get("numpy")
+    return numpy is not None and isinstance(value, numpy.ndarray)
+
+from uvm_isa import (CMD_LOAD, CMD_READ, CMD_WRITE, CMD_SQRT, INSTRUCTION_FORMATS,
+                     INSTRUCTIONS, BY_OPCODE, format_command, parse_line, source_line)
+
+# Бинарный формат программы: заголовок + команды с полями фиксированной ширины
+# (поля команд - INSTRUCTION_FORMATS из uvm_isa)
+PROGRAM_MAGIC = b"UVMB"
+PROGRAM_VERSION = 1
+PROGRAM_HEADER = struct.Struct("<4sHHQ")  # сигнатура, версия, флаги, число команд
+
+def encode_program(program):
+    """Кодирование программы в бинарный формат"""
+    chunks = [PROGRAM_HEADER.pack(PROGRAM_MAGIC, PROGRAM_VERSION, 0, len(program))]
+    for i, cmd in enumerate(program):
+        fmt = INSTRUCTION_FORMATS.get(cmd[0])
+        if fmt is None:
+            raise ValueError(f"команда {i}: неизвестный код операции {cmd[0]}")
+        try:
+            chunks.append(fmt.pack(*cmd))
+        except struct.error:
+            raise ValueError(f"команда {i}: аргумент не помещается в поле бинарного формата")
+    return b"".join(chunks)
+
+def decode_program(data):
+    """Декодирование программы из бинарного формата (команды - кортежи)"""
+    magic, version, flags, count = PROGRAM_HEADER.unpack_from(data, 0)
+    if magic != PROGRAM_MAGIC:
+        raise ValueError("неверная сигнатура бинарной программы")
+    if version != PROGRAM_VERSION:
+        raise ValueError(f"неподдерживаемая версия формата: {version}")
+    
+    decoders = {op: (fmt.unpack_from, fmt.size) for op, fmt in INSTRUCTION_FORMATS.items()}
+    program = []
+    append = program.append
+    pos = PROGRAM_HEADER.size
+    for _ in range(count):
+        try:
+            unpack, size = decoders[data[pos]]
+        except KeyError:
+            raise ValueError(f"неизвестный код операции {data[pos]} по смещению {pos}")
+        append(unpack(data, pos))
+        pos += size
+    if pos != len(data):
+        raise ValueError("лишние данные после последней команды")
+    return program
+
+PROGRAM_FORMATS = ("json", "bin")
+
+BINARY_EXTENSIONS = (".uvm", ".uvmb", ".bin")  # Расширения файлов программ в бинарном формате
+
+def program_format(path):
+    """Формат файла программы по расширению: бинарный для BINARY_EXTENSIONS, иначе JSON
+    
+    JSON - формат по умолчанию, как в исходном ассемблере; бинарный выбирается
+    только явно - расширением или опцией --format=bin.
+    """
+    return "bin" if path.lower().endswith(BINARY_EXTENSIONS) else "json"
+
+def save_program(program, output_file, fmt="json"):
+    """Сохранение программы в JSON или бинарном формате"""
+    if fmt == "json":
+        with open(output_file, 'w', encoding='utf-8') as f:
+            json.dump(program, f, indent=2)
+    elif fmt == "bin":
+        data = encode_program(program)
+        with open(output_file, 'wb') as f:
+            f.write(data)
+    else:
+        raise ValueError(f"неизвестный формат программы '{fmt}'")
+
+def read_program(program_file):
+    """Чтение программы с автоматическим определением формата по сигнатуре"""
+    with open(program_file, 'rb') as f:
+        data = f.read()
+    if data[:len(PROGRAM_MAGIC)] == PROGRAM_MAGIC:
+        return decode_program(data)
+    return json.loads(data.decode('utf-8'))
+
+def json_command(cmd):
+    """Команда в том виде, в каком ее записывает json.dump(program, f, indent=2)"""
+    return "  [\n" + ",\n".join(f"    {arg}" for arg in cmd) + "\n  ]"
+
+class JsonProgramWriter:
+    """Потоковая запись программы в JSON, совпадающая с json.dump(program, f, indent=2)"""
+    
+    def __init__(self, f):
+        self.f = f
+        self.count = 0
+    
+    def write(self, cmd):
+        self.f.write(("[\n" if self.count == 0 else ",\n") + json_command(cmd))
+        self.count += 1
+    
+    def close(self):
+        self.f.write("\n]" if self.count else "[]")
+
+class BinaryProgramWriter:
+    """Потоковая запись программы в бинарном формате; число команд вписывается в заголовок в конце"""
+    
+    def __init__(self, f):
+        self.f = f
+        self.count = 0
+        self.packers = {op: fmt.pack for op, fmt in INSTRUCTION_FORMATS.items()}
+        f.write(PROGRAM_HEADER.pack(PROGRAM_MAGIC, PROGRAM_VERSION, 0, 0))
+    
+    def write(self, cmd):
+        try:
+            self.f.write(self.packers[cmd[0]](*cmd))
+        except struct.error:
+            raise ValueError("аргумент не помещается в поле бинарного формата")
+        self.count += 1
+    
+    def close(self):
+        self.f.seek(0)
+        self.f.write(PROGRAM_HEADER.pack(PROGRAM_MAGIC, PROGRAM_VERSION, 0, self.count))
+
+PROGRAM_WRITERS = {"json": (JsonProgramWriter, 'w'), "bin": (BinaryProgramWriter, 'wb')}
+
+class AssemblyError(ValueError):
+    """Ошибка ассемблирования с номером строки исходного текста"""
+    
+    def __init__(self, line_num, message):
+        super().__init__(f"Ошибка в строке {line_num}: {message}")
+        self.line_num = line_num
 
 # ЭТАП 1
-def assemble(source_file, output_file, test_mode=False):
-    """Ассемблер: преобразует текстовую программу в промежуточное представление"""
+def iter_program(lines, first_line=1):
+    """Генератор пар (номер строки, команда) по строкам исходного текста
+    
+    Ошибка разбора поднимается как AssemblyError с номером строки.
+    """
+    for line_num, line in enumerate(lines, first_line):
+        try:
+            cmd = parse_line(line)
+        except (IndexError, ValueError) as e:
+            raise AssemblyError(line_num, e)
+        if cmd is not None:
+            yield line_num, cmd
+
+def assemble(source_file, output_file, test_mode=False, fmt=None, workers=1, cache=None,
+             optimize=None):
+    """Ассемблер: преобразует текстовую программу в промежуточное представление
+    
+    Исходный текст читается построчно, а команды кодируются и пишутся во
+    временный файл по мере разбора, поэтому расход памяти не зависит от
+    размера программы (кроме режима тестирования, где копится листинг).
+    fmt: "json" или "bin"; по умолчанию выбирается по расширению выходного файла.
+    workers: число процессов; при workers != 1 большие файлы ассемблируются
+    параллельно (см. assemble_parallel), кроме режима тестирования.
+    cache: AssemblyCache - неизмененные исходные файлы не разбираются заново
+    (в режиме тестирования кэш не используется: нужен листинг).
+    optimize: (mem_size, num_regs, word_bits) - результат оптимизируется
+    optimize_file; в кэш попадает уже оптимизированная программа.
+    """
+    if cache is not None and not test_mode:
+        return cache.assemble(source_file, output_file, fmt, workers, optimize)
+    if optimize is not None:
+        return (assemble(source_file, output_file, test_mode, fmt, workers)
+                and optimize_file(output_file, *optimize))
+    if (workers != 1 and not test_mode and os.path.exists(source_file)
+            and os.path.getsize(source_file) >= PARALLEL_MIN_BYTES):
+        return assemble_parallel(source_file, output_file, fmt, workers)
+    if fmt is None:
+        fmt = program_format(output_file)
+    if fmt not in PROGRAM_WRITERS:
+        print(f"Ошибка при сохранении: неизвестный формат программы '{fmt}'")
+        return False
+    writer_class, mode = PROGRAM_WRITERS[fmt]
+    
     try:
-        with open(source_file, 'r', encoding='utf-8') as f:
-            lines = f.readlines()
+        source = open(source_file, 'r', encoding='utf-8')
     except FileNotFoundError:
         print(f"Ошибка: файл {source_file} не найден")
         return False
+    
+    listing = [] if test_mode else None
+    tmp_file = None
+    try:
+        with source:
+            tmp_file = f"{output_file}.tmp{os.getpid()}"
+            with open(tmp_file, mode, encoding=None if 'b' in mode else 'utf-8') as out:
+                writer = writer_class(out)
+                for line_num, cmd in iter_program(source):
+                    if listing is not None:
+                        listing.append(format_command(writer.count, cmd))
+                    try:
+                        writer.write(cmd)
+                    except ValueError as e:
+                        raise AssemblyError(line_num, e)
+                writer.close()
+        
+        # Режим тестирования
+        if listing is not None:
+            print("Промежуточное представление программы:")
+            print("=" * 50)
+            for line in listing:
+                print(line)
+            print("=" * 50)
+        
+        os.replace(tmp_file, output_file)
+        tmp_file = None
+        print(f"Программа успешно ассемблирована в {output_file}")
+        return True
+    except AssemblyError as e:
+        print(e)
+        return False
+    except Exception as e:
+        print(f"Ошибка при сохранении: {e}")
+        return False
+    finally:
+        if tmp_file is not None and os.path.exists(tmp_file):
+            os.remove(tmp_file)
 
-    program = []
+PARALLEL_MIN_BYTES = 1 << 20  # Файлы меньше этого размера ассемблируются в одном процессе
+
+def split_source(source_file, num_chunks):
+    """Границы кусков исходного файла (смещения в байтах), выровненные по началу строк"""
+    size = os.path.getsize(source_file)
+    bounds = [0]
+    with open(source_file, 'rb') as f:
+        for i in range(1, num_chunks):
+            f.seek(max(size * i // num_chunks, bounds[-1]))
+            if f.tell() > 0:
+                f.readline()  # Дочитываем до конца строки, на которую попало смещение
+            if f.tell() > bounds[-1] and f.tell() < size:
+                bounds.append(f.tell())
+    bounds.append(size)
+    return bounds
+
+def assemble_chunk(source_file, begin, end, fmt, part_file):
+    """Разбор куска [begin, end) исходного файла в рабочем процессе
+    
+    Закодированные команды пишутся в part_file без заголовка и скобок.
+    Возвращает (число команд, число строк, (номер строки в куске, сообщение) или None).
+    """
+    with open(source_file, 'rb') as f:
+        f.seek(begin)
+        data = f.read(end - begin)
+    # Тот же разбор строк, что при чтении файла в текстовом режиме
+    lines = io.TextIOWrapper(io.BytesIO(data), encoding='utf-8')
+    count = 0
+    line_count = 0
+    packers = {op: spec.pack for op, spec in INSTRUCTION_FORMATS.items()}
+    mode = PROGRAM_WRITERS[fmt][1]
+    with open(part_file, mode, encoding=None if 'b' in mode else 'utf-8') as out:
+        for line_count, line in enumerate(lines, 1):
+            try:
+                cmd = parse_line(line)
+                if cmd is None:
+                    continue
+                if fmt == "bin":
+                    try:
+                        out.write(packers[cmd[0]](*cmd))
+                    except struct.error:
+                        raise ValueError("аргумент не помещается в поле бинарного формата")
+                else:
+                    out.write((",\n" if count else "") + json_command(cmd))
+            except (IndexError, ValueError) as e:
+                return count, line_count, (line_count, str(e))
+            count += 1
+    return count, line_count, None
+
+def assemble_parallel(source_file, output_file, fmt=None, workers=None):
+    """Многопроцессный ассемблер: файл режется по границам строк, куски
+    разбираются параллельно и склеиваются в исходном порядке
+    
+    Номер строки в сообщении об ошибке - глобальный: он складывается из
+    числа строк в предыдущих кусках, которое сообщает каждый процесс.
+    """
+    if fmt is None:
+        fmt = program_format(output_file)
+    if fmt not in PROGRAM_WRITERS:
+        print(f"Ошибка при сохранении: неизвестный формат программы '{fmt}'")
+        return False
+    if not os.path.exists(source_file):
+        print(f"Ошибка: файл {source_file} не найден")
+        return False
+    
+    workers = workers or os.cpu_count()
+    bounds = split_source(source_file, workers * 4)
+    tmp_file = f"{output_file}.tmp{os.getpid()}"
+    try:
+        with tempfile.TemporaryDirectory(dir=os.path.dirname(os.path.abspath(output_file))) as tmp:
+            parts = [os.path.join(tmp, f"part{i}") for i in range(len(bounds) - 1)]
+            import concurrent.futures
+            with concurrent.futures.ProcessPoolExecutor(max_workers=workers) as pool:
+                futures = [pool.submit(assemble_chunk, source_file, begin, end, fmt, part)
+                           for begin, end, part in zip(bounds, bounds[1:], parts)]
+                results = [future.result() for future in futures]
+            
+            # Первая ошибка в порядке файла: все куски до нее разобраны полностью
+            line_base = 0
+            for count, line_count, error in results:
+                if error is not None:
+                    raise AssemblyError(line_base + error[0], error[1])
+                line_base += line_count
+            
+            total = sum(count for count, _, _ in results)
+            with open(tmp_file, 'wb') as out:
+                if fmt == "bin":
+                    out.write(PROGRAM_HEADER.pack(PROGRAM_MAGIC, PROGRAM_VERSION, 0, total))
+                else:
+                    out.write(b"[\n" if total else b"[]")
+                first = True
+                for part, (count, _, _) in zip(parts, results):
+                    if not count:
+                        continue
+                    if fmt == "json" and not first:
+                        out.write(b",\n")
+                    first = False
+                    with open(part, 'rb') as f:
+                        shutil.copyfileobj(f, out)
+                if fmt == "json" and total:
+                    out.write(b"\n]")
+        
+        os.replace(tmp_file, output_file)
+        tmp_file = None
+        print(f"Программа успешно ассемблирована в {output_file} "
+              f"({total} команд, {len(bounds) - 1} кусков, {workers} процессов)")
+        return True
+    except AssemblyError as e:
+        print(e)
+        return False
+    except Exception as e:
+        print(f"Ошибка при сохранении: {e}")
+        return False
+    finally:
+        if tmp_file is not None and os.path.exists(tmp_file):
+            os.remove(tmp_file)
+
+# Кэш ассемблера: закодированные программы по хешу исходного текста
+ASSEMBLER_VERSION = 2        # Увеличивается при любом изменении кодирования программ или записей
+ASM_CACHE_DIR = os.path.join(os.environ.get("XDG_CACHE_HOME") or os.path.join(os.path.expanduser("~"), ".cache"),
+                             "uvm-asm")
+ASM_CACHE_SIZE = 256 << 20   # Предельный размер кэша в байтах
+
+class AssemblyCache:
+    """Дисковый кэш результатов ассемблирования (и скомпилированного кода движка compile)
+    
+    Ключ записи - sha256 от версии ассемблера, таблицы команд uvm_isa, формата
+    вывода, параметров оптимизации и содержимого исходного файла. При превышении max_bytes удаляются
+    записи, к которым дольше всего не обращались (время обращения - mtime).
+    Запись начинается с sha256 своих данных: поврежденная запись удаляется и
+    считается промахом, а не попадает в выходной файл.
+    """
+    
+    def __init__(self, cache_dir=ASM_CACHE_DIR, max_bytes=ASM_CACHE_SIZE):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+    
+    def key(self, source_file, fmt, optimize=None):
+        """Ключ записи для исходного файла, формата вывода и параметров оптимизации"""
+        digest = hashlib.sha256(f"{ASSEMBLER_VERSION}\0{fmt}\0{INSTRUCTIONS!r}\0".encode('utf-8'))
+        if optimize is not None:
+            digest.update(f"optimize{tuple(optimize)!r}\0".encode('utf-8'))
+        with open(source_file, 'rb') as f:
+            for block in iter(lambda: f.read(1 << 20), b""):
+                digest.update(block)
+        return digest.hexdigest()
+    
+    def entry_path(self, key, fmt):
+        return os.path.join(self.cache_dir, f"{key}.{fmt}")
+    
+    def _load(self, key, fmt):
+        """Данные записи после проверки контрольной суммы или None"""
+        entry = self.entry_path(key, fmt)
+        try:
+            os.utime(entry)  # Отметка обращения для вытеснения
+            with open(entry, 'rb') as f:
+                data = f.read()
+        except FileNotFoundError:
+            return None
+        if hashlib.sha256(data[32:]).digest() != data[:32]:
+            print(f"Предупреждение: запись кэша {entry} повреждена и удалена")
+            with contextlib.suppress(FileNotFoundError):
+                os.remove(entry)
+            return None
+        return data[32:]
+    
+    def _save(self, key, fmt, data):
+        os.makedirs(self.cache_dir, exist_ok=True)
+        entry = self.entry_path(key, fmt)
+        tmp_entry = f"{entry}.tmp{os.getpid()}"
+        with open(tmp_entry, 'wb') as f:
+            f.write(hashlib.sha256(data).digest())
+            f.write(data)
+        os.replace(tmp_entry, entry)
+        self.evict()
+    
+    def read_entry(self, key, fmt):
+        """Содержимое записи кэша (bytes) или None, если записи нет"""
+        data = self._load(key, fmt)
+        if data is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+        return data
+    
+    def write_entry(self, key, fmt, data):
+        """Запись bytes в кэш с последующим вытеснением"""
+        self._save(key, fmt, data)
+    
+    def fetch(self, key, fmt, output_file):
+        """Запись из кэша в output_file; False, если записи нет"""
+        data = self._load(key, fmt)
+        if data is None:
+            return False
+        # Совпадающий выходной файл не перезаписывается: его mtime остается прежним
+        with contextlib.suppress(FileNotFoundError):
+            if os.path.getsize(output_file) == len(data):
+                with open(output_file, 'rb') as f:
+                    if f.read() == data:
+                        return True
+        tmp_file = f"{output_file}.tmp{os.getpid()}"
+        try:
+            with open(tmp_file, 'wb') as f:
+                f.write(data)
+            os.replace(tmp_file, output_file)
+            tmp_file = None
+        finally:
+            if tmp_file is not None and os.path.exists(tmp_file):
+                os.remove(tmp_file)
+        return True
     
-    for line_num, line in enumerate(lines, 1):
-        line = line.strip()
-        if not line or line.startswith('#'):
+    def store(self, key, fmt, output_file):
+        """Сохранение результата ассемблирования в кэш с последующим вытеснением"""
+        with open(output_file, 'rb') as f:
+            self._save(key, fmt, f.read())
+    
+    def evict(self):
+        """Удаление давно не использованных записей, пока кэш больше max_bytes"""
+        entries = []
+        total = 0
+        with os.scandir(self.cache_dir) as it:
+            for item in it:
+                if item.is_file() and ".tmp" not in item.name:
+                    stat = item.stat()
+                    entries.append((stat.st_mtime, stat.st_size, item.path))
+                    total += stat.st_size
+        entries.sort()
+        for _, size, path in entries:
+            if total <= self.max_bytes:
+                break
+            with contextlib.suppress(FileNotFoundError):
+                os.remove(path)
+            total -= size
+    
+    def assemble(self, source_file, output_file, fmt=None, workers=1, optimize=None):
+        """Ассемблирование через кэш: неизмененный исходный текст не разбирается
+        
+        С optimize (см. assemble) кэшируется оптимизированная программа.
+        """
+        if fmt is None:
+            fmt = program_format(output_file)
+        try:
+            key = self.key(source_file, fmt, optimize)
+        except FileNotFoundError:
+            print(f"Ошибка: файл {source_file} не найден")
+            return False
+        
+        try:
+            hit = self.fetch(key, fmt, output_file)
+        except OSError as e:
+            print(f"Предупреждение: кэш ассемблера недоступен: {e}")
+            hit = False
+        if hit:
+            self.hits += 1
+            print(f"Программа {output_file} взята из кэша ассемблера")
+            return True
+        
+        self.misses += 1
+        if not assemble(source_file, output_file, fmt=fmt, workers=workers, optimize=optimize):
+            return False
+        try:
+            self.store(key, fmt, output_file)
+        except OSError as e:
+            print(f"Предупреждение: не удалось сохранить программу в кэш: {e}")
+        return True
+
+def assemble_dir(source_dir, output_dir, fmt="json", workers=1, cache=None):
+    """Ассемблирование всех .asm-файлов каталога в output_dir
+    
+    С кэшем заново разбираются только измененные файлы.
+    Выходные файлы: имя.json для формата json, имя.uvm для бинарного.
+    """
+    try:
+        sources = sorted(name for name in os.listdir(source_dir) if name.lower().endswith(".asm"))
+    except FileNotFoundError:
+        print(f"Ошибка: каталог {source_dir} не найден")
+        return False
+    os.makedirs(output_dir, exist_ok=True)
+    extension = ".json" if fmt == "json" else ".uvm"
+    
+    failed = []
+    for name in sources:
+        source_file = os.path.join(source_dir, name)
+        output_file = os.path.join(output_dir, os.path.splitext(name)[0] + extension)
+        if not assemble(source_file, output_file, fmt=fmt, workers=workers, cache=cache):
+            failed.append(name)
+    
+    summary = f"Ассемблировано файлов: {len(sources) - len(failed)} из {len(sources)}"
+    if cache is not None:
+        summary += f" (из кэша: {cache.hits}, разобрано: {cache.misses})"
+    print(summary)
+    if failed:
+        print(f"С ошибками: {', '.join(failed)}")
+    return not failed
+
+def cache_from_cli(options):
+    """Кэш ассемблера по опциям --cache[=каталог], --cache-size=МБ
+    
+    Кэш включается только явно; --no-cache отменяет --cache.
+    """
+    if "cache" not in options or "no-cache" in options:
+        return None
+    max_bytes = int(options["cache-size"]) << 20 if options.get("cache-size") else ASM_CACHE_SIZE
+    return AssemblyCache(options.get("cache") or ASM_CACHE_DIR, max_bytes)
+
+# Оптимизатор программы: удаление команд, не влияющих на итоговые memory и regs
+def _static_accesses(program, mem_size, num_regs, word_bits, regs=None):
+    """Прямой проход с известными значениями регистров (после LOAD)
+    
+    Возвращает (адреса, признаки): адрес памяти каждой команды - ячейка,
+    которую читает READ, пишет WRITE или пишет SQRT (None - неизвестен или
+    нет), и признак того, что команда заведомо выполняется без ошибки.
+    regs - значения регистров в начале (по умолчанию неизвестны).
+    """
+    low, high = (None, None) if word_bits is None else (-(1 << (word_bits - 1)), (1 << (word_bits - 1)) - 1)
+    # Допустимые номера регистров и адреса - только int (не bool и не float из JSON)
+    valid_regs = {reg: True for reg in range(num_regs)}
+    valid_addrs = range(mem_size)
+    
+    known = {} if regs is None else {reg: int(value) for reg, value in enumerate(regs)}
+    addrs = []
+    safe = []
+    for cmd in program:
+        opcode = cmd[0]
+        addr = None
+        ok = False
+        if opcode == CMD_LOAD and len(cmd) == 3 and type(cmd[2]) is int and cmd[2] in valid_regs:
+            const = cmd[1]
+            ok = low is None or low <= const <= high
+            known[cmd[2]] = const if ok else None
+        elif (opcode == CMD_READ and len(cmd) == 3 and type(cmd[1]) is int and type(cmd[2]) is int
+              and cmd[1] in valid_regs and cmd[2] in valid_regs):
+            addr = known.get(cmd[1])
+            ok = addr in valid_addrs
+            known[cmd[2]] = None
+        elif (opcode == CMD_WRITE and len(cmd) == 4 and type(cmd[1]) is int and type(cmd[2]) is int
+              and type(cmd[3]) is int and cmd[1] in valid_regs and cmd[3] in valid_regs):
+            base = known.get(cmd[3])
+            addr = None if base is None else base + cmd[2]
+            ok = addr in valid_addrs
+        elif opcode == CMD_SQRT and len(cmd) == 3 and type(cmd[1]) is int and type(cmd[2]) is int:
+            addr = cmd[2]
+            ok = cmd[1] in valid_addrs and addr in valid_addrs
+        addrs.append(addr)
+        safe.append(ok)
+    return addrs, safe
+
+def optimize_program(program, mem_size=1024, num_regs=256, word_bits=None):
+    """Удаление мертвых LOAD/READ, перезаписанных WRITE и SQRT
+    
+    Итоговые memory и regs после VirtualMachine.run() не меняются для ВМ с
+    памятью не меньше mem_size ячеек и num_regs регистрами; word_bits -
+    разрядность слова (None - хранилище list без ограничения).
+    Прямой проход вычисляет известные значения регистров (после LOAD),
+    обратный - живые регистры и ячейки, которые будут перезаписаны до
+    чтения. Удаляются только команды, которые не могут завершиться ошибкой:
+    команда с неизвестным или недопустимым адресом остается и считается
+    точкой, где наблюдаются все регистры и вся память (выполнение может на
+    ней остановиться). Возвращает (новая программа, Counter удаленных
+    команд по мнемоникам).
+    """
+    addrs, safe = _static_accesses(program, mem_size, num_regs, word_bits)
+    
+    # Обратный проход: в конце наблюдаются все регистры и вся память
+    all_regs = range(num_regs)
+    live = set(all_regs)
+    dead_cells = set()  # Ячейки, перезаписываемые до любого чтения
+    keep = [True] * len(program)
+    for i in range(len(program) - 1, -1, -1):
+        cmd = program[i]
+        if not safe[i]:
+            live.update(all_regs)
+            dead_cells.clear()
+            continue
+        opcode = cmd[0]
+        if opcode == CMD_LOAD:
+            if cmd[2] not in live:
+                keep[i] = False
+            live.discard(cmd[2])
+        elif opcode == CMD_READ:
+            if cmd[2] not in live:
+                keep[i] = False
+                continue
+            live.discard(cmd[2])
+            live.add(cmd[1])
+            dead_cells.discard(addrs[i])
+        elif opcode == CMD_WRITE:
+            if addrs[i] in dead_cells:
+                keep[i] = False
+                continue
+            dead_cells.add(addrs[i])
+            live.add(cmd[1])
+            live.add(cmd[3])
+        else:
+            if cmd[2] in dead_cells:
+                keep[i] = False
+                continue
+            dead_cells.add(cmd[2])
+            dead_cells.discard(cmd[1])
+    
+    removed = collections.Counter(BY_OPCODE[cmd[0]].mnemonic
+                                  for cmd, kept in zip(program, keep) if not kept)
+    return [cmd for cmd, kept in zip(program, keep) if kept], removed
+
+def optimize_file(program_file, mem_size=1024, num_regs=256, word_bits=None):
+    """Оптимизация файла программы на месте (формат сохраняется) с отчетом"""
+    try:
+        program = read_program(program_file)
+        optimized, removed = optimize_program(program, mem_size, num_regs, word_bits)
+        tmp_file = f"{program_file}.tmp{os.getpid()}"
+        try:
+            save_program(optimized, tmp_file, program_format(program_file))
+            os.replace(tmp_file, program_file)
+        finally:
+            if os.path.exists(tmp_file):
+                os.remove(tmp_file)
+    except Exception as e:
+        print(f"Ошибка оптимизации: {e}")
+        return False
+    details = ", ".join(f"{name} {count}" for name, count in sorted(removed.items()))
+    print(f"Оптимизация: удалено {len(program) - len(optimized)} из {len(program)} команд"
+          + (f" ({details})" if details else ""))
+    return True
+
+# Анализ зависимостей: разбиение программы на независимые сегменты
+ANALYZE_TOP = 10  # Размеров наибольших сегментов в отчете
+
+def _instruction_places(cmd, addr):
+    """Места, которые читает и пишет команда: регистр r - ключ -1 - r, ячейка - ее адрес
+    
+    addr - адрес из _static_accesses. Возвращает (читаемые места, записываемое место).
+    """
+    opcode = cmd[0]
+    if opcode == CMD_LOAD:
+        return (), -1 - cmd[2]
+    if opcode == CMD_READ:
+        return (-1 - cmd[1], addr), -1 - cmd[2]
+    if opcode == CMD_WRITE:
+        return (-1 - cmd[1], -1 - cmd[3]), addr
+    return (cmd[1],), cmd[2]
+
+def analyze_program(program, mem_size=1024, num_regs=256, word_bits=None, regs=None):
+    """Разбиение программы на сегменты, не связанные зависимостями по данным
+    
+    Для каждой команды вычисляются множества чтения и записи (регистры и
+    ячейки памяти с адресами из прямого прохода _static_accesses). Команды
+    объединяются (система непересекающихся множеств), если одна пишет то,
+    что другая читает или пишет: сегменты можно выполнять в любом порядке и
+    на разных ВМ. Чтение одной ячейки без записи сегменты не связывает.
+    Если адрес какой-то команды неизвестен или команда может завершиться
+    ошибкой, программа не разбивается. Возвращает (список сегментов - списков
+    номеров команд по возрастанию, или None; отчет - словарь для JSON).
+    """
+    addrs, safe = _static_accesses(program, mem_size, num_regs, word_bits, regs)
+    return _dependency_segments(program, addrs, safe)
+
+def _dependency_segments(program, addrs, safe):
+    """Сегменты и отчет analyze_program по результатам прямого прохода"""
+    report = {"instructions": len(program), "segments": 1 if program else 0,
+              "largest": len(program), "parallelism": 1.0, "sizes": [len(program)] if program else []}
+    if not all(safe):
+        report["blocked_by"] = safe.index(False)
+        return None, report
+    
+    parent = list(range(len(program)))
+    
+    def find(i):
+        while parent[i] != i:
+            parent[i] = parent[parent[i]]
+            i = parent[i]
+        return i
+    
+    # Читавшие место после записи уже связаны с писавшей командой, поэтому
+    # следующая запись связывается только с ней; отдельно хранятся команды,
+    # читавшие начальное значение места (до первой записи)
+    writers = {}   # место -> последняя писавшая команда
+    readers = {}   # место -> команды, читавшие начальное значение
+    for i, cmd in enumerate(program):
+        reads, written = _instruction_places(cmd, addrs[i])
+        linked = [writers[place] for place in reads if place in writers]
+        if written in writers:
+            linked.append(writers[written])
+        else:
+            linked.extend(readers.pop(written, ()))
+        for place in reads:
+            if place not in writers:
+                readers.setdefault(place, []).append(i)
+        # Корень - наименьший номер: команда i пока сама себе корень
+        root = i
+        for j in linked:
+            j = find(j)
+            if j < root:
+                parent[root] = j
+                root = j
+            elif j > root:
+                parent[j] = root
+        writers[written] = i
+    
+    groups = {}
+    for i in range(len(program)):
+        groups.setdefault(find(i), []).append(i)
+    segments = list(groups.values())
+    sizes = sorted((len(segment) for segment in segments), reverse=True)
+    if sizes:
+        report.update(segments=len(segments), largest=sizes[0],
+                      parallelism=len(program) / sizes[0], sizes=sizes[:ANALYZE_TOP])
+    return segments, report
+
+# Хранилища памяти и регистров
+STORAGE_BACKENDS = ("list", "array", "numpy", "mmap", "paged")
+OVERFLOW_POLICIES = ("error", "wrap", "saturate")
+WORD_TYPECODES = {array(code).itemsize * 8: code for code in "qlihb"}
+
+def make_storage(size, storage="list", word_bits=64):
+    """Выделение обнуленного хранилища слов: список, array, numpy-массив или PagedMemory"""
+    if storage == "list":
+        return [0] * size
+    if storage == "paged":
+        return PagedMemory(size)
+    if word_bits not in WORD_TYPECODES:
+        raise ValueError(f"неподдерживаемая ширина слова: {word_bits} "
+                         f"(доступны: {', '.join(map(str, sorted(WORD_TYPECODES)))})")
+    if storage == "array":
+        return array(WORD_TYPECODES[word_bits], [0]) * size
+    if storage == "numpy":
+        numpy = load_numpy()
+        if numpy is None:
+            raise ValueError("для хранилища numpy требуется пакет numpy")
+        return numpy.zeros(size, dtype=f"int{word_bits}")
+    if storage == "mmap":
+        raise ValueError("для хранилища mmap нужен файл памяти (mem_file)")
+    raise ValueError(f"неизвестное хранилище: {storage} (доступны: {', '.join(STORAGE_BACKENDS)})")
+
+MEMORY_PAGE_BITS = 9                   # Страница памяти paged - 512 ячеек
+MEMORY_PAGE_MASK = (1 << MEMORY_PAGE_BITS) - 1
+
+class PagedMemory:
+    """Память из страниц с копированием при записи (хранилище "paged")
+    
+    Значения - целые Python без ограничения разрядности, как у list.
+    fork() за O(1) создает копию, которая делит с исходной памятью и таблицу
+    страниц, и сами страницы: при первой записи копируется таблица (одна
+    ссылка на страницу), при первой записи в страницу - только эта страница.
+    Индексация повторяет list: отрицательный адрес отсчитывается от конца,
+    адрес вне памяти дает IndexError.
+    """
+    
+    __slots__ = ("size", "_table", "_table_shared", "_owned")
+    
+    def __init__(self, size):
+        page_size = 1 << MEMORY_PAGE_BITS
+        # Все страницы - одна общая нулевая страница, копируемая при первой записи
+        self.size = size
+        self._table = [[0] * page_size] * ((size + page_size - 1) >> MEMORY_PAGE_BITS)
+        self._table_shared = False
+        self._owned = set()
+    
+    def fork(self):
+        """Копия памяти с общими страницами; обе стороны копируют страницу при записи"""
+        child = PagedMemory.__new__(PagedMemory)
+        child.size = self.size
+        child._table = self._table
+        child._table_shared = self._table_shared = True
+        child._owned = set()
+        self._owned = set()
+        return child
+    
+    def private_pages(self):
+        """Число страниц, скопированных этой памятью (не общих с другими)"""
+        return len(self._owned)
+    
+    def __len__(self):
+        return self.size
+    
+    def __iter__(self):
+        return itertools.islice(itertools.chain.from_iterable(self._table), self.size)
+    
+    def __getitem__(self, addr):
+        if type(addr) is slice:
+            start, stop, step = addr.indices(self.size)
+            if step != 1:
+                return [self[i] for i in range(start, stop, step)]
+            values = []
+            while start < stop:
+                offset = start & MEMORY_PAGE_MASK
+                take = min(stop - start, MEMORY_PAGE_MASK + 1 - offset)
+                values.extend(self._table[start >> MEMORY_PAGE_BITS][offset:offset + take])
+                start += take
+            return values
+        if addr < 0:
+            addr += self.size
+        if not 0 <= addr < self.size:
+            raise IndexError("list index out of range")
+        return self._table[addr >> MEMORY_PAGE_BITS][addr & MEMORY_PAGE_MASK]
+    
+    def __setitem__(self, addr, value):
+        if type(addr) is slice:
+            indices = range(*addr.indices(self.size))
+            values = list(value)
+            if len(values) != len(indices):
+                raise ValueError("размер памяти paged не меняется присваиванием среза")
+            for i, item in zip(indices, values):
+                self[i] = item
+            return
+        if addr < 0:
+            addr += self.size
+        if not 0 <= addr < self.size:
+            raise IndexError("list assignment index out of range")
+        index = addr >> MEMORY_PAGE_BITS
+        if index not in self._owned:
+            if self._table_shared:
+                self._table = list(self._table)
+                self._table_shared = False
+            self._table[index] = list(self._table[index])
+            self._owned.add(index)
+        self._table[index][addr & MEMORY_PAGE_MASK] = value
+
+def map_storage(path, size, word_bits=64):
+    """Память из файла, отображенного через mmap: (memoryview слов, объект mmap)
+    
+    Существующее содержимое файла становится начальным образом памяти без
+    копирования; недостающий хвост дописывается нулями как разреженный
+    участок, так что страницы занимают RSS только после обращения к ним.
+    Слова хранятся в машинном порядке байт.
+    """
+    if word_bits not in WORD_TYPECODES:
+        raise ValueError(f"неподдерживаемая ширина слова: {word_bits}")
+    if size <= 0:
+        raise ValueError("размер памяти mmap должен быть положительным")
+    nbytes = size * word_bits // 8
+    fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o644)
+    try:
+        if os.fstat(fd).st_size < nbytes:
+            os.ftruncate(fd, nbytes)
+        mapping = mmap.mmap(fd, nbytes)
+    finally:
+        os.close(fd)
+    return memoryview(mapping).cast(WORD_TYPECODES[word_bits]), mapping
+
+def storage_bytes(values, word_bits):
+    """Слова хранилища (list, array, numpy, memoryview) одним блоком байт little-endian
+    
+    Для list значение, не помещающееся в слово, дает OverflowError.
+    """
+    if is_ndarray(values):
+        return values.astype(f"<i{word_bits // 8}").tobytes()
+    if isinstance(values, (list, PagedMemory)):
+        words = array(WORD_TYPECODES[word_bits], values)
+    else:
+        words = array(WORD_TYPECODES[word_bits], values.tobytes())
+    if sys.byteorder == "big":
+        words.byteswap()
+    return words.tobytes()
+
+def storage_words(data, word_bits):
+    """Слова little-endian из data (блок storage_bytes) в виде array"""
+    words = array(WORD_TYPECODES[word_bits])
+    words.frombytes(data)
+    if sys.byteorder == "big":
+        words.byteswap()
+    return words
+
+def fill_storage(target, words):
+    """Запись слов (array или list) во все хранилище target на месте
+    
+    Значения должны помещаться в слово хранилища: их проверяет вызывающий
+    до записи, иначе ошибка оставила бы хранилище записанным частично.
+    """
+    if isinstance(target, (list, PagedMemory)):
+        target[:] = words.tolist() if isinstance(words, array) else list(words)
+    elif is_ndarray(target):
+        target[:] = words
+    else:
+        # array или memoryview mmap: слова переводятся в массив той же ширины
+        typecode = target.typecode if isinstance(target, array) else target.format
+        if not (isinstance(words, array) and words.typecode == typecode):
+            words = array(typecode, words)
+        target[:] = words if isinstance(target, array) else memoryview(words)
+
+def zero_storage(target):
+    """Обнуление хранилища target (list, array, numpy, memoryview) на месте"""
+    if is_ndarray(target):
+        target[:] = 0
+    elif isinstance(target, list):
+        target[:] = [0] * len(target)
+    elif isinstance(target, array):
+        target[:] = array(target.typecode, [0]) * len(target)
+    else:
+        # memoryview над mmap: порциями, чтобы не выделять буфер размером с память
+        raw = target.cast("B")
+        zeros = bytes(min(raw.nbytes, DUMP_CHUNK))
+        for offset in range(0, raw.nbytes, len(zeros)):
+            raw[offset:offset + len(zeros)] = zeros[:raw.nbytes - offset]
+
+# Дамп памяти
+DUMP_CHUNK = 65536  # Ячеек в одной порции потоковой записи дампа
+DUMP_MODES = ("dense", "sparse", "rle")
+
+def _dense_cells(chunks):
+    for base, values in chunks:
+        yield "".join(f'<cell address="{addr}" value="{value}" />'
+                      for addr, value in zip(range(base, base + len(values)), values))
+
+def _sparse_cells(chunks):
+    for base, values in chunks:
+        yield "".join(f'<cell address="{base + i}" value="{value}" />'
+                      for i, value in enumerate(values) if value)
+
+def _value_runs(chunks):
+    # Серия может продолжаться через границу порций, поэтому последняя держится до конца
+    run_addr = run_value = None
+    run_count = 0
+    for base, values in chunks:
+        parts = []
+        addr = base
+        for value, group in itertools.groupby(values):
+            length = sum(1 for _ in group)
+            if run_count and value == run_value:
+                run_count += length
+            else:
+                if run_count:
+                    parts.append(f'<run address="{run_addr}" count="{run_count}" value="{run_value}" />')
+                run_addr, run_value, run_count = addr, value, length
+            addr += length
+        yield "".join(parts)
+    if run_count:
+        yield f'<run address="{run_addr}" count="{run_count}" value="{run_value}" />'
+
+_DUMP_WRITERS = {"dense": _dense_cells, "sparse": _sparse_cells, "rle": _value_runs}
+
+@contextlib.contextmanager
+def atomic_output(output_file, mode='w'):
+    """Файл для записи, который заменяет output_file только после успешной записи
+    
+    Запись идет во временный файл рядом с output_file: при ошибке прежний
+    файл не меняется, а недописанный временный удаляется. В имени - номер
+    потока: потоки сервера ВМ пишут дампы одновременно.
+    """
+    tmp_file = f"{output_file}.tmp{os.getpid()}.{threading.get_ident()}"
+    try:
+        with open(tmp_file, mode, encoding=None if 'b' in mode else 'utf-8') as f:
+            yield f
+        os.replace(tmp_file, output_file)
+    finally:
+        if os.path.exists(tmp_file):
+            os.remove(tmp_file)
+
+def read_memory_dump(dump_file):
+    """Чтение XML-дампа любого режима в плотный вид: (начальный адрес, список значений)"""
+    start_addr = None
+    values = []
+    mode = "dense"
+    for event, elem in ET.iterparse(dump_file, events=("start", "end")):
+        if event == "start":
+            if elem.tag == "memory_dump":
+                start_addr = int(elem.get("start"))
+                mode = elem.get("mode", "dense")
+                if mode != "dense":
+                    values = [0] * int(elem.get("count"))
+            continue
+        if elem.tag == "cell":
+            value = int(elem.get("value"))
+            if mode == "dense":
+                values.append(value)
+            else:
+                values[int(elem.get("address")) - start_addr] = value
+        elif elem.tag == "run":
+            offset = int(elem.get("address")) - start_addr
+            count = int(elem.get("count"))
+            values[offset:offset + count] = [int(elem.get("value"))] * count
+        else:
             continue
+        elem.clear()
+    return start_addr, values
+
+# Бинарный дамп: заголовок + слова little-endian подряд
+DUMP_MAGIC = b"UVMD"
+DUMP_VERSION = 1
+DUMP_HEADER = struct.Struct("<4sHHqQ")  # сигнатура, версия, разрядность слова, начало, число ячеек
+DUMP_FORMATS = ("xml", "bin", "npy")
+
+def npy_header(word_bits, count):
+    """Заголовок файла .npy версии 1.0 для одномерного массива целых слов"""
+    header = f"{{'descr': '<i{word_bits // 8}', 'fortran_order': False, 'shape': ({count},), }}"
+    # Данные в .npy должны начинаться с границы 64 байт: 10 байт префикса + заголовок + '\n'
+    header += " " * (-(10 + len(header) + 1) % 64) + "\n"
+    return b"\x93NUMPY\x01\x00" + struct.pack("<H", len(header)) + header.encode("latin1")
+
+def read_memory_bin(dump_file):
+    """Чтение бинарного дампа: (начальный адрес, array значений)"""
+    with open(dump_file, 'rb') as f:
+        data = f.read()
+    magic, version, word_bits, start_addr, count = DUMP_HEADER.unpack_from(data, 0)
+    if magic != DUMP_MAGIC:
+        raise ValueError("неверная сигнатура бинарного дампа")
+    if version != DUMP_VERSION:
+        raise ValueError(f"неподдерживаемая версия дампа: {version}")
+    if word_bits not in WORD_TYPECODES or len(data) != DUMP_HEADER.size + count * word_bits // 8:
+        raise ValueError("размер данных дампа не совпадает с заголовком")
+    return start_addr, storage_words(data[DUMP_HEADER.size:], word_bits)
+
+# ЭТАП 2
+VM_ENGINES = ("interp", "fast", "compile")
+
+# ЭТАП 3: корни больших операндов (длинная арифметика хранилища list) запоминаются;
+# для слов до 64 бит math.isqrt быстрее поиска в кэше
+SQRT_MEMO_MIN = 1 << 64
+SQRT_MEMO_SIZE = 4096
+isqrt_memo = functools.lru_cache(maxsize=SQRT_MEMO_SIZE)(math.isqrt)
+
+# Трассировка ВМ: уровни по возрастанию подробности
+TRACE_OFF = -1
+TRACE_ERROR = 0    # Ошибки загрузки, выполнения и дампа
+TRACE_INFO = 1     # Итоги загрузки, выполнения и дампа (по умолчанию)
+TRACE_SQRT = 2     # Строка на каждую команду SQRT
+TRACE_INSTR = 3    # Строка на каждую выполненную команду
+TRACE_LEVELS = {"off": TRACE_OFF, "error": TRACE_ERROR, "info": TRACE_INFO,
+                "sqrt": TRACE_SQRT, "instr": TRACE_INSTR}
+TRACE_BUFFER = 1 << 16  # Размер буфера файла трассировки
+
+class Tracer:
+    """Вывод трассировки ВМ с уровнем подробности
+    
+    Места вызова сравнивают tracer.level с уровнем до форматирования строки,
+    в горячих циклах сравнение вынесено за цикл - выключенная трассировка
+    ничего не стоит. Вывод идет в stdout, в буферизованный файл или в
+    кольцевой буфер последних ring строк, который выписывается при close().
+    Ошибки при выводе не в stdout дублируются в stdout.
+    """
+    
+    def __init__(self, level="info", file=None, ring=0):
+        if level not in TRACE_LEVELS:
+            raise ValueError(f"неизвестный уровень трассировки: {level} "
+                             f"(доступны: {', '.join(TRACE_LEVELS)})")
+        self.level = TRACE_LEVELS[level]
+        self.ring = collections.deque(maxlen=ring) if ring else None
+        self._out = open(file, 'w', encoding='utf-8', buffering=TRACE_BUFFER) if file else None
+    
+    def _emit(self, message):
+        if self._out is not None:
+            self._out.write(message + "\n")
+        else:
+            print(message)
+    
+    def write(self, message):
+        """Запись строки без проверки уровня (уровень проверяет вызывающий)"""
+        if self.ring is not None:
+            self.ring.append(message)
+        else:
+            self._emit(message)
+    
+    def error(self, message):
+        if self.level >= TRACE_ERROR:
+            self.write(message)
+            if self.ring is not None or self._out is not None:
+                print(message)
+    
+    def info(self, message):
+        if self.level >= TRACE_INFO:
+            self.write(message)
+    
+    def close(self):
+        """Выписывание кольцевого буфера и закрытие файла трассировки"""
+        if self.ring is not None:
+            while self.ring:
+                self._emit(self.ring.popleft())
+        if self._out is not None:
+            self._out.close()
+            self._out = None
+
+class VMHalt(Exception):
+    """Останов ВМ из обработчика команды; args[0] - сообщение об ошибке (если есть)"""
+
+def _make_raiser(exc):
+    """Обработчик, повторяющий ошибку разбора команды в момент ее выполнения"""
+    def op():
+        raise exc
+    return op
+
+def _load_handler(cmd, regs, memory, execute_sqrt, fit_word):
+    const, reg_dst = cmd[1], cmd[2]
+    if fit_word is not None:
+        const = fit_word(const)
+    def op():
+        regs[reg_dst] = const
+    return op
+
+def _read_handler(cmd, regs, memory, execute_sqrt, fit_word):
+    reg_src, reg_dst = cmd[1], cmd[2]
+    def op():
+        regs[reg_dst] = memory[regs[reg_src]]
+    return op
+
+def _write_handler(cmd, regs, memory, execute_sqrt, fit_word):
+    reg_src, offset, reg_addr = cmd[1], cmd[2], cmd[3]
+    mem_size = len(memory)
+    if fit_word is not None:
+        # Слова numpy складываются в своей разрядности с переполнением: адрес - в int
+        def op():
+            addr = int(regs[reg_addr]) + offset
+            if 0 <= addr < mem_size:
+                memory[addr] = regs[reg_src]
+            else:
+                raise VMHalt(f"Ошибка: адрес {addr} вне диапазона памяти")
+        return op
+    def op():
+        addr = regs[reg_addr] + offset
+        if 0 <= addr < mem_size:
+            memory[addr] = regs[reg_src]
+        else:
+            raise VMHalt(f"Ошибка: адрес {addr} вне диапазона памяти")
+    return op
+
+def _sqrt_handler(cmd, regs, memory, execute_sqrt, fit_word):
+    addr_src, addr_dst = cmd[1], cmd[2]
+    def op():
+        if not execute_sqrt(addr_src, addr_dst):
+            raise VMHalt()
+    return op
+
+HANDLER_FACTORIES = {
+    CMD_LOAD: _load_handler,
+    CMD_READ: _read_handler,
+    CMD_WRITE: _write_handler,
+    CMD_SQRT: _sqrt_handler,
+}
+
+@contextlib.contextmanager
+def gc_paused():
+    """Сборка мусора выключена на время блока
+    
+    Обработчики команд не образуют циклов ссылок, а сборщик, обходящий
+    миллионы только что созданных замыканий, замедляет декодирование и
+    первое выполнение в разы.
+    """
+    was_enabled = gc.isenabled()
+    gc.disable()
+    try:
+        yield
+    finally:
+        if was_enabled:
+            gc.enable()
+
+def make_handler(cmd, regs, memory, execute_sqrt, fit_word=None):
+    """Предекодирование одной команды в замыкание с привязанными операндами
+    
+    Семантика и сообщения об ошибках совпадают с VirtualMachine._run_interp:
+    ошибки разбора команды и переполнения константы откладываются до момента
+    ее выполнения. fit_word - приведение констант LOAD к слову памяти.
+    """
+    opcode = cmd[0]
+    factory = HANDLER_FACTORIES.get(opcode)
+    if factory is None:
+        return _make_raiser(VMHalt(f"Неизвестный код операции: {opcode}"))
+    try:
+        return factory(cmd, regs, memory, execute_sqrt, fit_word)
+    except (IndexError, OverflowError) as e:
+        return _make_raiser(e)
+
+# Профилирование: выборка каждой PROFILE_SAMPLE-й команды, гистограммы адресов столбцами
+PROFILE_SAMPLE = 64
+PROFILE_BUCKET = 64
+PROFILE_HISTOGRAMS = ("READ", "WRITE", "SQRT_SRC", "SQRT_DST")
+
+# Снимок состояния ВМ: заголовок + регистры + память словами little-endian
+SNAPSHOT_MAGIC = b"UVMS"
+SNAPSHOT_VERSION = 1
+# сигнатура, версия, флаги, разрядность слова, pc, число регистров, размер памяти, sha256 программы
+SNAPSHOT_HEADER = struct.Struct("<4sHHHxxQQQ32s")
+SNAPSHOT_ZLIB = 1   # Флаг: данные сжаты zlib
+SNAPSHOT_JSON = 2   # Флаг: данные - JSON (значения list не помещаются в 64 бита)
+SNAPSHOT_ZLIB_LEVEL = 1
+
+# Образ начального состояния (partial_evaluate): JSON с регистрами и ячейками памяти
+IMAGE_FORMAT = "uvm-image"
+IMAGE_VERSION = 1
+
+DECODE_CHUNK = 4096        # Команд в блоке предекодированных обработчиков кэша ВМ
+COMPILE_CHUNK = 2048       # Команд в одной сгенерированной функции
+COMPILE_CACHE_SIZE = 8     # Программ в кэше скомпилированного кода
+COMPILER_VERSION = 1       # Увеличивается при любом изменении генерируемого кода
+_compiled_cache = {}
+_compiled_lock = threading.Lock()  # ВМ сервера компилируют из потоков пула
+
+class CompiledFault(Exception):
+    """Ошибка в скомпилированном блоке: args = (индекс команды в блоке, исходное исключение)"""
+
+def program_hash(program):
+    """Хеш содержимого программы (команды-списки и команды-кортежи дают одинаковый хеш)"""
+    data = json.dumps(program, separators=(',', ':')).encode('utf-8')
+    return hashlib.sha256(data).hexdigest()
+
+def program_key(program):
+    """Быстрый ключ кэша кода: sha256 от marshal программы
+    
+    В несколько раз быстрее program_hash, но списки и кортежи дают разные
+    ключи; программа со значениями не из int (например, numpy) хешируется
+    program_hash.
+    """
+    try:
+        data = marshal.dumps(program)
+    except ValueError:
+        return program_hash(program)
+    return hashlib.sha256(data).hexdigest()
+
+def _address_halt(addr):
+    raise VMHalt(f"Ошибка: адрес {addr} вне диапазона памяти")
+
+def _message_halt(message):
+    raise VMHalt(message)
+
+def _compile_chunk(commands, num_regs, fit_word, name, trace=False):
+    """Генерация функции, выполняющей блок команд без диспетчеризации
+    
+    Регистры блока живут в локальных переменных и записываются обратно в
+    R при выходе. Каждая команда занимает ровно одну строку тела, поэтому
+    номер упавшей команды восстанавливается по номеру строки в traceback.
+    Строка SQRT выводится функцией трассировки T, только если trace.
+    Возвращает (код модуля, определяющего функцию, константы, множество
+    индексов команд SQRT в блоке); функцию создает _link_chunk.
+    """
+    consts = []
+    used = set()
+    assigned = set()
+    
+    def lit(value):
+        if type(value) is int:
+            return repr(value)
+        consts.append(value)
+        return f"K[{len(consts) - 1}]"
+    
+    def reg(r, target=False):
+        # Недопустимые номера остаются обращением к списку R - с той же ошибкой, что в run()
+        if type(r) is int and -num_regs <= r < num_regs:
+            r %= num_regs
+            used.add(r)
+            if target:
+                assigned.add(r)
+            return f"r{r}"
+        return f"R[{lit(r)}]"
+    
+    body = []
+    sqrt_lines = set()
+    for i, cmd in enumerate(commands):
+        opcode = cmd[0]
+        try:
+            if opcode == CMD_LOAD:
+                const, reg_dst = cmd[1], cmd[2]
+                if fit_word is not None:
+                    const = fit_word(const)
+                line = f"{reg(reg_dst, True)} = {lit(const)}"
+            elif opcode == CMD_READ:
+                reg_src, reg_dst = cmd[1], cmd[2]
+                src = reg(reg_src)
+                line = f"{reg(reg_dst, True)} = M[{src}]"
+            elif opcode == CMD_WRITE:
+                reg_src, offset, reg_addr = cmd[1], cmd[2], cmd[3]
+                # Регистр слова фиксированной ширины может быть скаляром numpy: сумма - в int
+                addr = reg(reg_addr) if fit_word is None else f"int({reg(reg_addr)})"
+                line = (f"a = {addr} + {lit(offset)}; "
+                        f"M[a] = {reg(reg_src)} if 0 <= a < n else _halt(a)")
+            elif opcode == CMD_SQRT:
+                src, dst = lit(cmd[1]), lit(cmd[2])
+                line = (f"v = M[{src}]; w = (_isqrt(v) if v < _big else _memo(v)) if v >= 0 else 0; "
+                        f"M[{dst}] = w")
+                if trace:
+                    line += (f"; T(f\"SQRT: memory[{{{src}}}]={{v}} -> sqrt={{w}} "
+                             f"-> memory[{{{dst}}}]\")")
+                sqrt_lines.add(i)
+            else:
+                line = f"_stop({'Неизвестный код операции: ' + str(opcode)!r})"
+        except (IndexError, OverflowError) as e:
+            line = f"raise {type(e).__name__}({str(e)!r})"
+        body.append("        " + line)
+    
+    loads = "; ".join(f"r{r} = R[{r}]" for r in sorted(used)) or "pass"
+    stores = "; ".join(f"R[{r}] = r{r}" for r in sorted(assigned)) or "pass"
+    first_line = 6
+    source = "\n".join([
+        "def chunk(R, M, T=None, K=K, _halt=_halt, _stop=_stop, _isqrt=_isqrt, _memo=_memo,",
+        "          _big=_big, _Fault=_Fault):",
+        "    n = len(M)",
+        "    " + loads,
+        "    try:",
+        *body,
+        "    except Exception as e:",
+        f"        raise _Fault(e.__traceback__.tb_lineno - {first_line}, e)",
+        "    finally:",
+        "        " + stores,
+        "",
+    ])
+    return compile(source, name, "exec"), consts, sqrt_lines
+
+def _link_chunk(code, consts):
+    """Функция блока из кода _compile_chunk (в том числе загруженного из кэша)"""
+    namespace = {
+        "K": consts, "_halt": _address_halt, "_stop": _message_halt,
+        "_isqrt": math.isqrt, "_memo": isqrt_memo, "_big": SQRT_MEMO_MIN,
+        "_Fault": CompiledFault,
+    }
+    exec(code, namespace)
+    return namespace["chunk"]
+
+def compile_program(program, num_regs=256, fit_word=None, word_key=None, trace=False, cache=None):
+    """Компиляция программы в список блоков (начальный pc, функция, индексы SQRT)
+    
+    Константы LOAD приводятся к слову памяти функцией fit_word. Результат
+    кэшируется в памяти процесса по ключу программы, числу регистров,
+    word_key - параметрам слова - и признаку трассировки SQRT. С cache
+    (AssemblyCache) код блоков хранится и на диске (marshal, запись .code):
+    компиляция стоит десятки микросекунд на команду, а загрузка - доли
+    микросекунды, так что повторные запуски из командной строки ее не платят.
+    """
+    key = (program_key(program), num_regs, word_key, trace)
+    with _compiled_lock:
+        chunks = _compiled_cache.pop(key, None)
+    if chunks is None:
+        disk_key = None
+        compiled = None
+        if cache is not None:
+            # Байт-код и marshal зависят от версии Python
+            disk_key = hashlib.sha256(repr((COMPILER_VERSION, importlib.util.MAGIC_NUMBER, COMPILE_CHUNK)
+                                           + key).encode('utf-8')).hexdigest()
+            try:
+                data = cache.read_entry(disk_key, "code")
+                if data is not None:
+                    compiled = marshal.loads(data)
+                    if not all(isinstance(code, types.CodeType) for _, code, _, _ in compiled):
+                        raise ValueError("в записи не код Python")
+            except (OSError, ValueError, EOFError, TypeError) as e:
+                print(f"Предупреждение: запись кэша кода не прочитана: {e}")
+                compiled = None
+        if compiled is None:
+            compiled = []
+            for base in range(0, len(program), COMPILE_CHUNK):
+                name = f"<uvm {key[0][:12]} @{base}>"
+                code, consts, sqrt_lines = _compile_chunk(program[base:base + COMPILE_CHUNK], num_regs,
+                                                          fit_word, name, trace)
+                compiled.append((base, code, consts, sqrt_lines))
+            if cache is not None:
+                try:
+                    cache.write_entry(disk_key, "code", marshal.dumps(compiled))
+                except (OSError, ValueError) as e:
+                    # ValueError - константы, которые marshal не сохраняет
+                    print(f"Предупреждение: код не сохранен в кэш: {e}")
+        chunks = [(base, _link_chunk(code, consts), set(sqrt_lines))
+                  for base, code, consts, sqrt_lines in compiled]
+    # Компиляция идет без блокировки: одну программу могут скомпилировать
+    # два потока сразу, но в кэше останется одна копия
+    with _compiled_lock:
+        _compiled_cache.pop(key, None)
+        while len(_compiled_cache) >= COMPILE_CACHE_SIZE:
+            _compiled_cache.pop(next(iter(_compiled_cache)))
+        _compiled_cache[key] = chunks
+    return chunks
+
+class VirtualMachine:
+    """Виртуальная машина УВМ (Вариант 21)"""
+    
+    def __init__(self, mem_size=1024, num_regs=256, storage="list", word_bits=64,
+                 overflow="error", mem_file=None, trace="info", trace_file=None, trace_ring=0,
+                 code_cache=None):
+        """storage: "list" - списки целых Python без ограничения разрядности,
+        "array"/"numpy" - типизированные массивы слов шириной word_bits,
+        "mmap" - память в файле mem_file, отображенном в адресное пространство
+        (регистры в этом случае - array).
+        overflow: что делать с константой LOAD, не помещающейся в слово:
+        "error" - ошибка выполнения, "wrap" - по модулю 2**word_bits,
+        "saturate" - ограничение минимальным/максимальным значением слова.
+        trace: уровень трассировки (см. TRACE_LEVELS): "off", "error", "info",
+        "sqrt" - строка на каждую команду SQRT, "instr" - на каждую команду;
+        вывод - в stdout, в файл trace_file или в кольцевой буфер последних
+        trace_ring строк (выписывается в close()).
+        code_cache: AssemblyCache для кода движка compile между запусками
+        (None - код кэшируется только в памяти процесса).
+        """
+        if overflow not in OVERFLOW_POLICIES:
+            raise ValueError(f"неизвестная политика переполнения: {overflow} "
+                             f"(доступны: {', '.join(OVERFLOW_POLICIES)})")
+        self.tracer = Tracer(trace, trace_file, trace_ring)
+        self._owns_tracer = True
+        self._mapping = None
+        try:
+            if storage == "mmap":
+                if mem_file is None:
+                    raise ValueError("для хранилища mmap нужен файл памяти (mem_file)")
+                self.memory, self._mapping = map_storage(mem_file, mem_size, word_bits)
+                self.regs = make_storage(num_regs, "array", word_bits)
+            else:
+                self.memory = make_storage(mem_size, storage, word_bits)
+                # Регистров мало: для памяти paged они - обычный список
+                self.regs = make_storage(num_regs, "list" if storage == "paged" else storage, word_bits)
+        except BaseException:
+            # ВМ не создана, и close() никто не вызовет: файл трассировки и mmap закрываются здесь
+            self.close()
+            raise
+        self.storage = storage
+        self.word_bits = word_bits
+        self.overflow = overflow
+        # Диапазон значений слова; None - без ограничения (хранилища list и paged)
+        if storage in ("list", "paged"):
+            self.word_range = None
+        else:
+            self.word_range = (-(1 << (word_bits - 1)), (1 << (word_bits - 1)) - 1)
+        self.pc = 0  # Program counter
+        self.program = []
+        self._compiled = None
+        self._compiled_for = None
+        self._compiled_trace = None
+        self.code_cache = code_cache
+        self._decoded = None
+        self._decoded_for = None
+        self._digest = None
+        self._digest_for = None
+        
+    def load_program(self, program_file):
+        """Загрузка программы из JSON или бинарного файла"""
+        try:
+            self.program = read_program(program_file)
+            self.tracer.info(f"Загружена программа из {program_file} ({len(self.program)} команд)")
+            return True
+        except Exception as e:
+            self.tracer.error(f"Ошибка загрузки программы: {e}")
+            return False
+    
+    def reset(self):
+        """Обнуление регистров, памяти и pc для повторного использования ВМ (программа остается)"""
+        self.pc = 0
+        zero_storage(self.regs)
+        if isinstance(self.memory, PagedMemory):
+            # Новая память без страниц: нули читаются из общей нулевой страницы
+            self.memory = PagedMemory(len(self.memory))
+            return
+        zero_storage(self.memory)
+    
+    def fork(self):
+        """Копия ВМ в том же состоянии: pc, регистры, память, программа
+        
+        Память paged делится с исходной ВМ по страницам с копированием при
+        записи, поэтому fork() выполняется за O(1) и тысячи копий занимают
+        память только под измененные страницы. Остальные хранилища
+        копируются целиком; память mmap не копируется. Копия пишет в ту же
+        трассировку, но не закрывает ее.
+        """
+        if self._mapping is not None:
+            raise ValueError("ВМ с памятью mmap нельзя разветвить")
+        child = copy.copy(self)
+        child.regs = copy.copy(self.regs)
+        if isinstance(self.memory, PagedMemory):
+            child.memory = self.memory.fork()
+        else:
+            child.memory = copy.copy(self.memory)
+        child._owns_tracer = False
+        child._decoded = child._decoded_for = None  # Обработчики привязаны к хранилищам исходной ВМ
+        return child
+    
+    def close(self):
+        """Закрытие трассировки, сброс на диск и закрытие памяти mmap"""
+        if self._owns_tracer:
+            self.tracer.close()
+        if self._mapping is None:
+            return
+        self.memory.release()
+        self._mapping.flush()
+        self._mapping.close()
+        self._mapping = None
+    
+    def fit_word(self, value):
+        """Приведение значения к слову памяти согласно политике переполнения"""
+        low, high = self.word_range
+        if low <= value <= high:
+            return value
+        if self.overflow == "wrap":
+            return (value - low) % (1 << self.word_bits) + low
+        if self.overflow == "saturate":
+            return low if value < low else high
+        raise OverflowError(f"значение {value} не помещается в {self.word_bits}-битное слово")
+    
+    def execute_sqrt(self, src_addr, dst_addr):
+        """ЭТАП 3: Выполнение команды SQRT (строка о выполнении - на уровне трассировки sqrt)"""
+        try:
+            value = self.memory[src_addr]
+            if value < 0:
+                result = 0
+            elif value < SQRT_MEMO_MIN:
+                result = math.isqrt(value)
+            else:
+                result = isqrt_memo(value)
+            
+            self.memory[dst_addr] = result
+            if self.tracer.level >= TRACE_SQRT:
+                self.tracer.write(f"SQRT: memory[{src_addr}]={value} -> sqrt={result} "
+                                  f"-> memory[{dst_addr}]")
+            return True
+        except IndexError:
+            self.tracer.error(f"Ошибка SQRT: адрес вне диапазона ({src_addr} или {dst_addr})")
+            return False
+        except Exception as e:
+            self.tracer.error(f"Ошибка SQRT: {e}")
+            return False
+    
+    def sqrt_range(self, src_addr, dst_addr, count):
+        """Пакетный SQRT: memory[dst_addr + i] = isqrt(memory[src_addr + i]) для i < count
+        
+        Результат тот же, что у count команд SQRT по порядку. Если приемник
+        начинается внутри источника (src_addr < dst_addr < src_addr + count),
+        команды читают уже записанные корни, и диапазон обрабатывается
+        поэлементно; иначе все значения читаются одним срезом и пишутся разом.
+        """
+        memory = self.memory
+        if count <= 0:
+            return True
+        if (min(src_addr, dst_addr) < 0
+                or max(src_addr, dst_addr) + count > len(memory)):
+            self.tracer.error(f"Ошибка SQRT: диапазон вне памяти ({src_addr} или {dst_addr}, {count} ячеек)")
+            return False
+        if src_addr < dst_addr < src_addr + count or self.tracer.level >= TRACE_SQRT:
+            for i in range(count):
+                if not self.execute_sqrt(src_addr + i, dst_addr + i):
+                    return False
+            return True
+        
+        values = memory[src_addr:src_addr + count]
+        if is_ndarray(memory):
+            memory[dst_addr:dst_addr + count] = isqrt_array(values)
+            return True
+        isqrt = math.isqrt
+        roots = [(isqrt(v) if v < SQRT_MEMO_MIN else isqrt_memo(v)) if v >= 0 else 0
+                 for v in values]
+        if isinstance(memory, (list, PagedMemory)):
+            memory[dst_addr:dst_addr + count] = roots
+        else:
+            for addr, root in zip(range(dst_addr, dst_addr + count), roots):
+                memory[addr] = root
+        return True
+    
+    def _engine(self, engine):
+        """Метод движка, выполняющий диапазон команд [start, stop), или None"""
+        if engine == "compile" and self.tracer.level >= TRACE_INSTR:
+            # В сгенерированном коде нет точек трассировки отдельных команд
+            self.tracer.info("Трассировка команд: движок compile заменен на fast")
+            engine = "fast"
+        runners = {"interp": self._run_interp, "fast": self._run_decoded,
+                   "compile": self._run_compiled}
+        if engine not in runners:
+            self.tracer.error(f"Неизвестный движок выполнения: {engine}")
+            return None
+        return runners[engine]
+    
+    def run(self, engine="interp", start=0, stop=None):
+        """Выполнение программы (включая ЭТАП 3)
+        
+        engine: "interp" - исходный интерпретатор,
+                "fast" - предекодированные обработчики команд (кэшируются в ВМ:
+                декодирование дороже одного прохода interp, выигрыш - с
+                повторных запусков и квантов той же программы),
+                "compile" - программа, скомпилированная в функции Python.
+        start, stop: выполняется диапазон команд [start, stop), по умолчанию
+        вся программа; после успешного выполнения pc = stop.
+        """
+        stop = len(self.program) if stop is None else min(stop, len(self.program))
+        runner = self._engine(engine)
+        if runner is None or not runner(start, stop):
+            return False
+        self.tracer.info(f"Выполнено {max(stop - start, 0)} команд (включая SQRT)")
+        return True
+    
+    def run_steps(self, budget, engine="fast"):
+        """Выполнение не более budget команд с pc; состояние и pc сохраняются
+        
+        Повторные вызовы продолжают программу с места остановки; программа
+        выполнена, когда pc == len(program). Возвращает False при ошибке
+        (pc - номер команды с ошибкой). Движок fast декодирует только команды
+        кванта; compile при первом вызове компилирует всю программу, зато
+        квант, кратный COMPILE_CHUNK, выполняет целыми блоками.
+        """
+        check_positive(budget, "квант команд")
+        stop = min(self.pc + budget, len(self.program))
+        runner = self._engine(engine)
+        return runner is not None and runner(self.pc, stop)
+    
+    def run_parallel(self, workers=None, engine="fast"):
+        """Выполнение с pc до конца программы независимыми сегментами в пуле процессов
+        
+        Сегменты (analyze_program) раскладываются по workers группам поровну
+        по числу команд; каждая группа выполняется на отдельной ВМ, а
+        записанные ею регистры и ячейки переносятся в эту ВМ. Итог совпадает
+        с run(): если программа не разбивается (неизвестный адрес, возможная
+        ошибка, один сегмент), нужна трассировка SQRT или команд или пул
+        процессов сломался, программа выполняется последовательно движком engine.
+        """
+        program = self.program[self.pc:]
+        word_bits, overflow = self._word_config()
+        addrs, safe = _static_accesses(program, len(self.memory), len(self.regs), word_bits, self.regs)
+        segments, report = _dependency_segments(program, addrs, safe)
+        workers = workers or os.cpu_count()
+        if segments is None or len(segments) < 2 or workers < 2 or self.tracer.level >= TRACE_SQRT:
+            self.tracer.info("Программа не разбивается на независимые сегменты: выполнение последовательное")
+            return self.run(engine, self.pc)
+        
+        # Жадная раскладка: очередной по размеру сегмент - в наименее загруженную группу
+        groups = [[] for _ in range(min(workers, len(segments)))]
+        loads = [0] * len(groups)
+        for segment in sorted(segments, key=len, reverse=True):
+            g = loads.index(min(loads))
+            groups[g].extend(segment)
+            loads[g] += len(segment)
+        
+        config = (len(self.memory), len(self.regs), word_bits, overflow)
+        tasks = []
+        for group in groups:
+            group.sort()
+            touched = set()
+            written = set()
+            for i in group:
+                reads, place = _instruction_places(program[i], addrs[i])
+                touched.update(reads)
+                written.add(place)
+            touched |= written
+            regs = [(-1 - place, int(self.regs[-1 - place])) for place in sorted(touched) if place < 0]
+            cells = [(place, int(self.memory[place])) for place in sorted(touched) if place >= 0]
+            tasks.append(([program[i] for i in group], regs, cells,
+                          sorted(-1 - place for place in written if place < 0),
+                          sorted(place for place in written if place >= 0)))
+        
+        try:
+            import concurrent.futures
+            with concurrent.futures.ProcessPoolExecutor(max_workers=len(tasks)) as pool:
+                futures = [pool.submit(run_segment, config, *task) for task in tasks]
+                results = [future.result() for future in futures]
+        except Exception as e:
+            # Состояние ВМ еще не менялось: выполнение с начала последовательно
+            self.tracer.info(f"Ошибка параллельного выполнения ({type(e).__name__}: {e}): "
+                             f"выполнение последовательное")
+            return self.run(engine, self.pc)
+        
+        for (_, _, _, written_regs, written_cells), (reg_values, cell_values) in zip(tasks, results):
+            for reg, value in zip(written_regs, reg_values):
+                self.regs[reg] = value
+            for addr, value in zip(written_cells, cell_values):
+                self.memory[addr] = value
+        self.pc = len(self.program)
+        self.tracer.info(f"Выполнено {len(program)} команд (включая SQRT): {report['segments']} сегментов "
+                         f"в {len(tasks)} процессах, параллелизм {report['parallelism']:.2f}")
+        return True
+    
+    def run_checkpointed(self, engine, every, snapshot_file, compress=False):
+        """Выполнение с pc до конца программы со снимком состояния каждые every команд
+        
+        Снимок пишется после каждого отрезка и в конце, так что после сбоя
+        выполнение продолжается из snapshot_file (см. restore).
+        """
+        runner = self._engine(engine)
+        if runner is None:
+            return False
+        start = self.pc
+        total = len(self.program)
+        while self.pc < total:
+            if not runner(self.pc, min(self.pc + every, total)):
+                return False
+            if not self.snapshot(snapshot_file, compress):
+                return False
+        self.tracer.info(f"Выполнено {total - start} команд (включая SQRT)")
+        return True
+    
+    def _run_interp(self, start, stop):
+        """Исходный интерпретатор: разбор каждой команды на каждом шаге"""
+        self.pc = start
+        tracer = self.tracer
+        trace_instr = tracer.level >= TRACE_INSTR
+        
+        while self.pc < stop:
+            cmd = self.program[self.pc]
+            if trace_instr:
+                tracer.write(format_command(self.pc, cmd))
+            opcode = cmd[0]
+            
+            try:
+                if opcode == CMD_LOAD:
+                    const, reg_dst = cmd[1], cmd[2]
+                    if self.word_range is not None:
+                        const = self.fit_word(const)
+                    self.regs[reg_dst] = const
+                    
+                elif opcode == CMD_READ:
+                    reg_src, reg_dst = cmd[1], cmd[2]
+                    addr = self.regs[reg_src]
+                    self.regs[reg_dst] = self.memory[addr]
+                    
+                elif opcode == CMD_WRITE:
+                    reg_src, offset, reg_addr = cmd[1], cmd[2], cmd[3]
+                    addr = self.regs[reg_addr]
+                    if self.word_range is not None:
+                        # Слово фиксированной ширины (скаляр numpy): сумма без переполнения
+                        addr = int(addr)
+                    addr += offset
+                    if 0 <= addr < len(self.memory):
+                        self.memory[addr] = self.regs[reg_src]
+                    else:
+                        tracer.error(f"Ошибка: адрес {addr} вне диапазона памяти")
+                        return False
+                        
+                elif opcode == CMD_SQRT:  # ЭТАП 3
+                    addr_src, addr_dst = cmd[1], cmd[2]
+                    if not self.execute_sqrt(addr_src, addr_dst):
+                        return False
+                    
+                else:
+                    tracer.error(f"Неизвестный код операции: {opcode}")
+                    return False
+                    
+            except (IndexError, OverflowError) as e:
+                tracer.error(f"Ошибка выполнения команды {self.pc}: {e}")
+                return False
+            
+            self.pc += 1
+        
+        return True
+    
+    def decode(self, start=0, stop=None):
+        """Предекодирование команд [start, stop) программы в список обработчиков"""
+        regs = self.regs
+        memory = self.memory
+        execute_sqrt = self.execute_sqrt
+        fit_word = self.fit_word if self.word_range is not None else None
+        with gc_paused():
+            try:
+                # Быстрый путь без разбора ошибок: почти все программы корректны
+                factories = HANDLER_FACTORIES
+                return [factories[cmd[0]](cmd, regs, memory, execute_sqrt, fit_word)
+                        for cmd in self.program[start:stop]]
+            except (KeyError, IndexError, OverflowError):
+                return [make_handler(cmd, regs, memory, execute_sqrt, fit_word)
+                        for cmd in self.program[start:stop]]
+    
+    def _decoded_range(self, start, stop):
+        """Обработчики команд [start, stop) из кэша ВМ
+        
+        Декодирование стоит дороже однократного выполнения команды, поэтому
+        обработчики хранятся блоками по DECODE_CHUNK команд: блок декодируется
+        при первом обращении, а повторные запуски и кванты run_steps берут
+        готовые. Кэш сбрасывается при смене программы или хранилищ ВМ.
+        """
+        key = (self.program, self.regs, self.memory)
+        cached = self._decoded_for
+        if (cached is None or cached[3] != len(self.program)
+                or any(a is not b for a, b in zip(cached, key))):
+            self._decoded = [None] * -(-len(self.program) // DECODE_CHUNK)
+            self._decoded_for = cached = key + (len(self.program),)
+        chunks = self._decoded
+        handlers = []
+        # Сборка мусора между блоками обходила бы все уже декодированные обработчики
+        with gc_paused():
+            for index in range(start // DECODE_CHUNK, -(-stop // DECODE_CHUNK)):
+                base = index * DECODE_CHUNK
+                chunk = chunks[index]
+                if chunk is None:
+                    chunk = chunks[index] = self.decode(base, base + DECODE_CHUNK)
+                handlers += chunk[max(start - base, 0):stop - base]
+        return handlers
+    
+    def _run_decoded(self, start, stop):
+        """Выполнение предекодированных команд в плотном цикле без разбора команд"""
+        handlers = self._decoded_range(start, stop)
+        total = start + len(handlers)
+        commands = iter(handlers)
+        tracer = self.tracer
+        self.pc = start
+        try:
+            if tracer.level >= TRACE_INSTR:
+                # Трассировка команд - отдельным циклом, чтобы не замедлять основной
+                program = self.program
+                for op in commands:
+                    tracer.write(format_command(self.pc, program[self.pc]))
+                    op()
+                    self.pc += 1
+            else:
+                for op in commands:
+                    op()
+        except VMHalt as e:
+            # Номер команды восстанавливается по остатку итератора: цикл не ведет счетчик
+            self.pc = total - operator.length_hint(commands) - 1
+            if e.args:
+                tracer.error(e.args[0])
+            return False
+        except (IndexError, OverflowError) as e:
+            self.pc = total - operator.length_hint(commands) - 1
+            tracer.error(f"Ошибка выполнения команды {self.pc}: {e}")
+            return False
+        
+        self.pc = total
+        return True
+    
+    def run_profiled(self, sample_every=PROFILE_SAMPLE):
+        """Выполнение предекодированной программы с pc до конца с профилированием
+        
+        Число выполненных команд каждого кода точное: переходов нет, и это
+        коды команд program[начальный pc:pc]. Время выполнения и адреса обращений
+        READ/WRITE/SQRT замеряются у каждой sample_every-й команды; время по
+        коду оценивается как среднее по выборке, умноженное на число команд.
+        Возвращает (успех, отчет - словарь для JSON).
+        """
+        check_positive(sample_every, "шаг выборки профиля")
+        start = self.pc
+        handlers = self.decode(start)
+        program = self.program
+        regs = self.regs
+        total = start + len(handlers)
+        commands = iter(handlers)
+        tracer = self.tracer
+        sampled = collections.Counter()
+        sampled_ns = collections.Counter()
+        histograms = {name: collections.Counter() for name in PROFILE_HISTOGRAMS}
+        clock = time.perf_counter_ns
+        skip = sample_every - 1
+        ok = True
+        started = time.perf_counter()
+        try:
+            for pc in range(start, total, sample_every):
+                cmd = program[pc]
+                opcode = cmd[0]
+                try:
+                    if opcode == CMD_READ:
+                        histograms["READ"][regs[cmd[1]] // PROFILE_BUCKET] += 1
+                    elif opcode == CMD_WRITE:
+                        histograms["WRITE"][(int(regs[cmd[3]]) + cmd[2]) // PROFILE_BUCKET] += 1
+                    elif opcode == CMD_SQRT:
+                        histograms["SQRT_SRC"][cmd[1] // PROFILE_BUCKET] += 1
+                        histograms["SQRT_DST"][cmd[2] // PROFILE_BUCKET] += 1
+                except (IndexError, TypeError):
+                    pass  # Ошибку сообщит обработчик команды
+                t0 = clock()
+                next(commands)()
+                sampled_ns[opcode] += clock() - t0
+                sampled[opcode] += 1
+                for op in itertools.islice(commands, skip):
+                    op()
+            self.pc = total
+        except VMHalt as e:
+            self.pc = total - operator.length_hint(commands) - 1
+            if e.args:
+                tracer.error(e.args[0])
+            ok = False
+        except (IndexError, OverflowError) as e:
+            self.pc = total - operator.length_hint(commands) - 1
+            tracer.error(f"Ошибка выполнения команды {self.pc}: {e}")
+            ok = False
+        wall_time = time.perf_counter() - started
+        executed = self.pc - start
+        if ok:
+            tracer.info(f"Выполнено {executed} команд (включая SQRT)")
+        
+        opcodes = {}
+        counts = collections.Counter(cmd[0] for cmd in itertools.islice(program, start, self.pc))
+        for opcode, count in sorted(counts.items(), key=lambda item: str(item[0])):
+            spec = BY_OPCODE.get(opcode)
+            samples = sampled[opcode]
+            opcodes[spec.mnemonic if spec else str(opcode)] = {
+                "count": count,
+                "samples": samples,
+                "time_estimate": sampled_ns[opcode] / samples * count / 1e9 if samples else None,
+            }
+        report = {
+            "completed": ok,
+            "start": start,
+            "executed": executed,
+            "wall_time": wall_time,
+            "ips": executed / wall_time if wall_time > 0 else None,
+            "sample_every": sample_every,
+            "opcodes": opcodes,
+            "address_bucket": PROFILE_BUCKET,
+            "address_histograms": {
+                name: {str(bucket * PROFILE_BUCKET): hits for bucket, hits in sorted(hist.items())}
+                for name, hist in histograms.items()
+            },
+        }
+        return ok, report
+    
+    def _run_compiled(self, start, stop):
+        """Выполнение программы, скомпилированной в прямолинейный код Python
+        
+        Компилируется (и кэшируется) вся программа; блоки, лишь частично
+        попавшие в [start, stop), выполняются предекодированными обработчиками.
+        """
+        tracer = self.tracer
+        trace = tracer.level >= TRACE_SQRT
+        # Повторные запуски той же программы на этой ВМ обходятся без хеширования
+        if self._compiled_for is not self.program or self._compiled_trace != trace:
+            if self.word_range is None:
+                self._compiled = compile_program(self.program, len(self.regs), trace=trace,
+                                                 cache=self.code_cache)
+            else:
+                self._compiled = compile_program(self.program, len(self.regs), self.fit_word,
+                                                 (self.word_bits, self.overflow), trace, self.code_cache)
+            self._compiled_for = self.program
+            self._compiled_trace = trace
+        chunks = self._compiled
+        regs = self.regs
+        memory = self.memory
+        self.pc = start
+        while self.pc < stop:
+            base, fn, sqrt_lines = chunks[self.pc // COMPILE_CHUNK]
+            end = min(base + COMPILE_CHUNK, len(self.program))
+            if self.pc != base or end > stop:
+                if not self._run_decoded(self.pc, min(end, stop)):
+                    return False
+                continue
+            try:
+                fn(regs, memory, tracer.write)
+            except CompiledFault as fault:
+                index, exc = fault.args
+                self.pc = base + index
+                if isinstance(exc, VMHalt):
+                    if exc.args:
+                        tracer.error(exc.args[0])
+                elif index in sqrt_lines:
+                    # Те же сообщения, что у execute_sqrt
+                    if isinstance(exc, IndexError):
+                        src_addr, dst_addr = self.program[self.pc][1:3]
+                        tracer.error(f"Ошибка SQRT: адрес вне диапазона ({src_addr} или {dst_addr})")
+                    else:
+                        tracer.error(f"Ошибка SQRT: {exc}")
+                elif isinstance(exc, (IndexError, OverflowError)):
+                    tracer.error(f"Ошибка выполнения команды {self.pc}: {exc}")
+                else:
+                    raise exc
+                return False
+            self.pc = end
+        
+        return True
+    
+    def _program_digest(self):
+        """sha256 загруженной программы для снимков (пересчитывается при смене программы)"""
+        if self._digest_for is not self.program:
+            self._digest = bytes.fromhex(program_hash(self.program))
+            self._digest_for = self.program
+        return self._digest
+    
+    def snapshot(self, snapshot_file, compress=False):
+        """Сохранение снимка состояния (pc, регистры, память) в файл
+        
+        Регистры и память пишутся двумя блоками байт; compress - сжатие zlib.
+        Файл заменяется атомарно, поэтому прерванная запись не портит
+        предыдущий снимок.
+        """
+        word_bits = 64 if self.word_range is None else self.word_bits
+        flags = SNAPSHOT_ZLIB if compress else 0
+        try:
+            blocks = [storage_bytes(self.regs, word_bits), storage_bytes(self.memory, word_bits)]
+        except OverflowError:
+            flags |= SNAPSHOT_JSON
+            state = {"regs": list(self.regs), "memory": list(self.memory)}
+            blocks = [json.dumps(state, separators=(',', ':')).encode('utf-8')]
+        header = SNAPSHOT_HEADER.pack(SNAPSHOT_MAGIC, SNAPSHOT_VERSION, flags, word_bits, self.pc,
+                                      len(self.regs), len(self.memory), self._program_digest())
+        tmp_file = f"{snapshot_file}.tmp{os.getpid()}"
+        try:
+            with open(tmp_file, 'wb') as f:
+                f.write(header)
+                if compress:
+                    compressor = zlib.compressobj(SNAPSHOT_ZLIB_LEVEL)
+                    for block in blocks:
+                        f.write(compressor.compress(block))
+                    f.write(compressor.flush())
+                else:
+                    for block in blocks:
+                        f.write(block)
+            os.replace(tmp_file, snapshot_file)
+            tmp_file = None
+            self.tracer.info(f"Снимок состояния сохранен в {snapshot_file} (pc={self.pc})")
+            return True
+        except OSError as e:
+            self.tracer.error(f"Ошибка при сохранении снимка: {e}")
+            return False
+        finally:
+            if tmp_file is not None and os.path.exists(tmp_file):
+                os.remove(tmp_file)
+    
+    def restore(self, snapshot_file):
+        """Восстановление состояния из снимка, сделанного для той же программы
+        
+        Число регистров и размер памяти должны совпадать с этой ВМ; ширина
+        слова может отличаться, если значения помещаются в слово ВМ. Снимок
+        разбирается и проверяется целиком до записи: при ошибке состояние ВМ
+        не меняется.
+        """
+        try:
+            with open(snapshot_file, 'rb') as f:
+                data = f.read()
+            magic, version, flags, word_bits, pc, num_regs, mem_size, digest = \
+                SNAPSHOT_HEADER.unpack_from(data, 0)
+            if magic != SNAPSHOT_MAGIC:
+                raise ValueError("неверная сигнатура снимка")
+            if version != SNAPSHOT_VERSION:
+                raise ValueError(f"неподдерживаемая версия снимка: {version}")
+            if (num_regs, mem_size) != (len(self.regs), len(self.memory)):
+                raise ValueError(f"снимок для {num_regs} регистров и {mem_size} ячеек памяти, "
+                                 f"а у ВМ {len(self.regs)} и {len(self.memory)}")
+            if digest != self._program_digest():
+                raise ValueError("снимок сделан для другой программы")
+            payload = memoryview(data)[SNAPSHOT_HEADER.size:]
+            if flags & SNAPSHOT_ZLIB:
+                payload = zlib.decompress(payload)
+            if flags & SNAPSHOT_JSON:
+                state = json.loads(bytes(payload).decode('utf-8'))
+                blocks = [state["regs"], state["memory"]]
+                if [len(values) for values in blocks] != [num_regs, mem_size]:
+                    raise ValueError("размер данных снимка не совпадает с заголовком")
+                if not all(type(value) is int for values in blocks for value in values):
+                    raise ValueError("в снимке не целые значения")
+            else:
+                regs_size = num_regs * word_bits // 8
+                if len(payload) != regs_size + mem_size * word_bits // 8:
+                    raise ValueError("размер данных снимка не совпадает с заголовком")
+                blocks = [storage_words(payload[:regs_size], word_bits),
+                          storage_words(payload[regs_size:], word_bits)]
+            if self.word_range is not None and (flags & SNAPSHOT_JSON or word_bits > self.word_bits):
+                low, high = self.word_range
+                for values in blocks:
+                    if len(values) and (min(values) < low or max(values) > high):
+                        raise OverflowError(f"значения снимка не помещаются в {self.word_bits}-битное слово ВМ")
+            fill_storage(self.regs, blocks[0])
+            fill_storage(self.memory, blocks[1])
+            self.pc = pc
+            self.tracer.info(f"Состояние восстановлено из {snapshot_file} (pc={pc})")
+            return True
+        except (OSError, ValueError, OverflowError, TypeError, struct.error, zlib.error) as e:
+            self.tracer.error(f"Ошибка восстановления снимка: {e}")
+            return False
+    
+    def apply_image(self, image_file):
+        """Начальное состояние из образа partial_evaluate для остаточной программы
+        
+        Образ задает регистры и вычисленные заранее ячейки памяти; остальные
+        ячейки не меняются (при memory_input это входные данные). Число
+        регистров, размер памяти, слово и политика переполнения должны
+        совпадать с теми, для которых образ вычислен.
+        """
+        try:
+            with open(image_file, 'r', encoding='utf-8') as f:
+                image = json.load(f)
+            if image.get("format") != IMAGE_FORMAT:
+                raise ValueError("неверный формат образа")
+            if image.get("version") != IMAGE_VERSION:
+                raise ValueError(f"неподдерживаемая версия образа: {image.get('version')}")
+            if (image["num_regs"], image["mem_size"]) != (len(self.regs), len(self.memory)):
+                raise ValueError(f"образ для {image['num_regs']} регистров и {image['mem_size']} "
+                                 f"ячеек памяти, а у ВМ {len(self.regs)} и {len(self.memory)}")
+            if (image["word_bits"], image["overflow"]) != self._word_config():
+                raise ValueError("образ вычислен для другого слова памяти или политики переполнения")
+            if image["program"] != self._program_digest().hex():
+                raise ValueError("образ вычислен для другой программы")
+            if not image["memory_input"] and self._mapping is not None:
+                raise ValueError("образ вычислен для нулевой памяти, а память ВМ - файл")
+            for reg, value in image["regs"]:
+                self.regs[reg] = value
+            for addr, value in image["memory"]:
+                self.memory[addr] = value
+            self.pc = 0
+            self.tracer.info(f"Начальное состояние из образа {image_file} "
+                             f"({image['folded']} команд вычислено заранее)")
+            return True
+        except (OSError, ValueError, KeyError, TypeError, IndexError, OverflowError) as e:
+            self.tracer.error(f"Ошибка загрузки образа: {e}")
+            return False
+    
+    def _word_config(self):
+        """(разрядность слова, политика переполнения) или (None, None) для слов без ограничения"""
+        if self.word_range is None:
+            return None, None
+        return self.word_bits, self.overflow
+    
+    def iter_memory_chunks(self, start_addr, end_addr, chunk=DUMP_CHUNK):
+        """Порции (первый адрес, значения) ячеек [start_addr, end_addr] в пределах памяти"""
+        memory = self.memory
+        stop = min(end_addr + 1, len(memory))
+        for base in range(start_addr, stop, chunk):
+            top = min(base + chunk, stop)
+            if base >= 0:
+                yield base, memory[base:top]
+            else:
+                # Отрицательные адреса индексируют память с конца, как в исходном дампе
+                yield base, [memory[addr] for addr in range(base, top)]
+    
+    def dump_memory_xml(self, start_addr, end_addr, dump_file, mode="dense"):
+        """Сохранение дампа памяти в XML формате
+        
+        mode: "dense" - все ячейки диапазона, "sparse" - только ненулевые,
+        "rle" - серии одинаковых значений элементами <run>. Ячейки пишутся
+        порциями по DUMP_CHUNK, поэтому расход памяти не зависит от размера
+        диапазона; плотный дамп совпадает с dump_memory_xml_tree байт в байт.
+        Файл заменяется атомарно: ошибка посреди записи не оставляет
+        обрезанного дампа.
+        """
+        try:
+            if mode not in DUMP_MODES:
+                raise ValueError(f"неизвестный режим дампа: {mode} (доступны: {', '.join(DUMP_MODES)})")
+            chunks = self.iter_memory_chunks(start_addr, end_addr)
+            root = f'<memory_dump start="{start_addr}" end="{end_addr}"'
+            if mode != "dense":
+                count = max(0, min(end_addr + 1, len(self.memory)) - start_addr)
+                root += f' mode="{mode}" count="{count}"'
+            
+            with atomic_output(dump_file) as f:
+                f.write("<?xml version='1.0' encoding='utf-8'?>\n")
+                f.write(root)
+                empty = True
+                for text in _DUMP_WRITERS[mode](chunks):
+                    if not text:
+                        continue
+                    if empty:
+                        f.write(">")
+                        empty = False
+                    f.write(text)
+                f.write(" />" if empty else "</memory_dump>")
+            self.tracer.info(f"Дамп памяти сохранен в {dump_file}")
+            return True
             
-        parts = line.split()
-        cmd_name = parts[0].upper()
+        except Exception as e:
+            self.tracer.error(f"Ошибка при сохранении дампа: {e}")
+            return False
+    
+    def memory_words(self, start_addr, end_addr):
+        """Ячейки [start_addr, end_addr] в пределах памяти одним срезом
         
+        Возвращает (разрядность слова, байты little-endian). Для хранилища
+        list слово 64-битное.
+        """
+        if start_addr < 0:
+            raise ValueError("начальный адрес бинарного дампа должен быть неотрицательным")
+        memory = self.memory
+        stop = max(start_addr, min(end_addr + 1, len(memory)))
+        word_bits = 64 if self.word_range is None else self.word_bits
+        return word_bits, storage_bytes(memory[start_addr:stop], word_bits)
+    
+    def dump_memory_bin(self, start_addr, end_addr, dump_file):
+        """Сохранение дампа памяти в бинарном формате (заголовок DUMP_HEADER + слова)"""
         try:
-            if cmd_name == "LOAD":
-                # LOAD константа регистр_назначения
-                const = int(parts[1])
-                reg_dst = int(parts[2])
-                if not (0 <= reg_dst < 256):
-                    raise ValueError("Номер регистра должен быть от 0 до 255")
-                program.append([CMD_LOAD, const, reg_dst])
-                
-            elif cmd_name == "READ":
-                # READ регистр_источник регистр_назначения
-                reg_src = int(parts[1])
-                reg_dst = int(parts[2])
-                if not (0 <= reg_src < 256 and 0 <= reg_dst < 256):
-                    raise ValueError("Номер регистра должен быть от 0 до 255")
-                program.append([CMD_READ, reg_src, reg_dst])
-                
-            elif cmd_name == "WRITE":
-                # WRITE регистр_источник смещение регистр_адреса
-                reg_src = int(parts[1])
-                offset = int(parts[2])
-                reg_addr = int(parts[3])
-                if not (0 <= reg_src < 256 and 0 <= reg_addr < 256):
-                    raise ValueError("Номер регистра должен быть от 0 до 255")
-                program.append([CMD_WRITE, reg_src, offset, reg_addr])
-                
-            elif cmd_name == "SQRT":  # ЭТАП 3
-                # SQRT адрес_источник адрес_назначения
-                addr_src = int(parts[1])
-                addr_dst = int(parts[2])
-                program.append([CMD_SQRT, addr_src, addr_dst])
-                
-            else:
-                print(f"Ошибка в строке {line_num}: неизвестная команда '{cmd_name}'")
-                return False
-                
-        except (IndexError, ValueError) as e:
-            print(f"Ошибка в строке {line_num}: {e}")
+            word_bits, data = self.memory_words(start_addr, end_addr)
+            count = len(data) // (word_bits // 8)
+            with atomic_output(dump_file, 'wb') as f:
+                f.write(DUMP_HEADER.pack(DUMP_MAGIC, DUMP_VERSION, word_bits, start_addr, count))
+                f.write(data)
+            self.tracer.info(f"Дамп памяти сохранен в {dump_file}")
+            return True
+        except Exception as e:
+            self.tracer.error(f"Ошибка при сохранении дампа: {e}")
             return False
     
-    # Режим тестирования
-    if test_mode:
-        print("Промежуточное представление программы:")
-        print("=" * 50)
-        for i, cmd in enumerate(program):
-            opcode = cmd[0]
-            args = cmd[1:]
-            if opcode == CMD_LOAD:
-                print(f"{i:3d}: LOAD {args[0]} -> reg[{args[1]}]")
-            elif opcode == CMD_READ:
-                print(f"{i:3d}: READ reg[{args[0]}] -> reg[{args[1]}]")
-            elif opcode == CMD_WRITE:
-                print(f"{i:3d}: WRITE reg[{args[0]}] -> memory[reg[{args[2]}]+{args[1]}]")
-            elif opcode == CMD_SQRT:
-                print(f"{i:3d}: SQRT memory[{args[0]}] -> memory[{args[1]}]")
-        print("=" * 50)
+    def dump_memory_npy(self, start_addr, end_addr, dump_file):
+        """Сохранение дампа памяти в формате .npy (читается numpy.load без копирования строк)"""
+        try:
+            word_bits, data = self.memory_words(start_addr, end_addr)
+            with atomic_output(dump_file, 'wb') as f:
+                f.write(npy_header(word_bits, len(data) // (word_bits // 8)))
+                f.write(data)
+            self.tracer.info(f"Дамп памяти сохранен в {dump_file}")
+            return True
+        except Exception as e:
+            self.tracer.error(f"Ошибка при сохранении дампа: {e}")
+            return False
     
-    try:
-        with open(output_file, 'w', encoding='utf-8') as f:
-            json.dump(program, f, indent=2)
-        print(f"Программа успешно ассемблирована в {output_file}")
-        return True
-    except Exception as e:
-        print(f"Ошибка при сохранении: {e}")
+    def dump_memory(self, start_addr, end_addr, dump_file, fmt="xml", mode="dense"):
+        """Сохранение дампа в выбранном формате: xml (с режимом mode), bin или npy"""
+        if fmt == "xml":
+            return self.dump_memory_xml(start_addr, end_addr, dump_file, mode)
+        if fmt == "bin":
+            return self.dump_memory_bin(start_addr, end_addr, dump_file)
+        if fmt == "npy":
+            return self.dump_memory_npy(start_addr, end_addr, dump_file)
+        self.tracer.error(f"Неизвестный формат дампа: {fmt} (доступны: {', '.join(DUMP_FORMATS)})")
         return False
+    
+    def dump_memory_xml_tree(self, start_addr, end_addr, dump_file):
+        """Сохранение дампа памяти через полное дерево ElementTree (эталон для бенчмарка)"""
+        try:
+            root = ET.Element("memory_dump")
+            root.set("start", str(start_addr))
+            root.set("end", str(end_addr))
+            
+            for addr in range(start_addr, min(end_addr + 1, len(self.memory))):
+                cell = ET.SubElement(root, "cell")
+                cell.set("address", str(addr))
+                cell.set("value", str(self.memory[addr]))
+            
+            tree = ET.ElementTree(root)
+            tree.write(dump_file, encoding="utf-8", xml_declaration=True)
+            self.tracer.info(f"Дамп памяти сохранен в {dump_file}")
+            return True
+            
+        except Exception as e:
+            self.tracer.error(f"Ошибка при сохранении дампа: {e}")
+            return False
+    
+    def print_state(self):
+        """Вывод состояния ВМ"""
+        print("\nСостояние виртуальной машины:")
+        print(f"PC: {self.pc}")
+        print(f"Регистры (первые 10): {[int(value) for value in self.regs[:10]]}")
+        print(f"Память (интересные ячейки):")
+        interesting = [100, 150, 200, 201, 396, 400, 959]
+        for addr in interesting:
+            if addr < len(self.memory):
+                print(f"  memory[{addr:3d}] = {self.memory[addr]}")
 
-# ЭТАП 2
-class VirtualMachine:
-    """Виртуальная машина УВМ (Вариант 21)"""
+# Векторное выполнение одной программы над пакетом образов памяти
+ISQRT_INT64_MAX = math.isqrt(2**63 - 1)
+
+def isqrt_array(values):
+    """Целочисленный квадратный корень numpy-массива (отрицательные значения дают 0)
     
-    def __init__(self, mem_size=1024, num_regs=256):
-        self.memory = [0] * mem_size
-        self.regs = [0] * num_regs
-        self.pc = 0  # Program counter
+    Корень из float64 может ошибиться на единицу при значениях больше 2**52,
+    поэтому результат уточняется целочисленными сравнениями.
+    """
+    numpy = load_numpy()
+    v = numpy.maximum(values.astype(numpy.int64), 0)
+    r = numpy.minimum(numpy.sqrt(v.astype(numpy.float64)).astype(numpy.int64), ISQRT_INT64_MAX)
+    for _ in range(2):
+        r = numpy.where(r * r > v, r - 1, r)
+        # Для r = ISQRT_INT64_MAX квадрат r + 1 переполняется, но такие элементы исключены маской
+        r = numpy.where((r < ISQRT_INT64_MAX) & ((r + 1) * (r + 1) <= v), r + 1, r)
+    return r
+
+class BatchVirtualMachine:
+    """ВМ, выполняющая одну программу над пакетом образов памяти (SIMD-режим на NumPy)
+    
+    memory имеет форму (batch_size, mem_size), regs - (batch_size, num_regs).
+    Каждая команда выполняется один раз для всего пакета: READ и WRITE -
+    выборкой и записью по вектору адресов, SQRT - векторным isqrt_array.
+    Если команда ошибочна хотя бы в одном варианте, останавливается весь пакет.
+    """
+    
+    def __init__(self, batch_size, mem_size=1024, num_regs=256, word_bits=64):
+        numpy = load_numpy()
+        if numpy is None:
+            raise ValueError("для векторного режима требуется пакет numpy")
+        if word_bits not in WORD_TYPECODES:
+            raise ValueError(f"неподдерживаемая ширина слова: {word_bits}")
+        dtype = f"int{word_bits}"
+        self.memory = numpy.zeros((batch_size, mem_size), dtype=dtype)
+        self.regs = numpy.zeros((batch_size, num_regs), dtype=dtype)
+        self.word_range = (-(1 << (word_bits - 1)), (1 << (word_bits - 1)) - 1)
+        self.lanes = numpy.arange(batch_size)
+        self.pc = 0
         self.program = []
-        
+    
     def load_program(self, program_file):
-        """Загрузка программы из JSON файла"""
+        """Загрузка программы из JSON или бинарного файла"""
         try:
-            with open(program_file, 'r', encoding='utf-8') as f:
-                self.program = json.load(f)
+            self.program = read_program(program_file)
             print(f"Загружена программа из {program_file} ({len(self.program)} команд)")
             return True
         except Exception as e:
             print(f"Ошибка загрузки программы: {e}")
             return False
     
-    def execute_sqrt(self, src_addr, dst_addr):
-        """ЭТАП 3: Выполнение команды SQRT"""
-        try:
-            value = self.memory[src_addr]
-            if value < 0:
-                result = 0
-            else:
-                result = int(math.isqrt(value))
-            
-            self.memory[dst_addr] = result
-            print(f"SQRT: memory[{src_addr}]={value} -> sqrt={result} -> memory[{dst_addr}]")
-            return True
-        except IndexError:
-            print(f"Ошибка SQRT: адрес вне диапазона ({src_addr} или {dst_addr})")
-            return False
-        except Exception as e:
-            print(f"Ошибка SQRT: {e}")
-            return False
+    def load_images(self, images):
+        """Начальные образы памяти: массив (batch_size, k) записывается в ячейки 0..k-1"""
+        images = load_numpy().asarray(images)
+        if images.ndim != 2 or images.shape[0] != self.memory.shape[0]:
+            raise ValueError(f"ожидался массив образов формы ({self.memory.shape[0]}, k), "
+                             f"получен {images.shape}")
+        if images.shape[1] > self.memory.shape[1]:
+            raise ValueError("образ больше памяти ВМ")
+        if images.dtype.kind not in "iu":
+            raise ValueError(f"образы должны быть целыми, получен тип {images.dtype}")
+        low, high = self.word_range
+        if images.size and (images.min() < low or images.max() > high):
+            raise ValueError(f"значение образа вне диапазона слова [{low}, {high}]")
+        self.memory[:, :images.shape[1]] = images
+    
+    def _failed(self, mask):
+        lanes = mask.nonzero()[0]
+        shown = ", ".join(str(lane) for lane in lanes[:5])
+        return f"{shown}{', ...' if len(lanes) > 5 else ''} (всего {len(lanes)})"
     
     def run(self):
-        """Выполнение программы (включая ЭТАП 3)"""
+        """Выполнение программы для всего пакета"""
+        memory = self.memory
+        regs = self.regs
+        lanes = self.lanes
+        mem_size = memory.shape[1]
+        low, high = self.word_range
         self.pc = 0
-        commands_executed = 0
         
-        while self.pc < len(self.program):
-            cmd = self.program[self.pc]
+        for pc, cmd in enumerate(self.program):
+            self.pc = pc
             opcode = cmd[0]
             
             try:
                 if opcode == CMD_LOAD:
                     const, reg_dst = cmd[1], cmd[2]
-                    self.regs[reg_dst] = const
+                    if not low <= const <= high:
+                        print(f"Ошибка выполнения команды {pc}: значение {const} не помещается в слово")
+                        return False
+                    regs[:, reg_dst] = const
                     
                 elif opcode == CMD_READ:
                     reg_src, reg_dst = cmd[1], cmd[2]
-                    addr = self.regs[reg_src]
-                    self.regs[reg_dst] = self.memory[addr]
+                    addr = regs[:, reg_src]
+                    bad = (addr < -mem_size) | (addr >= mem_size)
+                    if bad.any():
+                        print(f"Ошибка выполнения команды {pc}: адрес вне диапазона памяти "
+                              f"в вариантах {self._failed(bad)}")
+                        return False
+                    regs[:, reg_dst] = memory[lanes, addr]
                     
                 elif opcode == CMD_WRITE:
                     reg_src, offset, reg_addr = cmd[1], cmd[2], cmd[3]
-                    addr = self.regs[reg_addr] + offset
-                    if 0 <= addr < len(self.memory):
-                        self.memory[addr] = self.regs[reg_src]
-                    else:
-                        print(f"Ошибка: адрес {addr} вне диапазона памяти")
+                    addr = regs[:, reg_addr].astype("int64") + offset
+                    bad = (addr < 0) | (addr >= mem_size)
+                    if bad.any():
+                        print(f"Ошибка: адрес {addr[bad][0]} вне диапазона памяти "
+                              f"в вариантах {self._failed(bad)}")
                         return False
-                        
-                elif opcode == CMD_SQRT:  # ЭТАП 3
+                    memory[lanes, addr] = regs[:, reg_src]
+                    
+                elif opcode == CMD_SQRT:
                     addr_src, addr_dst = cmd[1], cmd[2]
-                    if not self.execute_sqrt(addr_src, addr_dst):
+                    if not (-mem_size <= addr_src < mem_size and -mem_size <= addr_dst < mem_size):
+                        print(f"Ошибка SQRT: адрес вне диапазона ({addr_src} или {addr_dst})")
                         return False
+                    memory[:, addr_dst] = isqrt_array(memory[:, addr_src])
                     
                 else:
                     print(f"Неизвестный код операции: {opcode}")
                     return False
                     
-            except IndexError as e:
-                print(f"Ошибка выполнения команды {self.pc}: {e}")
+            except (IndexError, OverflowError) as e:
+                print(f"Ошибка выполнения команды {pc}: {e}")
                 return False
-            
-            self.pc += 1
-            commands_executed += 1
         
-        print(f"Выполнено {commands_executed} команд (включая SQRT)")
+        self.pc = len(self.program)
+        print(f"Выполнено {self.pc} команд для {len(lanes)} вариантов памяти")
         return True
+
+def run_vector(program_file, images_file, output_file, start_addr, end_addr, mem_size=1024,
+               word_bits=64):
+    """Векторный запуск: образы памяти из .npy (batch, k), дамп диапазона в .npy (batch, n)"""
+    numpy = load_numpy()
+    if numpy is None:
+        print("Ошибка: для векторного режима требуется пакет numpy")
+        return False
+    try:
+        images = numpy.load(images_file)
+        vm = BatchVirtualMachine(images.shape[0], mem_size, word_bits=word_bits)
+        vm.load_images(images)
+    except (OSError, ValueError, IndexError) as e:
+        print(f"Ошибка загрузки образов памяти: {e}")
+        return False
     
-    def dump_memory_xml(self, start_addr, end_addr, dump_file):
-        """Сохранение дампа памяти в XML формате"""
-        try:
-            root = ET.Element("memory_dump")
-            root.set("start", str(start_addr))
-            root.set("end", str(end_addr))
+    if not vm.load_program(program_file):
+        return False
+    try:
+        if not vm.run():
+            return False
+    except (IndexError, OverflowError, ValueError, TypeError) as e:
+        print(f"Ошибка выполнения команды {vm.pc}: {e}")
+        return False
+    
+    numpy.save(output_file, vm.memory[:, max(start_addr, 0):end_addr + 1])
+    print(f"Дамп памяти сохранен в {output_file}")
+    return True
+
+def test_assembler():
+    """Тестирование ассемблера"""
+    print("Тестирование ассемблера...")
+    
+    test_program = """# Тестовая программа для Варианта 21 (все этапы)
+# Этап 1-2: Базовые операции
+LOAD 25 0
+LOAD 100 1
+WRITE 0 0 1      # memory[100] = 25
+WRITE 1 50 1     # memory[150] = 100
+
+# Этап 3: Команда SQRT
+SQRT 100 200      # sqrt(25) -> memory[200]
+SQRT 150 201      # sqrt(100) -> memory[201]
+
+# Тест из спецификации Варианта 21
+LOAD 625 2
+WRITE 2 959 0    # memory[959] = 625
+SQRT 959 396     # sqrt(625) -> memory[396]
+"""
+    
+    with open('test_all.asm', 'w', encoding='utf-8') as f:
+        f.write(test_program)
+    
+    success = assemble('test_all.asm', 'test_all.json', test_mode=True)
+    return success
+
+def test_program_formats():
+    """Тестирование бинарного формата программы"""
+    print("\nТестирование бинарного формата программы...")
+    
+    if not assemble('test_all.asm', 'test_all.uvm', fmt="bin"):
+        return False
+    
+    # Без --format бинарный формат выбирается только явным расширением
+    expected = {"p.json": "json", "p.txt": "json", "p": "json", "P.UVM": "bin", "p.uvmb": "bin", "p.bin": "bin"}
+    wrong = {name: program_format(name) for name, fmt in expected.items() if program_format(name) != fmt}
+    if wrong:
+        print(f"✗ Неверный формат по расширению: {wrong}")
+        return False
+    
+    json_program = read_program('test_all.json')
+    bin_program = read_program('test_all.uvm')
+    if [list(cmd) for cmd in bin_program] == json_program:
+        print(f"✓ Бинарный формат совпадает с JSON ({len(bin_program)} команд)")
+        return True
+    print("✗ Бинарная программа отличается от JSON")
+    return False
+
+def test_word_addresses():
+    """Адрес WRITE вычисляется без переполнения слова во всех движках и хранилищах"""
+    print("\nТестирование адресов WRITE для слов фиксированной разрядности...")
+    # -32768 + -32768 = -65536: в 16-битном слове numpy сумма переполнилась бы в 0.
+    # Адресный регистр задан константой LOAD, прочитан READ из памяти или
+    # записан в предыдущем блоке движка compile
+    programs = {
+        "LOAD": [[CMD_LOAD, -32768, 1], [CMD_LOAD, 7, 0], [CMD_WRITE, 0, -32768, 1]],
+        "READ": [[CMD_LOAD, -32768, 2], [CMD_LOAD, 5, 3], [CMD_WRITE, 2, 0, 3], [CMD_READ, 3, 1],
+                 [CMD_LOAD, 7, 0], [CMD_WRITE, 0, -32768, 1]],
+        "блок": ([[CMD_LOAD, -32768, 1]] + [[CMD_LOAD, 1, 2]] * COMPILE_CHUNK
+                 + [[CMD_LOAD, 7, 0], [CMD_WRITE, 0, -32768, 1]]),
+    }
+    storages = ("array", "numpy") if load_numpy() is not None else ("array",)
+    all_passed = True
+    for source, program in programs.items():
+        for storage in storages:
+            for engine in VM_ENGINES:
+                vm = VirtualMachine(storage=storage, word_bits=16, trace="off")
+                vm.program = program
+                ok = vm.run(engine)
+                if ok or vm.memory[0] != 0 or vm.pc != len(program) - 1:
+                    print(f"✗ {storage}/{engine}, регистр из {source}: "
+                          f"запись по адресу -65536 не остановила ВМ")
+                    all_passed = False
+    if all_passed:
+        print(f"✓ Адрес вне памяти обнаружен ({', '.join(storages)} x {', '.join(VM_ENGINES)})")
+    return all_passed
+
+def random_program(rng, length, error_rate=0.0, mem_size=1024, num_regs=8):
+    """Случайная программа для сверочных тестов
+    
+    Адреса рассчитаны на память mem_size ячеек, регистры - 0..num_regs-1;
+    с долей error_rate - константы и адреса SQRT вне памяти.
+    """
+    span = mem_size * 5 // 8 + 1
+    program = []
+    for _ in range(length):
+        kind = rng.randrange(4)
+        wild = rng.random() < error_rate
+        if kind == 0:
+            const = rng.randrange(-40, mem_size + 80) if wild else rng.randrange(span)
+            program.append([CMD_LOAD, const, rng.randrange(num_regs)])
+        elif kind == 1:
+            program.append([CMD_READ, rng.randrange(num_regs), rng.randrange(num_regs)])
+        elif kind == 2:
+            program.append([CMD_WRITE, rng.randrange(num_regs), rng.randrange(-5, span), rng.randrange(num_regs)])
+        else:
+            program.append([CMD_SQRT, rng.randrange(-3, mem_size + 6) if wild else rng.randrange(mem_size),
+                            rng.randrange(mem_size)])
+    return program
+
+def _final_state(program, engine="fast", memory=(), image=None, parallel=False, **vm_options):
+    """(успех, регистры, память) после выполнения программы на новой ВМ
+    
+    memory - пары (адрес, значение) начальной памяти, image - образ
+    partial_evaluate (через временный файл), parallel - run_parallel.
+    """
+    vm = VirtualMachine(trace="off", **vm_options)
+    try:
+        vm.program = program
+        for addr, value in memory:
+            vm.memory[addr] = value
+        if image is not None:
+            with tempfile.TemporaryDirectory() as tmp:
+                image_file = os.path.join(tmp, "image.json")
+                with open(image_file, 'w', encoding='utf-8') as f:
+                    json.dump(image, f)
+                if not vm.apply_image(image_file):
+                    return None
+        ok = vm.run_parallel(4, engine) if parallel else vm.run(engine)
+        return ok, list(vm.regs), list(vm.memory)
+    finally:
+        vm.close()
+
+def test_fast_engine():
+    """Движок fast дает тот же итог, что interp, в том числе с кэшем обработчиков ВМ"""
+    print("\nТестирование движка fast...")
+    rng = random.Random(2)
+    storages = [{}, {"storage": "array", "word_bits": 16}, {"storage": "paged"}]
+    if load_numpy() is not None:
+        storages.append({"storage": "numpy", "word_bits": 32})
+    all_passed = True
+    for options in storages:
+        # Одна ВМ на все программы: повторный запуск, смена программы и reset()
+        # (новая память paged) должны сбрасывать кэш обработчиков
+        vm = VirtualMachine(trace="off", **options)
+        for i in range(12):
+            program = random_program(rng, rng.randrange(1, 2 * DECODE_CHUNK + 10), rng.choice([0.0, 0.01]))
+            reference = VirtualMachine(trace="off", **options)
+            reference.program = program
+            expected = (reference.run("interp"), reference.pc, list(reference.regs), list(reference.memory))
+            reference.close()
+            vm.program = program
+            for attempt in range(2):
+                vm.reset()
+                ok = vm.run("fast")
+                if (ok, vm.pc, list(vm.regs), list(vm.memory)) != expected:
+                    print(f"✗ {options}: программа {i}, запуск {attempt + 1} расходится с interp")
+                    all_passed = False
+        vm.close()
+    if all_passed:
+        print(f"✓ fast совпадает с interp ({len(storages)} хранилищ, повторные запуски из кэша)")
+    return all_passed
+
+def test_compile_engine():
+    """Движок compile совпадает с interp, включая вывод SQRT и код из дискового кэша"""
+    print("\nТестирование движка compile...")
+    rng = random.Random(3)
+    storages = [{}, {"storage": "array", "word_bits": 16}]
+    if load_numpy() is not None:
+        storages.append({"storage": "numpy", "word_bits": 16})
+    all_passed = True
+    
+    def outcome(program, engine, options, trace="off"):
+        vm = VirtualMachine(trace=trace, **options)
+        vm.program = program
+        with contextlib.redirect_stdout(io.StringIO()) as output:
+            ok = vm.run(engine)
+        vm.close()
+        return ok, vm.pc, list(vm.regs), list(vm.memory), output.getvalue()
+    
+    for i in range(20):
+        # Каждая пятая программа длиннее блока COMPILE_CHUNK
+        length = rng.randrange(COMPILE_CHUNK, 2 * COMPILE_CHUNK) if i % 5 == 0 else rng.randrange(1, 200)
+        program = random_program(rng, length, rng.choice([0.0, 0.01, 0.1]))
+        options = rng.choice(storages)
+        trace = "sqrt" if i % 2 else "off"
+        if outcome(program, "compile", options, trace) != outcome(program, "interp", options, trace):
+            print(f"✗ Программа {i} ({options}, трассировка {trace}): compile расходится с interp")
+            all_passed = False
+    
+    # Дисковый кэш: второй "процесс" загружает код, поврежденная запись компилируется заново
+    program = random_program(rng, COMPILE_CHUNK + 100)
+    expected = outcome(program, "interp", {})
+    with tempfile.TemporaryDirectory() as tmp:
+        cache = AssemblyCache(tmp)
+        for attempt in ("запись", "загрузка", "повреждение"):
+            if attempt == "повреждение":
+                for name in os.listdir(tmp):
+                    with open(os.path.join(tmp, name), 'wb') as f:
+                        f.write(b"not marshal")
+            _compiled_cache.clear()
+            hits = cache.hits
+            result = outcome(program, "compile", {"code_cache": cache})
+            if result[:4] != expected[:4]:
+                print(f"✗ Кэш кода ({attempt}): итог расходится с interp")
+                all_passed = False
+            if attempt == "загрузка" and cache.hits == hits:
+                print("✗ Кэш кода: скомпилированный код не загружен с диска")
+                all_passed = False
+            if attempt == "повреждение" and "Предупреждение" not in result[4]:
+                print("✗ Кэш кода: поврежденная запись не обнаружена")
+                all_passed = False
+    _compiled_cache.clear()
+    if all_passed:
+        print("✓ compile совпадает с interp, код загружается из дискового кэша")
+    return all_passed
+
+def test_run_steps():
+    """Выполнение квантами run_steps совпадает с run() во всех движках и хранилищах"""
+    print("\nТестирование выполнения квантами (run_steps)...")
+    rng = random.Random(25)
+    storages = [{}, {"storage": "array", "word_bits": 16}, {"storage": "paged"}]
+    if load_numpy() is not None:
+        storages.append({"storage": "numpy", "word_bits": 32})
+    all_passed = True
+    checked = 0
+    for _ in range(60):
+        program = random_program(rng, rng.randrange(1, 120), rng.choice([0.0, 0.05, 0.3]))
+        options = rng.choice(storages)
+        reference = VirtualMachine(trace="off", **options)
+        reference.program = program
+        ok = reference.run("fast")
+        for engine in VM_ENGINES:
+            budget = rng.randrange(1, 40)
+            vm = VirtualMachine(trace="off", **options)
+            vm.program = program
+            while vm.run_steps(budget, engine) and vm.pc < len(program):
+                pass
+            stepped_ok = vm.pc >= len(program)
+            checked += 1
+            if (stepped_ok != ok or (not ok and vm.pc != reference.pc)
+                    or list(vm.regs) != list(reference.regs) or list(vm.memory) != list(reference.memory)):
+                print(f"✗ {engine}, квант {budget}, {options}: состояние расходится с run()")
+                all_passed = False
+    if all_passed:
+        print(f"✓ Совпадение с run() в {checked} прогонах")
+    return all_passed
+
+def test_batch_vm():
+    """Пакетная ВМ совпадает со скалярной в каждом варианте и не переполняет адреса"""
+    print("\nТестирование пакетной ВМ...")
+    numpy = load_numpy()
+    if numpy is None:
+        print("✓ Пропущено: нет пакета numpy")
+        return True
+    rng = random.Random(10)
+    all_passed = True
+    for _ in range(40):
+        program = random_program(rng, rng.randrange(1, 80), rng.choice([0.0, 0.05]))
+        images = numpy.array([[rng.randrange(-50, 1200) for _ in range(16)] for _ in range(4)], dtype="int16")
+        batch = BatchVirtualMachine(len(images), word_bits=16)
+        batch.program = program
+        batch.load_images(images)
+        with contextlib.redirect_stdout(io.StringIO()):
+            batch_ok = batch.run()
+        lanes_ok = True
+        for lane, image in enumerate(images):
+            vm = VirtualMachine(storage="numpy", word_bits=16, trace="off")
+            vm.program = program
+            vm.memory[:len(image)] = image
+            lane_ok = vm.run("fast")
+            lanes_ok = lanes_ok and lane_ok
+            if batch_ok and (not lane_ok or list(vm.memory) != list(batch.memory[lane])):
+                print(f"✗ Вариант {lane}: память расходится со скалярной ВМ")
+                all_passed = False
+        if batch_ok != lanes_ok:
+            print(f"✗ Пакет {'выполнен' if batch_ok else 'остановлен'} вопреки скалярной ВМ")
+            all_passed = False
+    
+    # Адрес WRITE и номер регистра вне диапазона останавливают пакет, а не бросают исключение
+    for program in ([[CMD_LOAD, 1, 0], [CMD_LOAD, 7, 1], [CMD_WRITE, 0, 100000, 1]],
+                    [[CMD_LOAD, -32768, 1], [CMD_WRITE, 0, -32768, 1]],
+                    [[CMD_LOAD, 7, 300]]):
+        batch = BatchVirtualMachine(2, word_bits=16)
+        batch.program = program
+        with contextlib.redirect_stdout(io.StringIO()):
+            if batch.run() or batch.memory.any():
+                print(f"✗ Ошибочная программа {program} выполнена")
+                all_passed = False
+    try:
+        BatchVirtualMachine(1, word_bits=16).load_images([[70000]])
+        print("✗ Образ со значением вне слова загружен")
+        all_passed = False
+    except ValueError:
+        pass
+    if all_passed:
+        print("✓ Пакетная ВМ совпадает со скалярной, ошибки адресов обнаружены")
+    return all_passed
+
+def test_streaming_assembler():
+    """Потоковый ассемблер пишет то же, что json.dump, с памятью, не зависящей от размера программы"""
+    print("\nТестирование потокового ассемблера...")
+    rng = random.Random(11)
+    all_passed = True
+    with tempfile.TemporaryDirectory() as tmp:
+        source_file = os.path.join(tmp, "program.asm")
+        json_file = os.path.join(tmp, "program.json")
+        bin_file = os.path.join(tmp, "program.uvm")
+        for length in (0, 1, 2, 500):
+            program = [list(cmd) for cmd in random_program(rng, length)]
+            with open(source_file, 'w', encoding='utf-8') as f:
+                f.write("# комментарий\n" + "".join(source_line(cmd) + "\n" for cmd in program))
+            with contextlib.redirect_stdout(io.StringIO()):
+                ok = assemble(source_file, json_file) and assemble(source_file, bin_file)
+            with open(json_file, encoding='utf-8') as f:
+                text = f.read()
+            if not ok or text != json.dumps(program, indent=2):
+                print(f"✗ {length} команд: JSON отличается от json.dump(program, indent=2)")
+                all_passed = False
+            elif [list(cmd) for cmd in read_program(bin_file)] != program:
+                print(f"✗ {length} команд: бинарная программа отличается от исходной")
+                all_passed = False
+        
+        # Ошибка в середине: номер строки в сообщении, прежний выход цел, временных файлов нет
+        lines = [source_line(cmd) for cmd in random_program(rng, 300)]
+        lines[149] = "WRITE 1 2"
+        with open(source_file, 'w', encoding='utf-8') as f:
+            f.write("\n".join(lines) + "\n")
+        for output_file in (json_file, bin_file):
+            with open(output_file, 'rb') as f:
+                previous = f.read()
+            with contextlib.redirect_stdout(io.StringIO()) as output:
+                ok = assemble(source_file, output_file)
+            with open(output_file, 'rb') as f:
+                unchanged = f.read() == previous
+            leftovers = [item for item in os.listdir(tmp) if ".tmp" in item]
+            if ok or not output.getvalue().startswith("Ошибка в строке 150:") or not unchanged or leftovers:
+                print(f"✗ Ошибка в строке 150 ({os.path.basename(output_file)}): {output.getvalue().strip()!r}, "
+                      f"выход {'цел' if unchanged else 'изменен'}, временные файлы {leftovers}")
+                all_passed = False
+        
+        # Пик памяти при ассемблировании в 8 раз большего файла почти не растет
+        peaks = []
+        for length in (20000, 160000):
+            with open(source_file, 'w', encoding='utf-8') as f:
+                for cmd in make_synthetic_program(length):
+                    f.write(source_line(cmd) + "\n")
+            tracemalloc.start()
+            with contextlib.redirect_stdout(io.StringIO()):
+                ok = assemble(source_file, json_file)
+            peaks.append(tracemalloc.get_traced_memory()[1])
+            tracemalloc.stop()
+            if not ok:
+                print(f"✗ Программа из {length} команд не ассемблирована")
+                all_passed = False
+        if peaks[1] > 2 * peaks[0]:
+            print(f"✗ Пик памяти растет с размером программы: {peaks[0]} -> {peaks[1]} байт")
+            all_passed = False
+    if all_passed:
+        print(f"✓ Потоковый ассемблер совпадает с json.dump, пик памяти {peaks[0] // 1024} -> "
+              f"{peaks[1] // 1024} КБ при 8-кратном росте программы")
+    return all_passed
+
+def test_parallel_assembler():
+    """Многопроцессный ассемблер совпадает с однопроцессным, включая номера строк ошибок"""
+    print("\nТестирование многопроцессного ассемблера...")
+    rng = random.Random(12)
+    lines = []
+    for cmd in random_program(rng, 3000):
+        lines.append(source_line(cmd) + rng.choice(["", "", "    # комментарий"]))
+        if rng.random() < 0.1:
+            lines.append(rng.choice(["", "# строка комментария", "   "]))
+    # (номер строки с ошибкой или None, перевод строки); после первой ошибки есть вторая
+    cases = [(None, "\n"), (None, "\r\n"), (1, "\n"), (len(lines) // 2, "\r\n"), (len(lines) - 1, "\n")]
+    all_passed = True
+    with tempfile.TemporaryDirectory() as tmp:
+        source_file = os.path.join(tmp, "program.asm")
+        for error_line, newline in cases:
+            text = list(lines)
+            if error_line is not None:
+                text[error_line - 1] = "LOAD 5"
+                text[-1] = "FOO 1 2"
+            with open(source_file, 'w', encoding='utf-8', newline='') as f:
+                f.write(newline.join(text) + newline)
+            for fmt in ("json", "bin"):
+                serial_file = os.path.join(tmp, f"serial.{fmt}")
+                parallel_file = os.path.join(tmp, f"parallel.{fmt}")
+                with contextlib.redirect_stdout(io.StringIO()) as serial_output:
+                    serial_ok = assemble(source_file, serial_file, fmt=fmt)
+                with contextlib.redirect_stdout(io.StringIO()) as parallel_output:
+                    parallel_ok = assemble_parallel(source_file, parallel_file, fmt, 3)
+                name = f"{fmt}, {'ошибка в строке ' + str(error_line) if error_line else 'без ошибок'}"
+                errors = [[line for line in output.getvalue().splitlines() if line.startswith("Ошибка")]
+                          for output in (serial_output, parallel_output)]
+                if serial_ok != (error_line is None) or parallel_ok != serial_ok:
+                    print(f"✗ {name}: однопроцессный {serial_ok}, многопроцессный {parallel_ok}")
+                    all_passed = False
+                elif serial_ok and not filecmp.cmp(serial_file, parallel_file, shallow=False):
+                    print(f"✗ {name}: файлы программы различаются")
+                    all_passed = False
+                elif not serial_ok and (errors[0] != errors[1]
+                                        or not errors[0][0].startswith(f"Ошибка в строке {error_line}:")):
+                    print(f"✗ {name}: сообщения об ошибке {errors}")
+                    all_passed = False
+    if all_passed:
+        print(f"✓ Многопроцессный ассемблер совпадает с однопроцессным ({len(cases)} файлов, json и bin)")
+    return all_passed
+
+def test_assembly_cache():
+    """Кэш ассемблера: включается явно; промах, попадание, изменение исходного текста и поврежденная запись"""
+    print("\nТестирование кэша ассемблера...")
+    all_passed = True
+    for options, expected in (({}, None), ({"cache": ""}, ASM_CACHE_DIR), ({"cache": "каталог"}, "каталог"),
+                              ({"cache": "", "no-cache": ""}, None)):
+        cache = cache_from_cli(options)
+        if (cache and cache.cache_dir) != expected:
+            print(f"✗ Опции {options}: кэш {cache and cache.cache_dir}, ожидался {expected}")
+            all_passed = False
+    
+    with tempfile.TemporaryDirectory() as tmp:
+        source_file = os.path.join(tmp, "program.asm")
+        cache = AssemblyCache(os.path.join(tmp, "cache"))
+        sources = {"A": "LOAD 5 0\nLOAD 700 1\nWRITE 0 0 1\n", "B": "LOAD 6 0\nSQRT 700 3\n"}
+        # (шаг, исходный текст, формат, ожидаемые попадания и промахи после шага)
+        steps = [("промах", "A", "json", (0, 1)), ("попадание", "A", "json", (1, 1)),
+                 ("другой формат", "A", "bin", (1, 2)), ("изменение исходного текста", "B", "json", (1, 3)),
+                 ("поврежденная запись", "B", "json", (1, 4)), ("запись после повреждения", "B", "json", (2, 4))]
+        for step, source, fmt, counts in steps:
+            with open(source_file, 'w', encoding='utf-8') as f:
+                f.write(sources[source])
+            if step == "поврежденная запись":
+                entry = cache.entry_path(cache.key(source_file, fmt), fmt)
+                with open(entry, 'r+b') as f:
+                    f.seek(-1, os.SEEK_END)
+                    last = f.read(1)
+                    f.seek(-1, os.SEEK_END)
+                    f.write(bytes([last[0] ^ 1]))
+            output_file = os.path.join(tmp, f"program.{fmt}")
+            reference_file = os.path.join(tmp, f"reference.{fmt}")
+            with contextlib.redirect_stdout(io.StringIO()) as output:
+                ok = assemble(source_file, output_file, fmt=fmt, cache=cache)
+                assemble(source_file, reference_file, fmt=fmt)
+            if not ok or not filecmp.cmp(output_file, reference_file, shallow=False):
+                print(f"✗ {step}: результат не совпадает с ассемблированием без кэша")
+                all_passed = False
+            elif (cache.hits, cache.misses) != counts:
+                print(f"✗ {step}: попаданий и промахов {(cache.hits, cache.misses)}, ожидалось {counts}")
+                all_passed = False
+            elif step == "поврежденная запись" and "повреждена" not in output.getvalue():
+                print("✗ Поврежденная запись кэша не обнаружена")
+                all_passed = False
+    if all_passed:
+        print("✓ Кэш ассемблера включается явно, попадания, промахи и повреждения верны")
+    return all_passed
+
+def test_memory_dumps():
+    """Дампы всех форматов и режимов читаются обратно в те же значения, ошибка не портит файл"""
+    print("\nТестирование дампов памяти (xml dense/sparse/rle, bin, npy)...")
+    rng = random.Random(7)
+    numpy = load_numpy()
+    mem_size = DUMP_CHUNK + 100
+    ranges = [(0, mem_size - 1), (DUMP_CHUNK - 5, mem_size + 50), (10, 20), (30, 29)]
+    storages = [{}, {"storage": "array", "word_bits": 16}]
+    if numpy is not None:
+        storages.append({"storage": "numpy", "word_bits": 32})
+    all_passed = True
+    checked = 0
+    with tempfile.TemporaryDirectory() as tmp:
+        dump_file = os.path.join(tmp, "dump")
+        for options in storages:
+            name = options.get("storage", "list")
+            vm = VirtualMachine(mem_size=mem_size, trace="off", **options)
+            # Серии нулей и одинаковых значений вперемешку с отрицательными
+            addr = 0
+            while addr < mem_size:
+                run = rng.randrange(1, 40)
+                value = rng.choice([0, 0, rng.randrange(-30000, 30000)])
+                for i in range(addr, min(addr + run, mem_size)):
+                    vm.memory[i] = value if rng.random() < 0.9 else rng.randrange(-5, 5)
+                addr += run
+            for start, end in ranges:
+                expected = [int(value) for value in vm.memory[start:end + 1]]
+                results = {}
+                for mode in DUMP_MODES:
+                    if vm.dump_memory(start, end, dump_file, "xml", mode):
+                        results[f"xml {mode}"] = read_memory_dump(dump_file)
+                if vm.dump_memory(start, end, dump_file, "bin"):
+                    results["bin"] = read_memory_bin(dump_file)
+                if numpy is not None and vm.dump_memory(start, end, dump_file + ".npy", "npy"):
+                    results["npy"] = (start, numpy.load(dump_file + ".npy"))
+                if len(results) != len(DUMP_MODES) + 1 + (numpy is not None):
+                    print(f"✗ {name} [{start}, {end}]: дамп не сохранен ({', '.join(results)})")
+                    all_passed = False
+                for fmt, (dump_start, values) in results.items():
+                    if dump_start != start or [int(value) for value in values] != expected:
+                        print(f"✗ {name} [{start}, {end}]: {fmt} читается не в те же значения")
+                        all_passed = False
+                    checked += 1
             
-            for addr in range(start_addr, min(end_addr + 1, len(self.memory))):
-                cell = ET.SubElement(root, "cell")
-                cell.set("address", str(addr))
-                cell.set("value", str(self.memory[addr]))
+            # Плотный дамп совпадает с эталонным ElementTree байт в байт
+            vm.dump_memory_xml_tree(0, 200, dump_file + ".tree")
+            vm.dump_memory(0, 200, dump_file)
+            if not filecmp.cmp(dump_file, dump_file + ".tree", shallow=False):
+                print(f"✗ {name}: плотный дамп отличается от dump_memory_xml_tree")
+                all_passed = False
             
-            tree = ET.ElementTree(root)
-            tree.write(dump_file, encoding="utf-8", xml_declaration=True)
-            print(f"Дамп памяти сохранен в {dump_file}")
-            return True
+            # Ошибка посреди записи: прежний дамп цел, временных файлов не осталось
+            def failing_chunks(start_addr, end_addr, chunk=DUMP_CHUNK):
+                yield start_addr, list(vm.memory[start_addr:start_addr + 10])
+                raise OSError("нет места на устройстве")
             
-        except Exception as e:
-            print(f"Ошибка при сохранении дампа: {e}")
-            return False
+            vm.iter_memory_chunks = failing_chunks
+            with open(dump_file, 'rb') as f:
+                previous = f.read()
+            with contextlib.redirect_stdout(io.StringIO()):
+                failed = not vm.dump_memory(0, mem_size - 1, dump_file)
+            with open(dump_file, 'rb') as f:
+                unchanged = f.read() == previous
+            leftovers = [item for item in os.listdir(tmp) if ".tmp" in item]
+            if not (failed and unchanged and not leftovers):
+                print(f"✗ {name}: прерванная запись дампа испортила файл или оставила {leftovers}")
+                all_passed = False
+            vm.close()
+    
+    # Обрезанный бинарный дамп не читается молча
+    with tempfile.TemporaryDirectory() as tmp:
+        dump_file = os.path.join(tmp, "dump.bin")
+        vm = VirtualMachine(mem_size=16, trace="off")
+        vm.dump_memory(0, 15, dump_file, "bin")
+        with open(dump_file, 'r+b') as f:
+            f.truncate(DUMP_HEADER.size + 8)
+        try:
+            read_memory_bin(dump_file)
+            print("✗ Обрезанный бинарный дамп прочитан без ошибки")
+            all_passed = False
+        except ValueError:
+            pass
+    if all_passed:
+        print(f"✓ Дампы {len(storages)} хранилищ читаются обратно ({checked} сравнений), "
+              f"прерванная запись не портит файл")
+    return all_passed
+
+def test_binary_dumps():
+    """Бинарный и .npy дампы: заголовок и слова little-endian для всех ширин слова и хранилищ"""
+    print("\nТестирование бинарных дампов (bin, npy)...")
+    rng = random.Random(8)
+    numpy = load_numpy()
+    
+    def read_npy(npy_file):
+        # Заголовок-словарь .npy, смещение данных и сами данные
+        with open(npy_file, 'rb') as f:
+            data = f.read()
+        offset = 10 + struct.unpack_from("<H", data, 8)[0]
+        return data[:8], ast.literal_eval(data[10:offset].decode("latin1")), offset, data[offset:]
+    
+    word_formats = {8: "b", 16: "h", 32: "i", 64: "q"}
+    all_passed = True
+    with tempfile.TemporaryDirectory() as tmp:
+        dump_file = os.path.join(tmp, "dump")
+        configs = [{}, {"storage": "paged"}, {"storage": "mmap", "word_bits": 16, "mem_file": os.path.join(tmp, "mem")}]
+        configs += [{"storage": "array", "word_bits": bits} for bits in sorted(WORD_TYPECODES)]
+        for options in configs:
+            vm = VirtualMachine(mem_size=300, trace="off", **options)
+            bits = options.get("word_bits", 64)
+            name = f"{options.get('storage', 'list')}/{bits}"
+            for addr in range(len(vm.memory)):
+                vm.memory[addr] = rng.randrange(-(1 << (bits - 1)), 1 << (bits - 1))
+            for start, end in ((0, 299), (17, 40), (290, 400), (50, 49)):
+                values = list(vm.memory[start:end + 1])
+                expected = struct.pack(f"<{len(values)}{word_formats[bits]}", *values)
+                
+                if not vm.dump_memory(start, end, dump_file, "bin"):
+                    print(f"✗ {name} [{start}, {end}]: бинарный дамп не сохранен")
+                    all_passed = False
+                    continue
+                with open(dump_file, 'rb') as f:
+                    data = f.read()
+                header = DUMP_HEADER.unpack_from(data)
+                if header != (DUMP_MAGIC, DUMP_VERSION, bits, start, len(values)) or \
+                        data[DUMP_HEADER.size:] != expected:
+                    print(f"✗ {name} [{start}, {end}]: бинарный дамп - заголовок {header} или данные неверны")
+                    all_passed = False
+                
+                # .npy: заголовок-словарь, данные с границы 64 байт
+                vm.dump_memory(start, end, dump_file + ".npy", "npy")
+                magic, header, offset, data = read_npy(dump_file + ".npy")
+                if magic != b"\x93NUMPY\x01\x00" or offset % 64 or data != expected or \
+                        header != {"descr": f"<i{bits // 8}", "fortran_order": False, "shape": (len(values),)}:
+                    print(f"✗ {name} [{start}, {end}]: дамп .npy неверен (заголовок {header})")
+                    all_passed = False
+                elif numpy is not None:
+                    loaded = numpy.load(dump_file + ".npy")
+                    if loaded.dtype != numpy.dtype(f"int{bits}") or loaded.tolist() != values:
+                        print(f"✗ {name} [{start}, {end}]: numpy.load читает {loaded.dtype}, а не int{bits}")
+                        all_passed = False
+            vm.close()
+        
+        # Значение list больше 64 бит не пишется в бинарный дамп молча обрезанным
+        vm = VirtualMachine(mem_size=8, trace="off")
+        vm.memory[3] = 1 << 70
+        for fmt in ("bin", "npy"):
+            with contextlib.redirect_stdout(io.StringIO()):
+                saved = vm.dump_memory(0, 7, os.path.join(tmp, f"big.{fmt}"), fmt)
+            if saved or os.path.exists(os.path.join(tmp, f"big.{fmt}")):
+                print(f"✗ Значение 2**70 записано в дамп {fmt}")
+                all_passed = False
+        vm.close()
+        
+        # Формат дампа выбирается опцией --dump-format команды run
+        program_file = os.path.join(tmp, "program.json")
+        save_program([[CMD_LOAD, 36, 0], [CMD_LOAD, 0, 1], [CMD_WRITE, 0, 4, 1], [CMD_SQRT, 4, 5]], program_file)
+        for fmt in DUMP_FORMATS:
+            dump_file = os.path.join(tmp, f"run.{fmt}")
+            _main_exit("run", program_file, dump_file, "3", "6", f"--dump-format={fmt}", "--trace=off")
+            if fmt == "xml":
+                values = read_memory_dump(dump_file)[1] if os.path.exists(dump_file) else None
+            elif fmt == "bin":
+                values = read_memory_bin(dump_file)[1].tolist() if os.path.exists(dump_file) else None
+            else:
+                values = storage_words(read_npy(dump_file)[3], 64).tolist() if os.path.exists(dump_file) else None
+            if values != [0, 36, 6, 0]:
+                print(f"✗ run --dump-format={fmt}: в дампе {values}")
+                all_passed = False
+        _main_exit("run", program_file, os.path.join(tmp, "run.csv"), "0", "6", "--dump-format=csv")
+        if os.path.exists(os.path.join(tmp, "run.csv")):
+            print("✗ run --dump-format=csv: неизвестный формат записан")
+            all_passed = False
+    if all_passed:
+        print(f"✓ Бинарные и .npy дампы {len(configs)} хранилищ верны, формат выбирается в run")
+    return all_passed
+
+def test_snapshot():
+    """Снимок сохраняет состояние любого хранилища, продолжение со снимка дает тот же итог"""
+    print("\nТестирование снимков состояния (snapshot, restore)...")
+    rng = random.Random(19)
+    configs = [{}, {"storage": "array", "word_bits": 16}, {"storage": "paged"}]
+    if load_numpy() is not None:
+        configs.append({"storage": "numpy", "word_bits": 32})
+    all_passed = True
+    checked = 0
+    with tempfile.TemporaryDirectory() as tmp:
+        snapshot_file = os.path.join(tmp, "state.snap")
+        for options in configs:
+            name = options.get("storage", "list")
+            for compress in (False, True):
+                for _ in range(4):
+                    program = random_program(rng, rng.randrange(2, 300), 0.0, 64)
+                    expected = _final_state(program, mem_size=64, **options)
+                    vm = VirtualMachine(mem_size=64, trace="off", **options)
+                    vm.program = program
+                    vm.run_steps(rng.randrange(1, len(program)))
+                    state = (vm.pc, list(vm.regs), list(vm.memory))
+                    saved = vm.snapshot(snapshot_file, compress)
+                    vm.close()
+                    
+                    # Продолжение со снимка на новой ВМ
+                    resumed = VirtualMachine(mem_size=64, trace="off", **options)
+                    resumed.program = program
+                    if not (saved and resumed.restore(snapshot_file)) or \
+                            (resumed.pc, list(resumed.regs), list(resumed.memory)) != state:
+                        print(f"✗ {name}{' (сжатие)' if compress else ''}: состояние не восстановлено")
+                        all_passed = False
+                    elif (resumed.run("fast", resumed.pc), list(resumed.regs), list(resumed.memory)) != expected:
+                        print(f"✗ {name}{' (сжатие)' if compress else ''}: продолжение со снимка "
+                              f"расходится с запуском без снимка")
+                        all_passed = False
+                    resumed.close()
+                    checked += 1
+        
+        # Значения вне слова ВМ: ошибка до записи, регистры и память ВМ не меняются.
+        # Снимок list со значением больше 64 бит сохраняется в JSON
+        for big, source, targets in ((70000, {"storage": "array", "word_bits": 32},
+                                      [{"storage": "array", "word_bits": 16}]),
+                                     (1 << 70, {}, [{"storage": "array", "word_bits": 64}, {}])):
+            program = [[CMD_LOAD, big, 0], [CMD_LOAD, 1, 1], [CMD_WRITE, 0, 0, 1], [CMD_LOAD, 9, 0]]
+            vm = VirtualMachine(mem_size=64, trace="off", **source)
+            vm.program = program
+            vm.run()
+            state = (vm.pc, list(vm.regs), list(vm.memory))
+            vm.snapshot(snapshot_file, True)
+            vm.close()
+            for options in targets:
+                target = VirtualMachine(mem_size=64, trace="off", **options)
+                target.program = program
+                target.memory[5] = 3
+                before = (target.pc, list(target.regs), list(target.memory))
+                fits = target.word_range is None
+                with contextlib.redirect_stdout(io.StringIO()):
+                    ok = target.restore(snapshot_file)
+                after = (target.pc, list(target.regs), list(target.memory))
+                if ok != fits or after != (state if fits else before):
+                    print(f"✗ Снимок со значением {big} в {options or 'list'}: restore() вернул {ok}, "
+                          f"состояние ВМ неверно")
+                    all_passed = False
+                target.close()
+    if all_passed:
+        print(f"✓ Снимки {len(configs)} хранилищ восстановлены ({checked}, со сжатием и без), "
+              f"значения вне слова отклонены без записи")
+    return all_passed
+
+def _main_exit(*args):
+    """Код выхода main() с аргументами командной строки args и ее вывод"""
+    argv = sys.argv
+    sys.argv = [argv[0], *args]
+    output = io.StringIO()
+    try:
+        with contextlib.redirect_stdout(output):
+            main()
+        code = 0
+    except SystemExit as e:
+        code = e.code
+    except Exception as e:
+        code = f"{type(e).__name__}: {e}"
+    finally:
+        sys.argv = argv
+    return code, output.getvalue()
+
+def test_run_batch():
+    """Пакет с ошибочным заданием: остальные задания выполняются, а код выхода - ненулевой"""
+    print("\nТестирование пакетного запуска (run-batch, assemble-dir)...")
+    good = [[CMD_LOAD, 49, 0], [CMD_LOAD, 0, 1], [CMD_WRITE, 0, 0, 1], [CMD_SQRT, 0, 1]]
+    bad = [[CMD_LOAD, 7, 0], [CMD_LOAD, 5000, 1], [CMD_WRITE, 0, 0, 1]]
+    all_passed = True
+    with tempfile.TemporaryDirectory() as tmp:
+        jobs = []
+        for name, program in (("good1", good), ("bad", bad), ("good2", good)):
+            save_program(program, os.path.join(tmp, name + ".json"))
+            jobs.append({"program": name + ".json", "dump": name + ".xml", "start": 0, "end": 1})
+        manifest = os.path.join(tmp, "batch.json")
+        with open(manifest, 'w', encoding='utf-8') as f:
+            json.dump(jobs, f)
+        
+        report = run_batch(read_batch_manifest(manifest), 2, trace="error")
+        if [r["ok"] for r in report["results"]] != [True, False, True] or report["summary"]["failed"] != 1:
+            print(f"✗ Итоги заданий: {[(r['ok'], r.get('error')) for r in report['results']]}")
+            all_passed = False
+        elif "вне диапазона" not in report["results"][1].get("error", ""):
+            print(f"✗ Нет причины ошибки задания: {report['results'][1]}")
+            all_passed = False
+        for name in ("good1", "good2"):
+            dump_file = os.path.join(tmp, name + ".xml")
+            if not os.path.exists(dump_file) or read_memory_dump(dump_file)[1] != [49, 7]:
+                print(f"✗ Задание {name}: неверный дамп памяти")
+                all_passed = False
+        
+        source_dir = os.path.join(tmp, "asm")
+        os.makedirs(source_dir)
+        with open(os.path.join(source_dir, "good.asm"), 'w', encoding='utf-8') as f:
+            f.write("LOAD 5 0\n")
+        with open(os.path.join(source_dir, "bad.asm"), 'w', encoding='utf-8') as f:
+            f.write("LOAD 5\n")
+        commands = [
+            ("run-batch с ошибочным заданием", ("run-batch", manifest, "--workers=2", "--trace=error"), 1),
+            ("нет манифеста", ("run-batch", os.path.join(tmp, "missing.json")), 1),
+            ("--workers без числа", ("run-batch", manifest, "--workers"), 0),
+            ("--workers=0", ("run-batch", manifest, "--workers=0"), 0),
+            ("assemble-dir с ошибочным файлом", ("assemble-dir", source_dir, os.path.join(tmp, "out")), 1),
+        ]
+        for name, args, expected in commands:
+            code, output = _main_exit(*args)
+            if code != expected:
+                print(f"✗ {name}: код выхода {code!r}, ожидался {expected}")
+                all_passed = False
+            elif args[-1].startswith("--workers") and "Использование" not in output:
+                print(f"✗ {name}: нет подсказки об использовании")
+                all_passed = False
+    if all_passed:
+        print("✓ Ошибочное задание не мешает остальным, код выхода сообщает об ошибке")
+    return all_passed
+
+def test_mmap_memory():
+    """Память mmap дает тот же итог, что array того же слова, и остается в файле между ВМ"""
+    print("\nТестирование памяти mmap (--mem-file)...")
+    rng = random.Random(5)
+    all_passed = True
+    checked = 0
+    with tempfile.TemporaryDirectory() as tmp:
+        mem_file = os.path.join(tmp, "memory.bin")
+        for _ in range(15):
+            program = random_program(rng, rng.randrange(1, 200), 0.05, 64)
+            expected = _final_state(program, "interp", mem_size=64, storage="array", word_bits=32)
+            for engine in VM_ENGINES:
+                if os.path.exists(mem_file):
+                    os.remove(mem_file)
+                got = _final_state(program, engine, mem_size=64, storage="mmap", word_bits=32, mem_file=mem_file)
+                if got != expected:
+                    print(f"✗ {engine}: итог на памяти mmap отличается от array")
+                    all_passed = False
+                checked += 1
+        
+        # Итоговая память остается в файле и становится начальной памятью следующей ВМ
+        os.remove(mem_file)
+        program = [[CMD_LOAD, 81, 0], [CMD_LOAD, 0, 1], [CMD_WRITE, 0, 10, 1], [CMD_SQRT, 10, 11]]
+        save_program(program, os.path.join(tmp, "program.json"))
+        code, _ = _main_exit("run", os.path.join(tmp, "program.json"), "-", "0", "0",
+                             f"--mem-file={mem_file}", "--mem-size=32", "--trace=off")
+        words = array(WORD_TYPECODES[64])
+        with open(mem_file, 'rb') as f:
+            words.frombytes(f.read())
+        if code != 0 or len(words) != 32 or words[10:12].tolist() != [81, 9]:
+            print(f"✗ run --mem-file: в файле памяти {words[8:14].tolist()} ({len(words)} слов)")
+            all_passed = False
+        vm = VirtualMachine(mem_size=64, storage="mmap", mem_file=mem_file, trace="off")
+        if list(vm.memory[8:14]) != [0, 0, 81, 9, 0, 0] or any(vm.memory[32:]):
+            print("✗ Новая ВМ не видит память из файла или хвост памяти не нулевой")
+            all_passed = False
+        vm.memory[12] = -7
+        vm.close()
+        with open(mem_file, 'rb') as f:
+            words = array(WORD_TYPECODES[64], f.read())
+        if len(words) != 64 or words[12] != -7:
+            print("✗ Запись в память mmap не сохранена в файле после close()")
+            all_passed = False
+        
+        # Без файла памяти и для fork() - ошибка, а не тихая память в процессе
+        vm = VirtualMachine(storage="mmap", mem_file=mem_file, trace="off")
+        for name, action in (("mmap без mem_file", lambda: VirtualMachine(storage="mmap", trace="off")),
+                             ("fork() памяти mmap", vm.fork)):
+            try:
+                action()
+                print(f"✗ {name}: нет ошибки")
+                all_passed = False
+            except ValueError:
+                pass
+        vm.close()
+    if all_passed:
+        print(f"✓ Память mmap совпадает с array ({checked} запусков), сохраняется в файле между ВМ")
+    return all_passed
+
+def test_tracer():
+    """Уровни трассировки во всех движках, вывод в файл и в кольцевой буфер"""
+    print("\nТестирование трассировки ВМ (--trace, --trace-file, --trace-ring)...")
+    program = [[CMD_LOAD, 49, 0], [CMD_LOAD, 0, 1], [CMD_WRITE, 0, 7, 1], [CMD_SQRT, 7, 8],
+               [CMD_SQRT, 8, 9], [CMD_READ, 1, 2], [CMD_SQRT, 9, 10]]
+    failing = program[:3] + [[CMD_SQRT, 7, 5000]]
+    listing = [format_command(i, cmd) for i, cmd in enumerate(program)]
+    all_passed = True
+    
+    def traced(commands, engine, **vm_options):
+        # Вывод загрузки, выполнения и дампа ВМ в stdout и итог выполнения
+        with contextlib.redirect_stdout(io.StringIO()) as output:
+            vm = VirtualMachine(mem_size=64, **vm_options)
+            vm.load_program(program_file)
+            vm.program = commands
+            ok = vm.run(engine)
+            vm.dump_memory(0, 10, dump_file)
+            vm.close()
+        return ok, output.getvalue().splitlines()
+    
+    with tempfile.TemporaryDirectory() as tmp:
+        program_file = os.path.join(tmp, "program.json")
+        dump_file = os.path.join(tmp, "dump.xml")
+        trace_file = os.path.join(tmp, "trace.log")
+        save_program(program, program_file)
+        for engine in VM_ENGINES:
+            ok, lines = traced(program, engine, trace="off")
+            if not ok or lines:
+                print(f"✗ {engine}, off: вывод {lines[:3]}")
+                all_passed = False
+            ok, lines = traced(failing, engine, trace="error")
+            if ok or len(lines) != 1 or "вне диапазона" not in lines[0]:
+                print(f"✗ {engine}, error: вывод {lines}")
+                all_passed = False
+            ok, lines = traced(program, engine, trace="sqrt")
+            if sum(line.startswith("SQRT:") for line in lines) != 3:
+                print(f"✗ {engine}, sqrt: не по строке на каждую команду SQRT")
+                all_passed = False
+            ok, lines = traced(program, engine, trace="instr")
+            if [line for line in lines if line in listing] != listing:
+                print(f"✗ {engine}, instr: не по строке на каждую команду")
+                all_passed = False
+            
+            # Файл трассировки: в stdout остаются только ошибки
+            ok, lines = traced(failing, engine, trace="instr", trace_file=trace_file)
+            with open(trace_file, encoding='utf-8') as f:
+                logged = f.read().splitlines()
+            instr = [format_command(i, cmd) for i, cmd in enumerate(failing)]
+            if len(lines) != 1 or lines[0] not in logged or [line for line in logged if line in instr] != instr:
+                print(f"✗ {engine}, trace_file: в stdout {lines}, в файле {logged[:6]}")
+                all_passed = False
+            
+            # Кольцевой буфер: только последние строки, выписываются при close()
+            ok, lines = traced(program, engine, trace="instr", trace_ring=3)
+            ok, full = traced(program, engine, trace="instr")
+            if lines != full[-3:]:
+                print(f"✗ {engine}, trace_ring=3: {lines}, ожидалось {full[-3:]}")
+                all_passed = False
+        
+        # Уровень и файл из командной строки run
+        code, output = _main_exit("run", program_file, dump_file, "0", "10", "--engine=compile",
+                                  "--trace=instr", f"--trace-file={trace_file}")
+        with open(trace_file, encoding='utf-8') as f:
+            logged = f.read().splitlines()
+        if code != 0 or set(listing) & set(output.splitlines()) or \
+                [line for line in logged if line in listing] != listing:
+            print(f"✗ run --trace=instr --trace-file: трасса команд не в файле ({len(logged)} строк)")
+            all_passed = False
+    try:
+        Tracer("verbose")
+        print("✗ Неизвестный уровень трассировки принят")
+        all_passed = False
+    except ValueError:
+        pass
+    if all_passed:
+        print(f"✓ Уровни off, error, sqrt, instr, файл и кольцевой буфер верны в {len(VM_ENGINES)} движках")
+    return all_passed
+
+def test_profiler():
+    """Профиль: итог как у fast, точные счетчики команд, гистограммы адресов и JSON-отчет run"""
+    print("\nТестирование профилирования (--profile)...")
+    rng = random.Random(17)
+    all_passed = True
+    checked = 0
+    for sample_every in (1, 7, PROFILE_SAMPLE):
+        for _ in range(10):
+            program = random_program(rng, rng.randrange(1, 400), 0.02, 256)
+            expected = _final_state(program, mem_size=256)
+            vm = VirtualMachine(mem_size=256, trace="off")
+            vm.program = program
+            ok, report = vm.run_profiled(sample_every)
+            executed = program[:vm.pc]
+            counts = collections.Counter(BY_OPCODE[cmd[0]].mnemonic for cmd in executed)
+            name = f"шаг {sample_every}, {len(program)} команд"
+            if (ok, list(vm.regs), list(vm.memory)) != expected or report["completed"] != ok:
+                print(f"✗ {name}: итог профилирования отличается от fast")
+                all_passed = False
+            elif report["executed"] != len(executed) or \
+                    {op: entry["count"] for op, entry in report["opcodes"].items()} != counts:
+                print(f"✗ {name}: счетчики команд {report['opcodes']}, ожидалось {dict(counts)}")
+                all_passed = False
+            elif sum(entry["samples"] for entry in report["opcodes"].values()) != \
+                    -(-len(executed) // sample_every):
+                print(f"✗ {name}: число замеров не соответствует шагу выборки")
+                all_passed = False
+            elif sample_every == 1 and ok and \
+                    sum(report["address_histograms"]["SQRT_SRC"].values()) != counts["SQRT"]:
+                print(f"✗ {name}: гистограмма SQRT не по каждой команде")
+                all_passed = False
+            vm.close()
+            checked += 1
     
-    def print_state(self):
-        """Вывод состояния ВМ"""
-        print("\nСостояние виртуальной машины:")
-        print(f"PC: {self.pc}")
-        print(f"Регистры (первые 10): {self.regs[:10]}")
-        print(f"Память (интересные ячейки):")
-        interesting = [100, 150, 200, 201, 396, 400, 959]
-        for addr in interesting:
-            if addr < len(self.memory):
-                print(f"  memory[{addr:3d}] = {self.memory[addr]}")
+    # Адреса READ/WRITE/SQRT попадают в корзины по PROFILE_BUCKET ячеек
+    program = [[CMD_LOAD, 130, 0], [CMD_LOAD, 4, 1], [CMD_WRITE, 1, 5, 0], [CMD_READ, 0, 2],
+               [CMD_SQRT, 135, 3 * PROFILE_BUCKET], [CMD_WRITE, 1, 0, 1]]
+    vm = VirtualMachine(mem_size=256, trace="off")
+    vm.program = program
+    ok, report = vm.run_profiled(1)
+    vm.close()
+    bucket = str(130 // PROFILE_BUCKET * PROFILE_BUCKET)
+    expected = {"READ": {bucket: 1}, "WRITE": {bucket: 1, "0": 1}, "SQRT_SRC": {bucket: 1},
+                "SQRT_DST": {str(3 * PROFILE_BUCKET): 1}}
+    if not ok or report["address_histograms"] != expected:
+        print(f"✗ Гистограммы адресов: {report['address_histograms']}, ожидалось {expected}")
+        all_passed = False
+    
+    # Отчет run --profile - JSON; неверный шаг выборки отклоняется до запуска
+    with tempfile.TemporaryDirectory() as tmp:
+        program_file = os.path.join(tmp, "program.json")
+        report_file = os.path.join(tmp, "profile.json")
+        save_program(program, program_file)
+        code, output = _main_exit("run", program_file, "-", "0", "0", f"--profile={report_file}",
+                                  "--profile-sample=2", "--trace=off")
+        try:
+            with open(report_file, encoding='utf-8') as f:
+                report = json.load(f)
+        except (OSError, ValueError):
+            report = {}
+        if code != 0 or report.get("program") != program_file or report.get("executed") != len(program) \
+                or report.get("sample_every") != 2 or not report.get("ips"):
+            print(f"✗ run --profile: отчет {report}")
+            all_passed = False
+        os.remove(report_file)
+        code, output = _main_exit("run", program_file, "-", "0", "0", f"--profile={report_file}",
+                                  "--profile-sample=0")
+        if os.path.exists(report_file) or "--profile-sample" not in output:
+            print("✗ run --profile-sample=0: шаг выборки не отклонен")
+            all_passed = False
+    if all_passed:
+        print(f"✓ Профиль совпадает с fast ({checked} запусков), счетчики и гистограммы точные, отчет в JSON")
+    return all_passed
 
-def test_assembler():
-    """Тестирование ассемблера"""
-    print("Тестирование ассемблера...")
+def test_fork():
+    """Копии fork() выполняются независимо, память paged копирует только записанные страницы"""
+    print("\nТестирование копирования ВМ (fork, память paged)...")
+    rng = random.Random(20)
+    mem_size = 8 << MEMORY_PAGE_BITS
+    storages = [{"storage": "paged"}, {}, {"storage": "array", "word_bits": 32}]
+    all_passed = True
+    checked = 0
+    for options in storages:
+        name = options.get("storage", "list")
+        for _ in range(5):
+            prefix = random_program(rng, rng.randrange(1, 200), 0.0, mem_size)
+            vm = VirtualMachine(mem_size=mem_size, trace="off", **options)
+            vm.program = prefix
+            vm.run("fast")
+            state = (list(vm.regs), list(vm.memory))
+            # Разные продолжения, в том числе от копии копии
+            children = []
+            for depth in range(4):
+                parent = children[-1][0] if depth == 3 else vm
+                suffix = random_program(rng, rng.randrange(1, 100), 0.0, mem_size)
+                base = parent.program
+                child = parent.fork()
+                child.program = base + suffix
+                children.append((child, base + suffix))
+            for child, program in children:
+                expected = _final_state(program, "fast", mem_size=mem_size, **options)
+                if (child.run("fast", child.pc), list(child.regs), list(child.memory)) != expected:
+                    print(f"✗ {name}: продолжение копии расходится с запуском без fork()")
+                    all_passed = False
+                checked += 1
+            if (list(vm.regs), list(vm.memory)) != state:
+                print(f"✗ {name}: запуск копий изменил исходную ВМ")
+                all_passed = False
+            for child, _ in children:
+                child.close()
+            vm.close()
     
-    test_program = """# Тестовая программа для Варианта 21 (все этапы)
-# Этап 1-2: Базовые операции
-LOAD 25 0
-LOAD 100 1
-WRITE 0 0 1      # memory[100] = 25
-WRITE 1 50 1     # memory[150] = 100
+    # Копия делит страницы с исходной памятью, запись копирует одну страницу
+    vm = VirtualMachine(mem_size=mem_size, storage="paged", trace="off")
+    for page in range(8):
+        vm.memory[page << MEMORY_PAGE_BITS] = page + 1
+    children = [vm.fork() for _ in range(100)]
+    shared = all(child.memory._table is vm.memory._table for child in children)
+    children[0].memory[5] = -1
+    children[0].memory[6] = -2
+    children[1].memory[3 << MEMORY_PAGE_BITS] = 0
+    vm.memory[7 << MEMORY_PAGE_BITS] = 99
+    pages = [memory.private_pages() for memory in (vm.memory, children[0].memory, children[1].memory,
+                                                   children[2].memory)]
+    values = [vm.memory[5], children[0].memory[5], children[1].memory[3 << MEMORY_PAGE_BITS],
+              vm.memory[3 << MEMORY_PAGE_BITS], children[2].memory[7 << MEMORY_PAGE_BITS]]
+    if not shared or pages != [1, 1, 1, 0] or values != [0, -1, 0, 4, 8]:
+        print(f"✗ paged: общие страницы {shared}, скопировано {pages}, значения {values}")
+        all_passed = False
+    vm.close()
+    if all_passed:
+        print(f"✓ Копии {len(storages)} хранилищ независимы ({checked} продолжений), "
+              f"paged копирует только записанные страницы")
+    return all_passed
 
-# Этап 3: Команда SQRT
-SQRT 100 200      # sqrt(25) -> memory[200]
-SQRT 150 201      # sqrt(100) -> memory[201]
+def test_reset():
+    """reset() обнуляет ВМ на месте, а память paged - без копирования страниц"""
+    print("\nТестирование сброса ВМ (reset)...")
+    program = [[CMD_LOAD, 5, 0], [CMD_LOAD, 700, 1], [CMD_WRITE, 0, 0, 1], [CMD_SQRT, 700, 3]]
+    storages = [{}, {"storage": "array", "word_bits": 16}, {"storage": "paged"}]
+    if load_numpy() is not None:
+        storages.append({"storage": "numpy", "word_bits": 32})
+    all_passed = True
+    with tempfile.TemporaryDirectory() as tmp:
+        storages.append({"storage": "mmap", "mem_file": os.path.join(tmp, "memory.bin")})
+        for options in storages:
+            vm = VirtualMachine(trace="off", **options)
+            vm.program = program
+            memory = vm.memory
+            vm.run()
+            vm.reset()
+            name = options.get("storage", "list")
+            if any(vm.regs) or any(vm.memory) or vm.pc != 0:
+                print(f"✗ {name}: после reset() остались ненулевые значения")
+                all_passed = False
+            elif name == "paged" and vm.memory.private_pages():
+                print("✗ paged: reset() скопировал страницы памяти")
+                all_passed = False
+            elif name != "paged" and vm.memory is not memory:
+                print(f"✗ {name}: reset() заменил хранилище вместо обнуления на месте")
+                all_passed = False
+            vm.close()
+    if all_passed:
+        print(f"✓ reset() обнуляет {len(storages)} видов хранилищ")
+    return all_passed
 
-# Тест из спецификации Варианта 21
-LOAD 625 2
-WRITE 2 959 0    # memory[959] = 625
-SQRT 959 396     # sqrt(625) -> memory[396]
-"""
+def test_server():
+    """Запросы к серверу ВМ через сокет: вывод, дамп, ошибочные запросы и статистика"""
+    import asyncio
+    print("\nТестирование сервера ВМ...")
+    all_passed = True
+    program = [[CMD_LOAD, 49, 0], [CMD_LOAD, 0, 1], [CMD_WRITE, 0, 0, 1], [CMD_SQRT, 0, 1]]
+    with tempfile.TemporaryDirectory() as tmp:
+        program_file = os.path.join(tmp, "program.json")
+        save_program(program, program_file)
+        socket_path = os.path.join(tmp, "vm.sock")
+        server = VMServer(socket_path, 2, trace="sqrt")
+        with contextlib.redirect_stdout(io.StringIO()):
+            thread = threading.Thread(target=asyncio.run, args=(server.serve(),))
+            thread.start()
+            for _ in range(500):
+                if os.path.exists(socket_path):
+                    break
+                time.sleep(0.01)
+            
+            def request(**fields):
+                messages = list(client_request(socket_path, dict(fields, id=1)))
+                return messages[-1], [m["line"] for m in messages if m["event"] == "output"]
+            
+            dump_file = os.path.join(tmp, "dump.xml")
+            requests = [
+                ("дамп", {"program": program_file, "dump": dump_file, "start": 0, "end": 1}, True),
+                ("движок compile", {"program": program_file, "engine": "compile"}, True),
+                ("неверный адрес дампа", {"program": program_file, "dump": dump_file, "start": "x", "end": 1}, False),
+                ("нет программы", {"program": os.path.join(tmp, "missing.json")}, False),
+                ("неизвестный движок", {"program": program_file, "engine": "jit"}, False),
+            ]
+            results = []
+            try:
+                for name, fields, expected in requests:
+                    result, lines = request(**fields)
+                    results.append((name, result, lines, expected))
+                stats = request(op="stats")[0]
+            finally:
+                list(client_request(socket_path, {"op": "shutdown"}))
+                thread.join()
+        dump_values = read_memory_dump(dump_file)[1] if os.path.exists(dump_file) else []
+    for name, result, lines, expected in results:
+        if result.get("event") != "result" or result.get("ok") != expected:
+            print(f"✗ {name}: ответ {result}, ожидался ok={expected}")
+            all_passed = False
+        elif expected and not any("SQRT" in line for line in lines):
+            print(f"✗ {name}: нет вывода трассировки SQRT в ответе")
+            all_passed = False
+        elif not expected and not lines:
+            print(f"✗ {name}: нет сообщения об ошибке в ответе")
+            all_passed = False
+    if dump_values[:2] != [49, 7]:
+        print(f"✗ Дамп памяти сервера: {dump_values}")
+        all_passed = False
+    failed = sum(1 for _, _, expected in requests if not expected)
+    if (stats.get("requests"), stats.get("ok"), stats.get("failed")) != (len(requests), len(requests) - failed, failed):
+        print(f"✗ Статистика сервера: {stats}")
+        all_passed = False
+    if all_passed:
+        print(f"✓ Сервер выполнил {len(requests)} запросов через сокет, ошибочные отклонены")
+    return all_passed
+
+def test_program_transforms():
+    """Оптимизатор, частичное вычисление и параллельное выполнение не меняют итог программы"""
+    print("\nТестирование преобразований программ (optimize, partial, parallel)...")
+    rng = random.Random(23)
+    configs = [{"mem_size": 16}, {"mem_size": 16, "num_regs": 4},
+               {"mem_size": 16, "storage": "array", "word_bits": 16}, {"mem_size": 16, "storage": "paged"}]
+    all_passed = True
+    removed_total = folded_total = 0
+    for i in range(60):
+        options = rng.choice(configs)
+        num_regs = options.get("num_regs", 8)
+        program = random_program(rng, rng.randrange(1, 60), rng.choice([0.0, 0.1]), 16, num_regs)
+        expected = _final_state(program, **options)
+        
+        word_bits = options.get("word_bits") if options.get("storage") == "array" else None
+        optimized, _ = optimize_program(program, options["mem_size"], num_regs, word_bits)
+        removed_total += len(program) - len(optimized)
+        if _final_state(optimized, **options) != expected:
+            print(f"✗ optimize_program: итог программы {i} изменился ({options})")
+            all_passed = False
+        
+        # Частичное вычисление на нулевой и на произвольной входной памяти
+        memory_input = i % 2 == 1
+        memory = [(rng.randrange(16), rng.randrange(-5, 300)) for _ in range(8)] if memory_input else []
+        image, residual = partial_evaluate(program, memory_input, **options)
+        folded_total += image["folded"]
+        if (_final_state(residual, memory=memory, image=image, **options)
+                != _final_state(program, memory=memory, **options)):
+            print(f"✗ partial_evaluate: итог программы {i} изменился "
+                  f"({options}, входная память: {memory_input})")
+            all_passed = False
     
-    with open('test_all.asm', 'w', encoding='utf-8') as f:
-        f.write(test_program)
+    # Параллельное выполнение: k независимых областей по 4 регистра и 40 ячеек
+    parallel_runs = 0
+    for i in range(4):
+        regions = rng.randrange(2, 6)
+        program = []
+        for _ in range(rng.randrange(40, 200)):
+            r = rng.randrange(regions)
+            base, reg = 40 * r, 4 * r
+            kind = rng.randrange(5)
+            if kind == 0:
+                program.append([CMD_LOAD, base + rng.randrange(20), reg])
+            elif kind == 1:
+                program.append([CMD_LOAD, rng.randrange(1000), reg + 1])
+            elif kind == 2:
+                program.append([CMD_WRITE, reg + 1 + rng.randrange(2), rng.randrange(10), reg])
+            elif kind == 3:
+                program.append([CMD_READ, reg, reg + 2])
+            else:
+                program.append([CMD_SQRT, base + rng.randrange(30), base + rng.randrange(30)])
+        options = rng.choice([{"mem_size": 400}, {"mem_size": 400, "storage": "array", "word_bits": 32}])
+        vm = VirtualMachine(**options)
+        vm.program = program
+        with contextlib.redirect_stdout(io.StringIO()) as output:
+            ok = vm.run_parallel(4)
+        parallel_runs += "процессах" in output.getvalue()
+        if (ok, list(vm.regs), list(vm.memory)) != _final_state(program, **options):
+            print(f"✗ run_parallel: итог программы {i} отличается от run() ({options})")
+            all_passed = False
+        vm.close()
+    if parallel_runs == 0:
+        print("✗ run_parallel: ни одна программа не выполнена параллельно")
+        all_passed = False
     
-    success = assemble('test_all.asm', 'test_all.json', test_mode=True)
-    return success
+    if all_passed:
+        print(f"✓ Итог не изменился: удалено {removed_total} команд, вычислено заранее {folded_total}, "
+              f"параллельных запусков {parallel_runs}")
+    return all_passed
 
 def test_interpreter_with_sqrt():
     """Тестирование интерпретатора с SQRT (этап 3)"""
@@ -287,64 +3669,1381 @@ def test_interpreter_with_sqrt():
     
     return all_passed
 
-def run_vm(program_file, dump_file, start_addr, end_addr):
-    """Запуск виртуальной машины"""
-    vm = VirtualMachine()
+def make_synthetic_program(num_commands, mem_size=1024, num_regs=8, seed=21, mix=None):
+    """Генерация случайной корректной программы для бенчмарков
     
-    if not vm.load_program(program_file):
+    Константы и смещения берутся из [0, mem_size/2), поэтому любой адрес,
+    вычисленный программой, остается в пределах памяти.
+    mix - веса (LOAD, READ, WRITE, SQRT); по умолчанию команды равновероятны.
+    """
+    rng = random.Random(seed)
+    half = mem_size // 2
+    program = []
+    for _ in range(num_commands):
+        kind = rng.randrange(4) if mix is None else rng.choices(range(4), mix)[0]
+        if kind == 0:
+            program.append([CMD_LOAD, rng.randrange(half), rng.randrange(num_regs)])
+        elif kind == 1:
+            program.append([CMD_READ, rng.randrange(num_regs), rng.randrange(num_regs)])
+        elif kind == 2:
+            program.append([CMD_WRITE, rng.randrange(num_regs), rng.randrange(half),
+                            rng.randrange(num_regs)])
+        else:
+            program.append([CMD_SQRT, rng.randrange(mem_size), rng.randrange(mem_size)])
+    return program
+
+def bench_program_format(num_commands=1000000):
+    """Бенчмарк: размер файла и время загрузки JSON против бинарного формата"""
+    print(f"Бенчмарк форматов программы ({num_commands} команд)...")
+    program = make_synthetic_program(num_commands)
+    
+    with tempfile.TemporaryDirectory() as tmp:
+        results = {}
+        for fmt in ("json", "bin"):
+            path = os.path.join(tmp, f"program.{fmt}")
+            t0 = time.perf_counter()
+            save_program(program, path, fmt)
+            t1 = time.perf_counter()
+            loaded = read_program(path)
+            t2 = time.perf_counter()
+            if [list(cmd) for cmd in loaded] != program:
+                print(f"✗ {fmt}: загруженная программа отличается от исходной")
+                return False
+            results[fmt] = (os.path.getsize(path), t1 - t0, t2 - t1)
+    
+    print(f"{'формат':>8} {'размер, байт':>14} {'запись, с':>10} {'загрузка, с':>12}")
+    for fmt, (size, save_time, load_time) in results.items():
+        print(f"{fmt:>8} {size:>14} {save_time:>10.3f} {load_time:>12.3f}")
+    json_size, _, json_load = results["json"]
+    bin_size, _, bin_load = results["bin"]
+    print(f"Размер: в {json_size / bin_size:.1f} раз меньше, "
+          f"загрузка: в {json_load / bin_load:.1f} раз быстрее")
+    return True
+
+def bench_memory_dump(num_cells=1000000):
+    """Бенчмарк: потоковый XML-дамп против построения полного дерева ElementTree"""
+    print(f"Бенчмарк дампа памяти ({num_cells} ячеек)...")
+    vm = VirtualMachine(mem_size=num_cells)
+    rng = random.Random(21)
+    for addr in range(0, num_cells, 7):
+        vm.memory[addr] = rng.randrange(1 << 20)
+    
+    writers = (("stream", vm.dump_memory_xml), ("tree", vm.dump_memory_xml_tree))
+    results = {}
+    with tempfile.TemporaryDirectory() as tmp:
+        for name, dump in writers:
+            path = os.path.join(tmp, f"{name}.xml")
+            t0 = time.perf_counter()
+            dump(0, num_cells - 1, path)
+            elapsed = time.perf_counter() - t0
+            # Пик памяти измеряется отдельным прогоном: tracemalloc замедляет выделения
+            tracemalloc.start()
+            dump(0, num_cells - 1, path)
+            peak = tracemalloc.get_traced_memory()[1]
+            tracemalloc.stop()
+            with open(path, 'rb') as f:
+                digest = hashlib.sha256(f.read()).hexdigest()
+            results[name] = (elapsed, peak, digest)
+    
+    print(f"{'способ':>8} {'время, с':>9} {'ячеек/с':>12} {'пик памяти, МБ':>15}")
+    for name, (elapsed, peak, _) in results.items():
+        print(f"{name:>8} {elapsed:>9.3f} {num_cells / elapsed:>12.0f} {peak / 2**20:>15.1f}")
+    if results["stream"][2] != results["tree"][2]:
+        print("✗ Потоковый дамп отличается от дампа ElementTree")
+        return False
+    print("✓ Дампы совпадают байт в байт")
+    return True
+
+def bench_sqrt(count=200000):
+    """Бенчмарк SQRT: покомандный путь с печатью против тихого и пакетного (sqrt_range)"""
+    print(f"Бенчмарк SQRT ({count} операций)...")
+    rng = random.Random(21)
+    pool = [rng.randrange(SQRT_MEMO_MIN, SQRT_MEMO_MIN << 32) for _ in range(256)]
+    operand_sets = (
+        ("слова", [rng.randrange(1 << 62) for _ in range(count)]),
+        ("длинные", [rng.choice(pool) for _ in range(count)]),  # повторяющиеся операнды
+    )
+    
+    def per_command(vm):
+        execute_sqrt = vm.execute_sqrt
+        for addr in range(count):
+            execute_sqrt(addr, count + addr)
+    
+    def bulk(vm):
+        vm.sqrt_range(0, count, count)
+    
+    paths = (("печать", "sqrt", per_command), ("тихий", "info", per_command),
+             ("пакетный", "info", bulk))
+    print(f"{'операнды':>9} {'путь':>9} {'время, с':>9} {'операций/с':>12}")
+    for operands, values in operand_sets:
+        expected = None
+        for path, trace, run in paths:
+            vm = VirtualMachine(mem_size=2 * count, trace=trace)
+            vm.memory[:count] = values
+            isqrt_memo.cache_clear()
+            # Печать идет в /dev/null: замеряется ее цена без терминала
+            with open(os.devnull, 'w') as null, contextlib.redirect_stdout(null):
+                t0 = time.perf_counter()
+                run(vm)
+                elapsed = time.perf_counter() - t0
+            print(f"{operands:>9} {path:>9} {elapsed:>9.3f} {count / elapsed:>12.0f}")
+            if expected is None:
+                expected = vm.memory[count:]
+            elif vm.memory[count:] != expected:
+                print(f"✗ Путь {path} дает другой результат")
+                return False
+    print("✓ Результаты всех путей совпадают")
+    return True
+
+def bench_fork(num_forks=300, mem_size=1 << 16, suffix_len=100):
+    """Бенчмарк fork(): общий префикс программы и num_forks продолжений
+    
+    Сравнивает память list (каждая копия - целый список) и paged (копия
+    при записи): время создания копий, пик памяти и итог продолжений.
+    """
+    print(f"Бенчмарк fork ({num_forks} копий, память {mem_size} ячеек, "
+          f"продолжения по {suffix_len} команд)...")
+    prefix = make_synthetic_program(10000, mem_size, seed=21)
+    suffixes = [make_synthetic_program(suffix_len, mem_size, seed=100 + i) for i in range(num_forks)]
+    print(f"{'память':>7} {'fork, с':>9} {'прогон, с':>10} {'пик, МБ':>9}")
+    expected = None
+    for storage in ("list", "paged"):
+        base = VirtualMachine(mem_size=mem_size, storage=storage, trace="error")
+        base.program = prefix
+        base.run("fast")
+        gc.collect()
+        tracemalloc.start()
+        t0 = time.perf_counter()
+        forks = [base.fork() for _ in range(num_forks)]
+        forked = time.perf_counter()
+        for vm, suffix in zip(forks, suffixes):
+            vm.program = prefix + suffix
+            vm.run("fast", len(prefix))
+        elapsed = time.perf_counter() - forked
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+        print(f"{storage:>7} {forked - t0:>9.3f} {elapsed:>10.3f} {peak / 2**20:>9.1f}")
+        # Сверка: сумма памяти каждой копии и неизменность общей памяти
+        result = [sum(vm.memory) for vm in forks] + [sum(base.memory)]
+        if expected is None:
+            expected = result
+        elif result != expected:
+            print("✗ Память paged дает другой результат")
+            return False
+        del forks
+    print("✓ Результаты совпадают")
+    return True
+
+def parse_line_legacy(line):
+    """Прежний разбор строки цепочкой if (эталон для bench-parse)"""
+    line = line.strip()
+    if not line or line.startswith('#'):
+        return None
+    
+    parts = line.split()
+    cmd_name = parts[0].upper()
+    
+    if cmd_name == "LOAD":
+        # LOAD константа регистр_назначения
+        const = int(parts[1])
+        reg_dst = int(parts[2])
+        if not (0 <= reg_dst < 256):
+            raise ValueError("Номер регистра должен быть от 0 до 255")
+        return [CMD_LOAD, const, reg_dst]
+    
+    if cmd_name == "READ":
+        # READ регистр_источник регистр_назначения
+        reg_src = int(parts[1])
+        reg_dst = int(parts[2])
+        if not (0 <= reg_src < 256 and 0 <= reg_dst < 256):
+            raise ValueError("Номер регистра должен быть от 0 до 255")
+        return [CMD_READ, reg_src, reg_dst]
+    
+    if cmd_name == "WRITE":
+        # WRITE регистр_источник смещение регистр_адреса
+        reg_src = int(parts[1])
+        offset = int(parts[2])
+        reg_addr = int(parts[3])
+        if not (0 <= reg_src < 256 and 0 <= reg_addr < 256):
+            raise ValueError("Номер регистра должен быть от 0 до 255")
+        return [CMD_WRITE, reg_src, offset, reg_addr]
+    
+    if cmd_name == "SQRT":  # ЭТАП 3
+        # SQRT адрес_источник адрес_назначения
+        addr_src = int(parts[1])
+        addr_dst = int(parts[2])
+        return [CMD_SQRT, addr_src, addr_dst]
+    
+    raise ValueError(f"неизвестная команда '{cmd_name}'")
+
+def bench_parser(num_lines=1000000):
+    """Бенчмарк: табличный разбор строк (uvm_isa.parse_line) против прежнего"""
+    print(f"Бенчмарк разбора исходного текста ({num_lines} строк)...")
+    rng = random.Random(21)
+    lines = []
+    for cmd in make_synthetic_program(num_lines):
+        text = source_line(cmd)
+        roll = rng.random()
+        if roll < 0.05:
+            text = "# " + text
+        elif roll < 0.1:
+            text = "    " + text.lower()
+        lines.append(text + "\n")
+    
+    # Результаты не накапливаются: ассемблер тоже сразу пишет команды в файл
+    results = {}
+    parsers = (("legacy", parse_line_legacy), ("table", parse_line))
+    for name, parse in parsers:
+        t0 = time.perf_counter()
+        for line in lines:
+            parse(line)
+        results[name] = time.perf_counter() - t0
+    
+    print(f"{'разбор':>8} {'время, с':>9} {'строк/с':>12}")
+    for name, elapsed in results.items():
+        print(f"{name:>8} {elapsed:>9.3f} {num_lines / elapsed:>12.0f}")
+    if any(parse_line_legacy(line) != parse_line(line) for line in lines):
+        print("✗ Результаты разбора отличаются")
+        return False
+    print(f"✓ Результаты совпадают, ускорение в {results['legacy'] / results['table']:.1f} раз")
+    return True
+
+# Набор бенчмарков: размеры программ, смеси команд (веса LOAD, READ, WRITE, SQRT)
+BENCH_SIZES = (1000, 10000, 100000)
+BENCH_MIXES = {
+    "uniform": (1, 1, 1, 1),
+    "registers": (4, 4, 1, 0),   # в основном LOAD/READ
+    "memory": (1, 2, 6, 0),      # в основном WRITE
+    "sqrt": (1, 0, 1, 6),        # в основном SQRT
+}
+BENCH_MEM_SIZE = 1 << 16
+BENCH_MIN_TIME = 0.2    # Короткий этап повторяется, пока суммарное время меньше этого
+BENCH_TOLERANCE = 1.25  # Замедление относительно базовой линии, считающееся регрессией
+
+def _bench_stage(stage, repeat):
+    """Лучшее время stage() и пик памяти отдельного запуска под tracemalloc
+    
+    Этап выполняется не меньше repeat раз и не меньше BENCH_MIN_TIME секунд
+    в сумме: минимум по многим запускам устойчив к шуму.
+    """
+    best = None
+    runs = 0
+    total = 0.0
+    while runs < repeat or total < BENCH_MIN_TIME:
+        gc.collect()  # Мусор предыдущих запусков не должен собираться внутри замера
+        t0 = time.perf_counter()
+        stage()
+        elapsed = time.perf_counter() - t0
+        best = elapsed if best is None else min(best, elapsed)
+        runs += 1
+        total += elapsed
+    # tracemalloc замедляет выделения, поэтому пик памяти - отдельным запуском
+    tracemalloc.start()
+    stage()
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return best, peak
+
+def bench_suite(sizes=BENCH_SIZES, mixes=tuple(BENCH_MIXES), engines=VM_ENGINES, repeat=1,
+                baseline_file=None, save_baseline=False, tolerance=BENCH_TOLERANCE):
+    """Набор бенчмарков: assemble, load_program, run (каждый движок) и dump_memory_xml
+    
+    Этапы run:<движок> - первый запуск программы (декодирование или
+    компиляция входят в замер); fast:cached - повторный запуск fast на той же
+    ВМ, compile:disk - запуск compile в новом процессе с кодом из дискового кэша.
+    Программы генерируются с фиксированным зерном, поэтому результаты
+    воспроизводимы. С baseline_file результаты сравниваются с сохраненной
+    базовой линией (регрессия - замедление больше tolerance раз);
+    save_baseline записывает в baseline_file текущие результаты.
+    Возвращает True, если регрессий нет.
+    """
+    results = []
+    print(f"{'команд':>8} {'смесь':>9} {'этап':>12} {'время, с':>9} {'в секунду':>12} "
+          f"{'пик, МБ':>8}")
+    with tempfile.TemporaryDirectory() as tmp, open(os.devnull, 'w') as null:
+        source_file = os.path.join(tmp, "program.asm")
+        program_file = os.path.join(tmp, "program.uvm")
+        dump_file = os.path.join(tmp, "dump.xml")
+        for size in sizes:
+            for mix in mixes:
+                program = make_synthetic_program(size, BENCH_MEM_SIZE, mix=BENCH_MIXES[mix])
+                with open(source_file, 'w', encoding='utf-8') as f:
+                    for cmd in program:
+                        f.write(source_line(cmd) + "\n")
+                
+                vm = VirtualMachine(BENCH_MEM_SIZE, trace="off")
+                code_cache = AssemblyCache(os.path.join(tmp, "cache"))
+                
+                def run_engine(engine, cold=True):
+                    if cold:
+                        _compiled_cache.clear()
+                        vm._compiled_for = vm._decoded_for = None
+                    vm.run(engine)
+                
+                def run_compile_from_disk():
+                    # Как новый процесс: в памяти кода нет, он загружается из кэша
+                    _compiled_cache.clear()
+                    vm._compiled_for = None
+                    vm.code_cache = code_cache
+                    try:
+                        vm.run("compile")
+                    finally:
+                        vm.code_cache = None
+                
+                stages = [
+                    ("assemble", size,
+                     lambda: assemble(source_file, program_file, fmt="bin")),
+                    ("load", size, lambda: vm.load_program(program_file)),
+                ]
+                stages += [(f"run:{engine}", size, functools.partial(run_engine, engine))
+                           for engine in engines]
+                if "fast" in engines:
+                    stages.append(("fast:cached", size, functools.partial(run_engine, "fast", False)))
+                if "compile" in engines:
+                    stages.append(("compile:disk", size, run_compile_from_disk))
+                stages.append(("dump", BENCH_MEM_SIZE,
+                               lambda: vm.dump_memory_xml(0, BENCH_MEM_SIZE - 1, dump_file)))
+                for stage, items, fn in stages:
+                    with contextlib.redirect_stdout(null):
+                        if stage == "compile:disk":
+                            fn()  # Заполнение дискового кэша вне замера
+                        seconds, peak = _bench_stage(fn, repeat)
+                    results.append({"size": size, "mix": mix, "stage": stage,
+                                    "seconds": seconds, "per_second": items / seconds,
+                                    "peak_bytes": peak})
+                    print(f"{size:>8} {mix:>9} {stage:>12} {seconds:>9.4f} "
+                          f"{items / seconds:>12.0f} {peak / 2**20:>8.2f}")
+    
+    ok = True
+    if baseline_file is not None and not save_baseline:
+        try:
+            with open(baseline_file, 'r', encoding='utf-8') as f:
+                baseline = json.load(f)
+        except FileNotFoundError:
+            print(f"Базовая линия {baseline_file} не найдена (сохраняется опцией --save-baseline)")
+            return True
+        reference = {(r["size"], r["mix"], r["stage"]): r["seconds"] for r in baseline["results"]}
+        compared = 0
+        for r in results:
+            old = reference.get((r["size"], r["mix"], r["stage"]))
+            if old is None:
+                continue
+            compared += 1
+            if r["seconds"] > old * tolerance:
+                ok = False
+                print(f"✗ Регрессия: {r['size']} {r['mix']} {r['stage']}: "
+                      f"{old:.4f} с -> {r['seconds']:.4f} с ({r['seconds'] / old:.2f}x)")
+        if ok:
+            print(f"✓ Регрессий нет (сравнено замеров: {compared})")
+    
+    if save_baseline and baseline_file is not None:
+        with open(baseline_file, 'w', encoding='utf-8') as f:
+            json.dump({"python": sys.version.split()[0], "platform": sys.platform,
+                       "repeat": repeat, "results": results}, f, indent=2, ensure_ascii=False)
+        print(f"Базовая линия сохранена в {baseline_file}")
+    return ok
+
+def run_segment(config, program, regs, cells, written_regs, written_cells):
+    """Выполнение группы сегментов в рабочем процессе
+    
+    config - (размер памяти, число регистров, разрядность слова или None,
+    политика переполнения); regs и cells - начальные значения мест, которые
+    читает группа. Возвращает значения записанных регистров и ячеек.
+    """
+    mem_size, num_regs, word_bits, overflow = config
+    storage = "list" if word_bits is None else "array"
+    vm = VirtualMachine(mem_size, num_regs, storage, word_bits or 64, overflow or "error", trace="off")
+    try:
+        for reg, value in regs:
+            vm.regs[reg] = value
+        for addr, value in cells:
+            vm.memory[addr] = value
+        vm.program = program
+        if not vm.run("fast"):
+            raise RuntimeError(f"сегмент остановлен на команде {vm.pc}")
+        return [int(vm.regs[reg]) for reg in written_regs], [int(vm.memory[addr]) for addr in written_cells]
+    finally:
+        vm.close()
+
+def analyze_cli(program_file, report_file=None, **vm_options):
+    """Анализ зависимостей файла программы с выводом отчета"""
+    try:
+        program = read_program(program_file)
+        vm = VirtualMachine(**dict(vm_options, trace="off"))
+        try:
+            segments, report = analyze_program(program, len(vm.memory), len(vm.regs),
+                                               vm._word_config()[0], vm.regs)
+        finally:
+            vm.close()
+    except Exception as e:
+        print(f"Ошибка анализа: {e}")
         return False
     
-    if not vm.run():
+    if segments is None:
+        print(f"Программа не разбивается на сегменты: адрес команды {report['blocked_by']} "
+              f"неизвестен или команда может завершиться ошибкой")
+    else:
+        print(f"Команд: {report['instructions']}, независимых сегментов: {report['segments']}, "
+              f"наибольший: {report['largest']} команд, параллелизм: {report['parallelism']:.2f}")
+        print(f"Наибольшие сегменты: {', '.join(map(str, report['sizes']))}")
+    if report_file is not None:
+        report["program"] = program_file
+        with open(report_file, 'w', encoding='utf-8') as f:
+            json.dump(report, f, indent=2, ensure_ascii=False)
+        print(f"Отчет сохранен в {report_file}")
+    return True
+
+def partial_evaluate(program, memory_input=False, **vm_options):
+    """Частичное вычисление: префикс программы сворачивается в образ начального состояния
+    
+    ВМ стартует с нулевыми регистрами, а LOAD берет только константы, поэтому
+    команды до первой, зависящей от входных данных, вычисляются заранее.
+    memory_input=False - память на входе нулевая (обычный запуск): заранее
+    вычисляется вся программа до первой ошибки; memory_input=True - память
+    на входе произвольная (--mem-file), и префикс кончается на первом чтении
+    ячейки, не записанной раньше. vm_options - параметры VirtualMachine.
+    Возвращает (образ - словарь для JSON, остаточная программа); остаток,
+    запущенный на ВМ после apply_image, дает те же memory и regs, что и
+    исходная программа.
+    """
+    vm_options = dict(vm_options, trace="off")
+    if vm_options.pop("mem_file", None) is not None or vm_options.get("storage") == "mmap":
+        # Память в файле - входные данные; префикс вычисляется в массиве той же разрядности
+        memory_input = True
+        vm_options["storage"] = "array"
+    vm = VirtualMachine(**vm_options)
+    try:
+        vm.program = program
+        size = len(vm.memory)
+        if not memory_input:
+            vm.run("fast")
+            cells = [[addr, int(value)] for addr, value in enumerate(vm.memory) if value]
+        else:
+            written = set()
+            for pc, cmd in enumerate(program):
+                vm.pc = pc
+                opcode = cmd[0]
+                try:
+                    source = int(vm.regs[cmd[1]]) if opcode == CMD_READ else cmd[1] if opcode == CMD_SQRT else None
+                    target = int(vm.regs[cmd[3]]) + cmd[2] if opcode == CMD_WRITE else cmd[2] if opcode == CMD_SQRT else None
+                except (IndexError, TypeError):
+                    source = target = None  # Команда завершится ошибкой и останется в остатке
+                if source is not None and -size <= source < size and source % size not in written:
+                    break
+                if not vm.run("fast", pc, pc + 1):
+                    break
+                if target is not None:
+                    written.add(target % size)
+            else:
+                vm.pc = len(program)
+            cells = [[addr, int(vm.memory[addr])] for addr in sorted(written)]
+        
+        word_bits, overflow = vm._word_config()
+        residual = program[vm.pc:]
+        image = {
+            "format": IMAGE_FORMAT,
+            "version": IMAGE_VERSION,
+            "program": program_hash(residual),
+            "folded": vm.pc,
+            "num_regs": len(vm.regs),
+            "mem_size": size,
+            "word_bits": word_bits,
+            "overflow": overflow,
+            "memory_input": memory_input,
+            "regs": [[reg, int(value)] for reg, value in enumerate(vm.regs) if value],
+            "memory": cells,
+        }
+        return image, residual
+    finally:
+        vm.close()
+
+def partial_cli(program_file, image_file, residual_file, memory_input=False, **vm_options):
+    """Частичное вычисление файла программы: образ в JSON и остаточная программа"""
+    try:
+        program = read_program(program_file)
+        image, residual = partial_evaluate(program, memory_input, **vm_options)
+        with open(image_file, 'w', encoding='utf-8') as f:
+            json.dump(image, f)
+        save_program(residual, residual_file, program_format(residual_file))
+    except Exception as e:
+        print(f"Ошибка частичного вычисления: {e}")
         return False
+    print(f"Вычислено заранее {image['folded']} из {len(program)} команд: образ {image_file} "
+          f"({len(image['memory'])} ячеек), остаток {residual_file} ({len(residual)} команд)")
+    return True
+
+def run_vm(program_file, dump_file, start_addr, end_addr, engine="interp", dump_mode="dense",
+           dump_format="xml", profile_file=None, profile_sample=PROFILE_SAMPLE,
+           checkpoint_every=None, checkpoint_file=None, resume_file=None, compress=False,
+           image_file=None, parallel=None, **vm_options):
+    """Запуск виртуальной машины; vm_options передаются в конструктор VirtualMachine
     
-    if not vm.dump_memory_xml(start_addr, end_addr, dump_file):
+    dump_file "-" - без дампа (например, когда память и так лежит в файле mmap).
+    profile_file - JSON-отчет профилирования (см. VirtualMachine.run_profiled);
+    с ним программа выполняется предекодированными обработчиками (движок fast).
+    checkpoint_every - снимок состояния в checkpoint_file каждые N команд;
+    resume_file - продолжение выполнения со снимка (compress - сжатие снимков).
+    image_file - начальное состояние из образа partial_evaluate (программа - остаток).
+    parallel - выполнение независимыми сегментами в parallel процессах (0 - по числу ядер).
+    Снимки, профилирование и параллельное выполнение взаимоисключающи.
+    """
+    modes = [name for name, value in (("--checkpoint-every", checkpoint_every), ("--profile", profile_file),
+                                      ("--parallel", parallel)) if value is not None]
+    if len(modes) > 1:
+        print(f"Опции {' и '.join(modes)} нельзя использовать вместе")
         return False
     
-    vm.print_state()
+    try:
+        vm = VirtualMachine(**vm_options)
+    except (ValueError, OSError) as e:
+        print(f"Ошибка создания ВМ: {e}")
+        return False
+    
+    try:
+        if not vm.load_program(program_file):
+            return False
+        
+        if image_file is not None and not vm.apply_image(image_file):
+            return False
+        
+        if resume_file is not None and not vm.restore(resume_file):
+            return False
+        
+        if checkpoint_every is not None:
+            if not vm.run_checkpointed(engine, checkpoint_every, checkpoint_file, compress):
+                return False
+        elif profile_file is not None:
+            ok, report = vm.run_profiled(profile_sample)
+            report["program"] = program_file
+            with open(profile_file, 'w', encoding='utf-8') as f:
+                json.dump(report, f, indent=2, ensure_ascii=False)
+            vm.tracer.info(f"Профиль выполнения сохранен в {profile_file}")
+            if not ok:
+                return False
+        elif parallel is not None:
+            if not vm.run_parallel(parallel or None, engine):
+                return False
+        elif not vm.run(engine, vm.pc):
+            return False
+        
+        if dump_file != "-" and not vm.dump_memory(start_addr, end_addr, dump_file,
+                                                   dump_format, dump_mode):
+            return False
+        
+        if vm.tracer.level >= TRACE_INFO:
+            vm.print_state()
+        return True
+    finally:
+        vm.close()
+
+def run_batch_job(job, engine="interp", vm_options=None):
+    """Выполнение одного задания пакета (в рабочем процессе)
+    
+    Вывод ВМ перехватывается; любая ошибка задания попадает в результат и
+    не прерывает остальные задания. Возвращает словарь с итогом и временами.
+    """
+    result = {"program": job["program"], "dump": job["dump"], "ok": False,
+              "instructions": 0, "load": 0.0, "run": 0.0, "dump_time": 0.0}
+    output = io.StringIO()
+    t_start = time.perf_counter()
+    try:
+        with contextlib.redirect_stdout(output):
+            vm = VirtualMachine(**{**(vm_options or {}), **job.get("vm", {})})
+            try:
+                t0 = time.perf_counter()
+                ok = vm.load_program(job["program"])
+                t1 = time.perf_counter()
+                ok = ok and vm.run(job.get("engine", engine))
+                t2 = time.perf_counter()
+                result["instructions"] = vm.pc
+                ok = ok and vm.dump_memory(job["start"], job["end"], job["dump"],
+                                           job.get("dump_format", "xml"),
+                                           job.get("dump_mode", "dense"))
+                t3 = time.perf_counter()
+                result.update(load=t1 - t0, run=t2 - t1, dump_time=t3 - t2)
+            finally:
+                vm.close()
+        result["ok"] = ok
+        if not ok:
+            lines = output.getvalue().strip().splitlines()
+            result["error"] = lines[-1] if lines else "неизвестная ошибка"
+    except Exception as e:
+        result["error"] = f"{type(e).__name__}: {e}"
+    result["total"] = time.perf_counter() - t_start
+    return result
+
+def read_batch_manifest(manifest_file):
+    """Чтение манифеста пакета: JSON-список заданий {program, dump, start, end}
+    
+    Относительные пути считаются от каталога манифеста.
+    """
+    with open(manifest_file, 'r', encoding='utf-8') as f:
+        jobs = json.load(f)
+    if isinstance(jobs, dict):
+        jobs = jobs["jobs"]
+    base = os.path.dirname(os.path.abspath(manifest_file))
+    for job in jobs:
+        for key in ("program", "dump"):
+            job[key] = os.path.normpath(os.path.join(base, job[key]))
+        for key in ("mem_file", "trace_file"):
+            if key in job.get("vm", {}):
+                job["vm"][key] = os.path.normpath(os.path.join(base, job["vm"][key]))
+        if "mem_file" in job.get("vm", {}):
+            job["vm"].setdefault("storage", "mmap")  # Как --mem-file в командной строке
+    return jobs
+
+def check_job_options(vm_options):
+    """Общие для всех заданий параметры ВМ: файлы памяти и трассировки у каждого задания свои
+    
+    Одна память mmap или один файл трассировки на все задания связали бы
+    задания между собой; такие параметры задаются только в "vm" задания.
+    """
+    for key, option in (("mem_file", "--mem-file"), ("trace_file", "--trace-file")):
+        if key in vm_options:
+            raise ValueError(f"{option} нельзя задать для всех заданий: укажите \"{key}\" в \"vm\" задания")
+
+def run_batch(jobs, workers=None, engine="interp", **vm_options):
+    """Выполнение пакета независимых заданий в пуле процессов
+    
+    Возвращает отчет: результаты заданий в исходном порядке и сводные времена.
+    """
+    check_job_options(vm_options)
+    t_start = time.perf_counter()
+    results = [None] * len(jobs)
+    import concurrent.futures
+    with concurrent.futures.ProcessPoolExecutor(max_workers=workers) as pool:
+        futures = {pool.submit(run_batch_job, job, engine, vm_options): i
+                   for i, job in enumerate(jobs)}
+        for future in concurrent.futures.as_completed(futures):
+            i = futures[future]
+            try:
+                results[i] = future.result()
+            except Exception as e:
+                # Аварийное завершение рабочего процесса (например, BrokenProcessPool)
+                results[i] = {"program": jobs[i]["program"], "dump": jobs[i]["dump"], "ok": False,
+                              "instructions": 0, "load": 0.0, "run": 0.0, "dump_time": 0.0,
+                              "total": 0.0, "error": f"{type(e).__name__}: {e}"}
+    wall = time.perf_counter() - t_start
+    
+    instructions = sum(r["instructions"] for r in results)
+    summary = {
+        "jobs": len(results),
+        "ok": sum(1 for r in results if r["ok"]),
+        "failed": sum(1 for r in results if not r["ok"]),
+        "workers": workers or os.cpu_count(),
+        "wall": wall,
+        "load": sum(r["load"] for r in results),
+        "run": sum(r["run"] for r in results),
+        "dump": sum(r["dump_time"] for r in results),
+        "cpu_total": sum(r["total"] for r in results),
+        "instructions": instructions,
+        "instructions_per_second": instructions / wall if wall else 0.0,
+    }
+    return {"summary": summary, "results": results}
+
+def run_batch_cli(manifest_file, workers=None, engine="interp", report_file=None, **vm_options):
+    """Пакетный запуск по манифесту с выводом сводки"""
+    try:
+        jobs = read_batch_manifest(manifest_file)
+    except (OSError, ValueError, KeyError, TypeError) as e:
+        print(f"Ошибка чтения манифеста: {e}")
+        return False
+    
+    try:
+        report = run_batch(jobs, workers, engine, **vm_options)
+    except ValueError as e:
+        print(f"Ошибка: {e}")
+        return False
+    summary = report["summary"]
+    for result in report["results"]:
+        if not result["ok"]:
+            print(f"✗ {result['program']}: {result['error']}")
+    print(f"Заданий: {summary['jobs']}, успешно: {summary['ok']}, с ошибкой: {summary['failed']}")
+    print(f"Процессов: {summary['workers']}, общее время: {summary['wall']:.3f} с "
+          f"(загрузка {summary['load']:.3f} с, выполнение {summary['run']:.3f} с, "
+          f"дамп {summary['dump']:.3f} с суммарно)")
+    print(f"Выполнено {summary['instructions']} команд, "
+          f"{summary['instructions_per_second']:.0f} команд/с")
+    
+    if report_file:
+        with open(report_file, 'w', encoding='utf-8') as f:
+            json.dump(report, f, indent=2, ensure_ascii=False)
+        print(f"Отчет сохранен в {report_file}")
+    return summary["failed"] == 0
+
+# Планировщик: поочередное выполнение многих ВМ квантами команд в одном процессе
+def check_positive(value, name):
+    """Проверка параметра, который должен быть положительным целым (квант, приоритет)"""
+    if type(value) is not int or value <= 0:
+        raise ValueError(f"{name} должен быть положительным целым, а не {value!r}")
+    return value
+
+SCHEDULER_QUANTUM = 4 * COMPILE_CHUNK  # Команд в кванте (кратно блоку движка compile)
+SCHEDULER_STRIDE = 1 << 20             # Шаг задачи с приоритетом 1 (шаговое планирование)
+
+class Scheduler:
+    """Кооперативный планировщик ВМ с квантами команд и приоритетами
+    
+    Каждая задача выполняется квантами по budget команд (VirtualMachine.run_steps).
+    Очередь - шаговое планирование (stride scheduling): после кванта путь
+    задачи растет на SCHEDULER_STRIDE / priority, а следующий квант
+    получает задача с наименьшим путем, поэтому доля команд задачи
+    пропорциональна ее приоритету. Новая задача начинает с наименьшего
+    текущего пути: короткие задачи сразу получают квант и завершаются, не
+    дожидаясь длинных.
+    """
+    
+    def __init__(self, quantum=SCHEDULER_QUANTUM, engine="fast"):
+        self.quantum = check_positive(quantum, "квант команд")
+        self.engine = engine
+        self.queue = []   # куча (путь, номер задачи, задача)
+        self.tasks = []
+    
+    def add(self, vm, name=None, priority=1, budget=None):
+        """Добавление ВМ с загруженной программой; возвращает задачу (словарь)"""
+        check_positive(priority, "приоритет задачи")
+        budget = self.quantum if budget is None else check_positive(budget, "квант задачи")
+        # Квант без трассировки команд: замена compile на fast - один раз, а не в каждом кванте
+        engine = "fast" if self.engine == "compile" and vm.tracer.level >= TRACE_INSTR else self.engine
+        task = {"name": name if name is not None else f"vm{len(self.tasks)}", "vm": vm,
+                "priority": priority, "budget": budget, "engine": engine,
+                "ok": None, "instructions": 0, "slices": 0,
+                "added": time.perf_counter(), "first_slice": None, "finished": None}
+        pass_value = self.queue[0][0] if self.queue else 0
+        heapq.heappush(self.queue, (pass_value, len(self.tasks), task))
+        self.tasks.append(task)
+        return task
+    
+    def step(self):
+        """Один квант задачи с наименьшим путем; False - очередь пуста"""
+        if not self.queue:
+            return False
+        pass_value, seq, task = heapq.heappop(self.queue)
+        vm = task["vm"]
+        if task["first_slice"] is None:
+            task["first_slice"] = time.perf_counter()
+        start = vm.pc
+        ok = vm.run_steps(task["budget"], task["engine"])
+        task["instructions"] += vm.pc - start
+        task["slices"] += 1
+        if not ok or vm.pc >= len(vm.program):
+            task["ok"] = ok
+            task["finished"] = time.perf_counter()
+            if ok:
+                vm.tracer.info(f"Выполнено {vm.pc} команд (включая SQRT)")
+        else:
+            heapq.heappush(self.queue, (pass_value + SCHEDULER_STRIDE // task["priority"], seq, task))
+        return True
+    
+    def run(self):
+        """Выполнение всех задач до завершения; возвращает список задач в порядке добавления"""
+        while self.step():
+            pass
+        return self.tasks
+
+def run_many(jobs, quantum=SCHEDULER_QUANTUM, engine="fast", **vm_options):
+    """Выполнение заданий манифеста на ВМ одного процесса через Scheduler
+    
+    Задание - как в run-batch, плюс необязательные "priority" и "budget".
+    Ошибка задания (параметры ВМ, загрузка, приоритет) попадает в его
+    результат и не прерывает остальные задания. Возвращает отчет: задания
+    с задержками (до первого кванта и до завершения, с) и сводку.
+    """
+    check_job_options(vm_options)
+    scheduler = Scheduler(quantum, engine)
+    vms = []
+    tasks = []
+    errors = []
+    t_start = time.perf_counter()
+    try:
+        for job in jobs:
+            task = error = None
+            try:
+                vm = VirtualMachine(**dict(vm_options, **job.get("vm", {})))
+                vms.append(vm)
+                if vm.load_program(job["program"]):
+                    task = scheduler.add(vm, job["program"], job.get("priority", 1), job.get("budget"))
+                else:
+                    error = "ошибка загрузки программы"
+            except (OSError, ValueError, TypeError) as e:
+                error = f"{type(e).__name__}: {e}"
+            tasks.append(task)
+            errors.append(error)
+        scheduler.run()
+        
+        results = []
+        for job, task, error in zip(jobs, tasks, errors):
+            result = {"program": job["program"], "dump": job["dump"], "ok": False,
+                      "priority": job.get("priority", 1), "instructions": 0, "slices": 0,
+                      "first_slice": 0.0, "latency": 0.0}
+            if task is not None:
+                vm = task["vm"]
+                result.update(instructions=task["instructions"], slices=task["slices"],
+                              first_slice=task["first_slice"] - task["added"],
+                              latency=task["finished"] - task["added"])
+                if not task["ok"]:
+                    error = f"выполнение остановлено на команде {vm.pc}"
+                elif not vm.dump_memory(job.get("start", 0), job.get("end", len(vm.memory) - 1), job["dump"],
+                                        job.get("dump_format", "xml"), job.get("dump_mode", "dense")):
+                    error = "ошибка сохранения дампа"
+                else:
+                    result["ok"] = True
+            if error is not None:
+                result["error"] = error
+            results.append(result)
+    finally:
+        for vm in vms:
+            vm.close()
+    wall = time.perf_counter() - t_start
+    instructions = sum(r["instructions"] for r in results)
+    summary = {"jobs": len(results), "ok": sum(1 for r in results if r["ok"]),
+               "failed": sum(1 for r in results if not r["ok"]), "quantum": quantum,
+               "wall": wall, "instructions": instructions,
+               "instructions_per_second": instructions / wall if wall else 0.0}
+    return {"summary": summary, "results": results}
+
+def run_many_cli(manifest_file, quantum=SCHEDULER_QUANTUM, engine="fast", report_file=None,
+                 **vm_options):
+    """Запуск заданий манифеста планировщиком с выводом задержек"""
+    try:
+        jobs = read_batch_manifest(manifest_file)
+    except (OSError, ValueError, KeyError, TypeError) as e:
+        print(f"Ошибка чтения манифеста: {e}")
+        return False
+    
+    try:
+        report = run_many(jobs, quantum, engine, **vm_options)
+    except ValueError as e:
+        print(f"Ошибка: {e}")
+        return False
+    for result in report["results"]:
+        if "error" in result:
+            print(f"✗ {result['program']}: {result['error']}")
+            continue
+        print(f"✓ {result['program']}: {result['instructions']} команд, "
+              f"{result['slices']} квантов, приоритет {result['priority']}, "
+              f"завершено через {result['latency'] * 1000:.1f} мс")
+    summary = report["summary"]
+    print(f"Заданий: {summary['jobs']}, успешно: {summary['ok']}, с ошибкой: {summary['failed']}")
+    print(f"Время: {summary['wall']:.3f} с, {summary['instructions_per_second']:.0f} команд/с")
+    
+    if report_file:
+        with open(report_file, 'w', encoding='utf-8') as f:
+            json.dump(report, f, indent=2, ensure_ascii=False)
+        print(f"Отчет сохранен в {report_file}")
+    return summary["failed"] == 0
+
+# Сервер ВМ: пул заранее созданных ВМ за Unix-сокетом, протокол - строки JSON
+SERVER_POOL = 4              # ВМ в пуле сервера
+SERVER_OUTPUT_LINES = 10000  # Строк вывода ВМ, отправляемых на запрос
+SERVER_PROGRAM_CACHE = 64    # Разобранных программ в кэше сервера
+SERVER_LATENCIES = 1000      # Последних задержек для процентилей в статистике
+
+class ServerOutput:
+    """Вывод ВМ сервера: замена кольцевого буфера трассировщика на время запроса
+    
+    Строки из потока пула передаются в очередь asyncio цикла событий и
+    отправляются клиенту сразу, а не после выполнения; None - конец вывода.
+    Отправляются первые limit строк, об остальных сообщает последняя строка.
+    """
+    
+    def __init__(self, loop, limit=SERVER_OUTPUT_LINES):
+        import asyncio
+        self.loop = loop
+        self.queue = asyncio.Queue()
+        self.limit = limit
+        self.lines = 0
+    
+    def _put(self, line):
+        self.loop.call_soon_threadsafe(self.queue.put_nowait, line)
+    
+    def append(self, line):
+        self.lines += 1
+        if self.lines <= self.limit:
+            self._put(line)
+    
+    def close(self):
+        if self.lines > self.limit:
+            self._put(f"... пропущено строк вывода: {self.lines - self.limit}")
+        self._put(None)
+
+class VMServer:
+    """Долгоживущий сервер ВМ на Unix-сокете (asyncio импортируется при запуске)
+    
+    Запрос - строка JSON: {"op": "run", "id": ..., "program": путь, "dump": путь
+    или "-", "start": N, "end": N, "engine", "dump_format", "dump_mode"};
+    ответы - строки JSON: {"event": "started"} при получении ВМ из пула,
+    {"event": "output", "line"} для каждой строки вывода ВМ и итоговая
+    {"event": "result", "ok", "instructions", "wait", "run", "total"}.
+    {"op": "stats"} - счетчики задержек и пропускной способности,
+    {"op": "shutdown"} - останов сервера. Программы разбираются один раз и
+    кэшируются по пути, времени изменения и размеру файла; ВМ выполняются в
+    пуле потоков, а между запросами обнуляются (VirtualMachine.reset).
+    Потоки делят GIL: пул перекрывает ввод-вывод и разбор программ, а
+    вычисления нескольких ВМ идут на одном ядре - для нагрузки на все ядра
+    запускается несколько серверов на разных сокетах.
+    """
+    
+    def __init__(self, socket_path, pool_size=SERVER_POOL, **vm_options):
+        if vm_options.get("storage") == "mmap" or "mem_file" in vm_options:
+            raise ValueError("память mmap нельзя делить между запросами сервера")
+        self.socket_path = socket_path
+        self.pool_size = pool_size
+        # Кольцо вместо stdout; на время запроса его заменяет ServerOutput
+        self.vm_options = dict(vm_options, trace_ring=1)
+        self.programs = collections.OrderedDict()
+        self.programs_lock = threading.Lock()
+        self.latencies = collections.deque(maxlen=SERVER_LATENCIES)
+        self.counters = {"requests": 0, "ok": 0, "failed": 0, "instructions": 0,
+                         "program_cache_hits": 0, "busy": 0.0}
+        self.started = None
+    
+    def load_program(self, program_file):
+        """Разобранная программа из кэша или из файла (вызывается из потока пула)"""
+        st = os.stat(program_file)
+        key = (os.path.abspath(program_file), st.st_mtime_ns, st.st_size)
+        with self.programs_lock:
+            program = self.programs.get(key)
+            if program is not None:
+                self.programs.move_to_end(key)
+                self.counters["program_cache_hits"] += 1
+                return program
+        program = read_program(program_file)
+        with self.programs_lock:
+            self.programs[key] = program
+            while len(self.programs) > SERVER_PROGRAM_CACHE:
+                self.programs.popitem(last=False)
+        return program
+    
+    def execute(self, vm, request, output):
+        """Выполнение запроса на ВМ из пула (в потоке): (успех, число команд)
+        
+        Строки вывода ВМ по мере появления передаются в output (ServerOutput).
+        """
+        vm.reset()
+        ring = vm.tracer.ring
+        vm.tracer.ring = output
+        ok = False
+        try:
+            vm.program = self.load_program(request["program"])
+            vm.tracer.info(f"Загружена программа из {request['program']} ({len(vm.program)} команд)")
+            ok = vm.run(request.get("engine", "interp"))
+            dump = request.get("dump", "-")
+            if ok and dump != "-":
+                ok = vm.dump_memory(int(request["start"]), int(request["end"]), dump,
+                                    request.get("dump_format", "xml"), request.get("dump_mode", "dense"))
+        except (OSError, ValueError, KeyError, TypeError) as e:
+            vm.tracer.error(f"Ошибка запроса: {e}")
+            ok = False
+        finally:
+            vm.tracer.ring = ring
+            output.close()
+        return ok, vm.pc
+    
+    def stats(self):
+        """Счетчики сервера: запросы, задержки (мс), пропускная способность"""
+        uptime = time.perf_counter() - self.started
+        latencies = sorted(self.latencies)
+        
+        def percentile(q):
+            return latencies[min(len(latencies) - 1, int(q * len(latencies)))] * 1000 if latencies else 0.0
+        
+        return dict(self.counters, uptime=uptime, pool=self.pool_size, idle=self.pool.qsize(),
+                    cached_programs=len(self.programs),
+                    latency_p50_ms=percentile(0.5), latency_p95_ms=percentile(0.95),
+                    latency_max_ms=latencies[-1] * 1000 if latencies else 0.0,
+                    requests_per_second=self.counters["requests"] / uptime if uptime else 0.0,
+                    instructions_per_second=self.counters["instructions"] / uptime if uptime else 0.0)
+    
+    async def send(self, writer, message):
+        writer.write((json.dumps(message, ensure_ascii=False) + "\n").encode('utf-8'))
+        await writer.drain()
+    
+    async def run_request(self, request, writer):
+        """Выполнение запроса: ВМ берется из пула, результат отправляется по мере готовности"""
+        import asyncio
+        request_id = request.get("id")
+        t_start = time.perf_counter()
+        vm = await self.pool.get()
+        try:
+            t_run = time.perf_counter()
+            await self.send(writer, {"id": request_id, "event": "started"})
+            output = ServerOutput(asyncio.get_running_loop())
+            done = asyncio.get_running_loop().run_in_executor(self.executor, self.execute, vm, request, output)
+            try:
+                while True:
+                    line = await output.queue.get()
+                    if line is None:
+                        break
+                    await self.send(writer, {"id": request_id, "event": "output", "line": line})
+            finally:
+                # Клиент мог отключиться - ВМ возвращается в пул только после выполнения
+                ok, instructions = await done
+        finally:
+            self.pool.put_nowait(vm)
+        t_end = time.perf_counter()
+        
+        counters = self.counters
+        counters["requests"] += 1
+        counters["ok" if ok else "failed"] += 1
+        counters["instructions"] += instructions
+        counters["busy"] += t_end - t_run
+        self.latencies.append(t_end - t_start)
+        await self.send(writer, {"id": request_id, "event": "result", "ok": ok,
+                                 "instructions": instructions, "wait": t_run - t_start,
+                                 "run": t_end - t_run, "total": t_end - t_start})
+    
+    async def handle(self, reader, writer):
+        """Обработка соединения: запросы по одному на строку, по порядку"""
+        try:
+            while True:
+                line = await reader.readline()
+                if not line:
+                    break
+                try:
+                    request = json.loads(line)
+                    op = request.get("op", "run")
+                except (ValueError, AttributeError) as e:
+                    await self.send(writer, {"event": "error", "error": f"неверный запрос: {e}"})
+                    continue
+                if op == "run":
+                    await self.run_request(request, writer)
+                elif op == "stats":
+                    await self.send(writer, {"id": request.get("id"), "event": "stats", **self.stats()})
+                elif op == "shutdown":
+                    await self.send(writer, {"id": request.get("id"), "event": "shutdown"})
+                    self.stopping.set()
+                    break
+                else:
+                    await self.send(writer, {"id": request.get("id"), "event": "error",
+                                             "error": f"неизвестная операция: {op}"})
+        except ConnectionError:
+            pass
+        finally:
+            writer.close()
+    
+    async def serve(self):
+        """Запуск сервера до запроса shutdown"""
+        import asyncio
+        import concurrent.futures
+        self.pool = asyncio.Queue()
+        vms = [VirtualMachine(**self.vm_options) for _ in range(self.pool_size)]
+        for vm in vms:
+            self.pool.put_nowait(vm)
+        self.executor = concurrent.futures.ThreadPoolExecutor(self.pool_size)
+        self.stopping = asyncio.Event()
+        if os.path.exists(self.socket_path):
+            os.remove(self.socket_path)
+        server = await asyncio.start_unix_server(self.handle, path=self.socket_path)
+        self.started = time.perf_counter()
+        print(f"Сервер ВМ слушает {self.socket_path} (ВМ в пуле: {self.pool_size})")
+        try:
+            async with server:
+                await self.stopping.wait()
+        finally:
+            self.executor.shutdown()
+            for vm in vms:
+                vm.tracer.ring.clear()
+                vm.close()
+            if os.path.exists(self.socket_path):
+                os.remove(self.socket_path)
+        stats = self.stats()
+        print(f"Сервер остановлен: запросов {stats['requests']}, успешно {stats['ok']}, "
+              f"задержка p50 {stats['latency_p50_ms']:.2f} мс, p95 {stats['latency_p95_ms']:.2f} мс")
+
+def serve_cli(socket_path, pool_size=SERVER_POOL, **vm_options):
+    """Запуск сервера ВМ из командной строки"""
+    import asyncio
+    try:
+        server = VMServer(socket_path, pool_size, **vm_options)
+        asyncio.run(server.serve())
+    except (OSError, ValueError) as e:
+        print(f"Ошибка сервера: {e}")
+        return False
+    except KeyboardInterrupt:
+        pass
     return True
 
+def client_request(socket_path, request):
+    """Отправка запроса серверу ВМ; генератор строк-ответов (словарей) до итоговой"""
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+        sock.connect(socket_path)
+        sock.sendall((json.dumps(request, ensure_ascii=False) + "\n").encode('utf-8'))
+        with sock.makefile('r', encoding='utf-8') as responses:
+            for line in responses:
+                message = json.loads(line)
+                yield message
+                if message.get("event") != "output" and message.get("event") != "started":
+                    return
+
+def client_cli(socket_path, request):
+    """Клиент сервера ВМ: вывод ВМ и итог, как у команды run"""
+    ok = False
+    try:
+        for message in client_request(socket_path, request):
+            event = message.get("event")
+            if event == "output":
+                print(message["line"])
+            elif event == "result":
+                ok = message["ok"]
+                print(f"Выполнено на сервере за {message['total'] * 1000:.2f} мс "
+                      f"(ожидание ВМ {message['wait'] * 1000:.2f} мс)")
+            elif event == "stats":
+                ok = True
+                print(json.dumps({k: v for k, v in message.items() if k not in ("id", "event")},
+                                 indent=2, ensure_ascii=False))
+            elif event == "shutdown":
+                ok = True
+                print("Сервер останавливается")
+            elif event == "error":
+                print(f"Ошибка сервера: {message['error']}")
+    except (OSError, ValueError) as e:
+        print(f"Ошибка соединения с сервером {socket_path}: {e}")
+    return ok
+
+def vm_options_from_cli(options):
+    """Параметры VirtualMachine из опций командной строки"""
+    vm_options = {}
+    if "mem-size" in options:
+        vm_options["mem_size"] = int(options["mem-size"])
+    if "storage" in options:
+        vm_options["storage"] = options["storage"]
+    if "word" in options:
+        vm_options["word_bits"] = int(options["word"])
+    if "overflow" in options:
+        vm_options["overflow"] = options["overflow"]
+    if "mem-file" in options:
+        vm_options["mem_file"] = options["mem-file"]
+        vm_options.setdefault("storage", "mmap")
+    if "trace" in options:
+        vm_options["trace"] = options["trace"] or "sqrt"
+    if "trace-file" in options:
+        vm_options["trace_file"] = options["trace-file"]
+    if "trace-ring" in options:
+        vm_options["trace_ring"] = int(options["trace-ring"])
+    if "cache" in options:
+        # Кэш кода движка compile между запусками - только по явной опции --cache
+        vm_options["code_cache"] = cache_from_cli(options)
+    return vm_options
+
+def parse_options(args):
+    """Разделение аргументов на позиционные и опции вида --ключ=значение"""
+    positional = []
+    options = {}
+    for arg in args:
+        if arg.startswith("--"):
+            key, _, value = arg[2:].partition("=")
+            options[key] = value
+        else:
+            positional.append(arg)
+    return positional, options
+
 def main():
     """Главная функция"""
-    if len(sys.argv) < 2:
+    argv, options = parse_options(sys.argv)
+    if len(argv) < 2:
         print("Использование:")
-        print("  Этап 1 (Ассемблер): python prak3.py assemble <вход> <выход> [test]")
-        print("  Этап 2-3 (Интерпретатор): python prak3.py run <программа> <дамп> <начало> <конец>")
+        print("  Этап 1 (Ассемблер): python prak3.py assemble <вход> <выход> [test] [--format=json|bin] [--jobs=N]")
+        print("    формат по умолчанию - JSON; бинарный - для выхода .uvm, .uvmb, .bin или с --format=bin")
+        print("    --jobs=N - параллельное ассемблирование больших файлов (--jobs без числа - все ядра)")
+        print("    кэш ассемблера (включается явно): [--cache[=каталог]] [--cache-size=МБ]")
+        print("      (по умолчанию $XDG_CACHE_HOME/uvm-asm или ~/.cache/uvm-asm)")
+        print("    --optimize - удаление мертвых команд для ВМ с памятью --mem-size (1024), --regs (256)")
+        print("      регистрами и словом --word бит (по умолчанию без ограничения, как list)")
+        print("  Каталог .asm-файлов: python prak3.py assemble-dir <каталог> <выходной_каталог> [--format=json|bin]")
+        print("  Этап 2-3 (Интерпретатор): python prak3.py run <программа> <дамп> <начало> <конец> [--engine=interp|fast|compile]")
+        print("  Параметры ВМ для run: [--mem-size=N] [--storage=list|array|numpy|mmap|paged] [--word=8|16|32|64]")
+        print("                        [--overflow=error|wrap|saturate] [--mem-file=файл_памяти]")
+        print("  Кэш кода --engine=compile между запусками: [--cache[=каталог]] (включается явно)")
+        print("  Снимки для run: [--checkpoint-every=N] [--checkpoint=файл.snap] [--compress]")
+        print("                  [--resume=файл.snap] - продолжение со снимка")
+        print("  Параллельные сегменты для run: [--parallel[=N]]; анализ: python prak3.py analyze <программа>")
+        print("  Сервер ВМ: python prak3.py serve <сокет> [--pool=N]; статистика и останов:")
+        print("    python prak3.py client <сокет> --stats|--shutdown")
+        print("  Запуск на сервере (как run): python prak3.py client <сокет> <программа> <дамп> <начало> <конец>")
+        print("  Частичное вычисление: python prak3.py partial <программа> <образ.json> <остаток> [--input-memory]")
+        print("    [--input-memory] - память на входе не нулевая; запуск остатка: run <остаток> ... --image=образ.json")
+        print("  Профилирование run: [--profile=отчет.json] [--profile-sample=N] - замер каждой N-й команды")
+        print("  Трассировка для run: [--trace=off|error|info|sqrt|instr] (--trace без уровня - sqrt)")
+        print("                       [--trace-file=файл] [--trace-ring=N] - только последние N строк")
+        print("  Дамп \"-\" в run - без дампа (итоговая память остается в --mem-file)")
+        print("  Дамп для run: [--dump-format=xml|bin|npy] [--dump-mode=dense|sparse|rle] (режим - для xml)")
+        print("  Пакетный запуск: python prak3.py run-batch <манифест.json> [--workers=N] [--report=отчет.json]")
+        print("  Планировщик в одном процессе: python prak3.py run-many <манифест.json> [--quantum=N]")
+        print("    (в заданиях манифеста - необязательные priority и budget)")
+        print("    манифест - JSON-список заданий {\"program\", \"dump\", \"start\", \"end\"}")
+        print("  Векторный запуск по пакету образов памяти (NumPy):")
+        print("    python prak3.py run-vector <программа> <образы.npy> <дамп.npy> <начало> <конец> [--mem-size=N]")
         print("  Тесты всех этапов: python prak3.py test")
         print("  Тест этапа 3 (SQRT): python prak3.py test-sqrt")
+        print("  Бенчмарк форматов программы: python prak3.py bench-format [число_команд]")
+        print("  Бенчмарк дампа памяти: python prak3.py bench-dump [число_ячеек]")
+        print("  Бенчмарк разбора строк: python prak3.py bench-parse [число_строк]")
+        print("  Бенчмарк SQRT: python prak3.py bench-sqrt [число_операций]")
+        print("  Бенчмарк fork (память paged): python prak3.py bench-fork [число_копий]")
+        print("  Набор бенчмарков: python prak3.py bench [--sizes=1000,10000] [--mixes=uniform,sqrt]")
+        print("    [--engines=interp,fast] [--repeat=N] [--baseline=файл.json] [--save-baseline]")
+        print("    [--tolerance=1.25] - допустимое замедление относительно базовой линии")
         print("\nПримеры:")
         print("  python prak3.py assemble program.asm program.json test")
+        print("  python prak3.py assemble program.asm program.uvm")
         print("  python prak3.py run program.json dump.xml 0 1000")
         print("  python prak3.py test")
         return
     
-    command = sys.argv[1]
+    command = argv[1]
     
     if command == "assemble":
-        if len(sys.argv) < 4:
-            print("Использование: python prak3.py assemble <вход> <выход> [test]")
+        if len(argv) < 4:
+            print("Использование: python prak3.py assemble <вход> <выход> [test] [--format=json|bin] "
+                  "[--jobs=N] [--optimize [--mem-size=N] [--regs=N] [--word=N]]")
             return
-        source = sys.argv[2]
-        output = sys.argv[3]
-        test_mode = len(sys.argv) > 4 and sys.argv[4].lower() == "test"
-        assemble(source, output, test_mode)
+        source = argv[2]
+        output = argv[3]
+        test_mode = len(argv) > 4 and argv[4].lower() == "test"
+        workers = int(options["jobs"]) if options.get("jobs") else (1 if "jobs" not in options else None)
+        optimize = None
+        if "optimize" in options:
+            # Без --word программа оптимизируется для хранилища list (слова без ограничения)
+            optimize = (int(options.get("mem-size") or 1024), int(options.get("regs") or 256),
+                        int(options["word"]) if options.get("word") else None)
+        ok = assemble(source, output, test_mode, fmt=options.get("format"), workers=workers,
+                      cache=cache_from_cli(options), optimize=optimize)
+        if not ok:
+            sys.exit(1)
+        
+    elif command == "assemble-dir":
+        if len(argv) < 4:
+            print("Использование: python prak3.py assemble-dir <каталог> <выходной_каталог> "
+                  "[--format=json|bin] [--jobs=N] [--cache[=каталог]]")
+            return
+        workers = int(options["jobs"]) if options.get("jobs") else (1 if "jobs" not in options else None)
+        ok = assemble_dir(argv[2], argv[3], options.get("format") or "json", workers=workers,
+                          cache=cache_from_cli(options))
+        if not ok:
+            sys.exit(1)
         
     elif command == "run":
-        if len(sys.argv) < 6:
-            print("Использование: python prak3.py run <программа> <дамп> <начало> <конец>")
+        if len(argv) < 6:
+            print("Использование: python prak3.py run <программа> <дамп> <начало> <конец> [--engine=interp|fast|compile]")
             print("Пример: python prak3.py run program.json dump.xml 0 1000")
             return
-        program = sys.argv[2]
-        dump = sys.argv[3]
-        start = int(sys.argv[4])
-        end = int(sys.argv[5])
-        run_vm(program, dump, start, end)
+        program = argv[2]
+        dump = argv[3]
+        start = int(argv[4])
+        end = int(argv[5])
+        engine = options.get("engine", "interp")
+        if engine not in VM_ENGINES:
+            print(f"Неизвестный движок выполнения: {engine} (доступны: {', '.join(VM_ENGINES)})")
+            return
+        profile_sample = int(options["profile-sample"]) if options.get("profile-sample") else PROFILE_SAMPLE
+        if profile_sample <= 0:
+            print("Шаг выборки --profile-sample должен быть положительным")
+            return
+        if options.get("profile") and "engine" in options and engine != "fast":
+            # Профилирование выполняется только предекодированными обработчиками
+            print(f"Профилирование: движок {engine} заменен на fast")
+        checkpoint_every = int(options["checkpoint-every"]) if options.get("checkpoint-every") else None
+        if checkpoint_every is not None and checkpoint_every <= 0:
+            print("Интервал снимков --checkpoint-every должен быть положительным")
+            return
+        run_vm(program, dump, start, end, engine, options.get("dump-mode", "dense"),
+               options.get("dump-format", "xml"), options.get("profile"), profile_sample,
+               checkpoint_every, options.get("checkpoint") or f"{program}.snap",
+               options.get("resume"), "compress" in options, options.get("image"),
+               int(options["parallel"] or 0) if "parallel" in options else None,
+               **vm_options_from_cli(options))
+        
+    elif command == "analyze":
+        if len(argv) < 3:
+            print("Использование: python prak3.py analyze <программа> [--report=отчет.json] [параметры ВМ]")
+            return
+        analyze_cli(argv[2], options.get("report"), **vm_options_from_cli(options))
+        
+    elif command == "partial":
+        if len(argv) < 5:
+            print("Использование: python prak3.py partial <программа> <образ.json> <остаток> "
+                  "[--input-memory] [параметры ВМ]")
+            return
+        partial_cli(argv[2], argv[3], argv[4], "input-memory" in options, **vm_options_from_cli(options))
+        
+    elif command == "run-many":
+        if len(argv) < 3:
+            print("Использование: python prak3.py run-many <манифест.json> [--quantum=N] "
+                  "[--engine=...] [--report=отчет.json]")
+            return
+        quantum = int(options["quantum"]) if options.get("quantum") else SCHEDULER_QUANTUM
+        if quantum <= 0:
+            print("Квант --quantum должен быть положительным")
+            return
+        ok = run_many_cli(argv[2], quantum,
+                          options.get("engine", "fast"), options.get("report"),
+                          **vm_options_from_cli(options))
+        if not ok:
+            sys.exit(1)
+        
+    elif command == "serve":
+        if len(argv) < 3:
+            print("Использование: python prak3.py serve <сокет> [--pool=N] [параметры ВМ]")
+            return
+        serve_cli(argv[2], int(options.get("pool") or SERVER_POOL), **vm_options_from_cli(options))
+        
+    elif command == "client":
+        if "stats" in options or "shutdown" in options:
+            if len(argv) < 3:
+                print("Использование: python prak3.py client <сокет> --stats|--shutdown")
+                return
+            request = {"op": "stats" if "stats" in options else "shutdown"}
+        elif len(argv) < 7:
+            print("Использование: python prak3.py client <сокет> <программа> <дамп> <начало> <конец> "
+                  "[--engine=interp|fast|compile]")
+            return
+        else:
+            # Пути - абсолютные: у сервера свой текущий каталог
+            dump = argv[4] if argv[4] == "-" else os.path.abspath(argv[4])
+            request = {"op": "run", "program": os.path.abspath(argv[3]), "dump": dump,
+                       "start": int(argv[5]), "end": int(argv[6]),
+                       "engine": options.get("engine", "interp"),
+                       "dump_format": options.get("dump-format", "xml"),
+                       "dump_mode": options.get("dump-mode", "dense")}
+        if not client_cli(argv[2], request):
+            sys.exit(1)
+        
+    elif command == "run-batch":
+        workers = options.get("workers")
+        if len(argv) < 3 or (workers is not None and not (workers.isdigit() and int(workers) > 0)):
+            if workers is not None:
+                print("Число процессов --workers должно быть положительным целым")
+            print("Использование: python prak3.py run-batch <манифест.json> [--workers=N] "
+                  "[--engine=...] [--report=отчет.json]")
+            return
+        ok = run_batch_cli(argv[2], int(workers) if workers else None, options.get("engine", "interp"),
+                           options.get("report"), **vm_options_from_cli(options))
+        if not ok:
+            sys.exit(1)
+        
+    elif command == "run-vector":
+        if len(argv) < 7:
+            print("Использование: python prak3.py run-vector <программа> <образы.npy> <дамп.npy> "
+                  "<начало> <конец> [--mem-size=N] [--word=64]")
+            return
+        run_vector(argv[2], argv[3], argv[4], int(argv[5]), int(argv[6]),
+                   int(options.get("mem-size", 1024)), int(options.get("word", 64)))
         
     elif command == "test":
         print("Запуск всех тестов (этапы 1-3)...")
         test1 = test_assembler()
         test2 = test_interpreter_with_sqrt()
+        test3 = test_program_formats()
+        # Проверки движков, хранилищ и инструментов; выполняются все, даже после неудачи
+        extra_tests = (test_word_addresses, test_fast_engine, test_compile_engine, test_run_steps,
+                       test_batch_vm, test_run_batch, test_streaming_assembler, test_parallel_assembler,
+                       test_assembly_cache, test_memory_dumps, test_binary_dumps, test_snapshot,
+                       test_mmap_memory, test_tracer, test_profiler, test_fork, test_reset, test_server,
+                       test_program_transforms)
+        extra = [test() for test in extra_tests]
         
-        if test1 and test2:
+        if test1 and test2 and test3 and all(extra):
             print("\n Все этапы пройдены успешно!")
             print("   Этап 1: Ассемблер")
             print("   Этап 2: Интерпретатор (память)")
@@ -383,6 +5082,42 @@ def main():
         else:
             print("\n Этап 3 (SQRT) не пройден!")
         
+    elif command == "bench-dump":
+        num_cells = int(argv[2]) if len(argv) > 2 else 1000000
+        bench_memory_dump(num_cells)
+        
+    elif command == "bench-format":
+        num_commands = int(argv[2]) if len(argv) > 2 else 1000000
+        bench_program_format(num_commands)
+        
+    elif command == "bench":
+        sizes = [int(n) for n in options["sizes"].split(",")] if options.get("sizes") else BENCH_SIZES
+        mixes = options["mixes"].split(",") if options.get("mixes") else tuple(BENCH_MIXES)
+        engines = options["engines"].split(",") if options.get("engines") else VM_ENGINES
+        unknown = [mix for mix in mixes if mix not in BENCH_MIXES] + \
+                  [engine for engine in engines if engine not in VM_ENGINES]
+        if unknown:
+            print(f"Неизвестные смеси или движки: {', '.join(unknown)}")
+            return
+        ok = bench_suite(sizes, mixes, engines, int(options.get("repeat") or 1),
+                         options.get("baseline"), "save-baseline" in options,
+                         float(options.get("tolerance") or BENCH_TOLERANCE))
+        if not ok:
+            sys.exit(1)
+        
+    elif command == "bench-sqrt":
+        count = int(argv[2]) if len(argv) > 2 else 200000
+        bench_sqrt(count)
+        
+    elif command == "bench-fork":
+        num_forks = int(argv[2]) if len(argv) > 2 else 300
+        if not bench_fork(num_forks):
+            sys.exit(1)
+        
+    elif command == "bench-parse":
+        num_lines = int(argv[2]) if len(argv) > 2 else 1000000
+        bench_parser(num_lines)
+        
     else:
         print(f"Неизвестная команда: {command}")
 
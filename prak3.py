@@ -1,11 +1,11 @@
 import sys
 import json
 
-# Коды команд согласно спецификации УВМ
-CMD_LOAD = 0    # Загрузка константы в регистр
-CMD_READ = 2    # Чтение из памяти в регистр
-CMD_WRITE = 6   # Запись регистра в память со смещением
-CMD_SQRT = 7    # Квадратный корень (будет на этапе 3)
+from uvm_isa import make_parse_line
+
+# Команды этого этапа: набор зафиксирован, новые команды общей таблицы uvm_isa
+# ассемблер этапа не принимает
+parse_line = make_parse_line(("LOAD", "READ", "WRITE", "SQRT"))
 
 def assemble(source_file, output_file, test_mode=False):
     """
@@ -21,52 +21,14 @@ def assemble(source_file, output_file, test_mode=False):
     program = []
     
     for line_num, line in enumerate(lines, 1):
-        line = line.strip()
-        if not line or line.startswith('#'):
-            continue
-            
-        parts = line.split()
-        cmd_name = parts[0].upper()
-        
+        # Разбор по общей таблице команд (uvm_isa)
         try:
-            if cmd_name == "LOAD":
-                # LOAD константа регистр_назначения
-                const = int(parts[1])
-                reg_dst = int(parts[2])
-                if not (0 <= reg_dst < 256):
-                    raise ValueError("Номер регистра должен быть от 0 до 255")
-                program.append((CMD_LOAD, const, reg_dst))
-                
-            elif cmd_name == "READ":
-                # READ регистр_источник регистр_назначения
-                reg_src = int(parts[1])
-                reg_dst = int(parts[2])
-                if not (0 <= reg_src < 256 and 0 <= reg_dst < 256):
-                    raise ValueError("Номер регистра должен быть от 0 до 255")
-                program.append((CMD_READ, reg_src, reg_dst))
-                
-            elif cmd_name == "WRITE":
-                # WRITE регистр_источник смещение регистр_адреса
-                reg_src = int(parts[1])
-                offset = int(parts[2])
-                reg_addr = int(parts[3])
-                if not (0 <= reg_src < 256 and 0 <= reg_addr < 256):
-                    raise ValueError("Номер регистра должен быть от 0 до 255")
-                program.append((CMD_WRITE, reg_src, offset, reg_addr))
-                
-            elif cmd_name == "SQRT":
-                # SQRT адрес_источник адрес_назначения
-                addr_src = int(parts[1])
-                addr_dst = int(parts[2])
-                program.append((CMD_SQRT, addr_src, addr_dst))
-                
-            else:
-                print(f"Ошибка в строке {line_num}: неизвестная команда '{cmd_name}'")
-                return False
-                
+            cmd = parse_line(line)
         except (IndexError, ValueError) as e:
             print(f"Ошибка в строке {line_num}: {e}")
             return False
+        if cmd is not None:
+            program.append(tuple(cmd))
     
     # Режим тестирования
     if test_mode:
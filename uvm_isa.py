@@ -0,0 +1,133 @@
+import struct
+from collections import namedtuple
+
+# Система команд УВМ (Вариант 21): общая таблица для ассемблера, режима
+# тестирования и бинарного формата программы во всех этапах (prak3*.py)
+
+# Коды команд согласно спецификации УВМ
+CMD_LOAD = 0    # Загрузка константы в регистр
+CMD_READ = 2    # Чтение из памяти в регистр
+CMD_WRITE = 6   # Запись регистра в память со смещением
+CMD_SQRT = 7    # Квадратный корень
+
+# Вид операнда: поле бинарного формата, допустимый диапазон [low, high) или None,
+# сообщение об ошибке диапазона
+OperandKind = namedtuple("OperandKind", "field bounds message")
+
+OPERAND_KINDS = {
+    "reg": OperandKind("B", (0, 256), "Номер регистра должен быть от 0 до 255"),
+    "const": OperandKind("q", None, None),
+    "offset": OperandKind("q", None, None),
+    "addr": OperandKind("q", None, None),
+}
+
+# Команда: мнемоника, код, виды операндов по порядку, шаблон строки листинга
+Instruction = namedtuple("Instruction", "mnemonic opcode operands listing")
+
+INSTRUCTIONS = (
+    # LOAD константа регистр_назначения
+    Instruction("LOAD", CMD_LOAD, ("const", "reg"), "LOAD {0} -> reg[{1}]"),
+    # READ регистр_источник регистр_назначения
+    Instruction("READ", CMD_READ, ("reg", "reg"), "READ reg[{0}] -> reg[{1}]"),
+    # WRITE регистр_источник смещение регистр_адреса
+    Instruction("WRITE", CMD_WRITE, ("reg", "offset", "reg"),
+                "WRITE reg[{0}] -> memory[reg[{2}]+{1}]"),
+    # SQRT адрес_источник адрес_назначения (ЭТАП 3)
+    Instruction("SQRT", CMD_SQRT, ("addr", "addr"), "SQRT memory[{0}] -> memory[{1}]"),
+)
+
+BY_MNEMONIC = {spec.mnemonic: spec for spec in INSTRUCTIONS}
+BY_OPCODE = {spec.opcode: spec for spec in INSTRUCTIONS}
+
+# Бинарное кодирование команды: код (байт) и поля операндов фиксированной ширины
+INSTRUCTION_FORMATS = {
+    spec.opcode: struct.Struct("<B" + "".join(OPERAND_KINDS[kind].field for kind in spec.operands))
+    for spec in INSTRUCTIONS
+}
+
+# Десятичные записи малых чисел (номера регистров, типичные адреса и константы):
+# поиск в словаре в несколько раз быстрее int(), остальные числа идут через int()
+SMALL_INTS = {str(value): value for value in range(-1024, 4096)}
+
+def _operand_checks(spec):
+    """Проверки диапазонов операндов команды spec: (номер операнда, low, high, сообщение)
+    
+    Виды операндов проверяются в порядке OPERAND_KINDS, как в прежнем
+    разборе цепочкой if: первая неудачная проверка дает сообщение своего вида.
+    """
+    checks = []
+    for kind_name, kind in OPERAND_KINDS.items():
+        if kind.bounds is None:
+            continue
+        for i, operand in enumerate(spec.operands, 1):
+            if operand == kind_name:
+                checks.append((i, *kind.bounds, kind.message))
+    return tuple(checks)
+
+def make_parse_line(mnemonics=None):
+    """Разбор строк по таблице INSTRUCTIONS; mnemonics - допустимые команды (по умолчанию все)
+    
+    Этап задает свой набор команд: команда из таблицы, которой нет в
+    mnemonics, считается неизвестной.
+    """
+    table = {spec.mnemonic: (spec.opcode, len(spec.operands), _operand_checks(spec))
+             for spec in INSTRUCTIONS if mnemonics is None or spec.mnemonic in mnemonics}
+    ints = SMALL_INTS.get
+    
+    def parse_line(line):
+        """Разбор строки исходного текста: команда или None для пустой строки и комментария"""
+        parts = line.split()
+        if not parts:
+            return None
+        entry = table.get(parts[0])
+        if entry is None:
+            cmd_name = parts[0]
+            if cmd_name[0] == '#':
+                return None
+            # Мнемоники нечувствительны к регистру
+            cmd_name = cmd_name.upper()
+            entry = table.get(cmd_name)
+            if entry is None:
+                raise ValueError(f"неизвестная команда '{cmd_name}'")
+        opcode, count, checks = entry
+        # Сначала все операнды приводятся к int (IndexError, если операнда нет),
+        # затем проверяются диапазоны. Два и три операнда (все команды УВМ)
+        # разбираются без цикла: так разбор почти вдвое быстрее
+        if count == 2 or count == 3:
+            a = ints(parts[1])
+            if a is None:
+                a = int(parts[1])
+            b = ints(parts[2])
+            if b is None:
+                b = int(parts[2])
+            if count == 2:
+                cmd = [opcode, a, b]
+            else:
+                c = ints(parts[3])
+                if c is None:
+                    c = int(parts[3])
+                cmd = [opcode, a, b, c]
+        else:
+            cmd = [opcode]
+            for i in range(1, count + 1):
+                value = ints(parts[i])
+                cmd.append(int(parts[i]) if value is None else value)
+        for i, low, high, message in checks:
+            if not low <= cmd[i] < high:
+                raise ValueError(message)
+        return cmd
+    
+    return parse_line
+
+parse_line = make_parse_line()
+
+def format_command(i, cmd):
+    """Строка промежуточного представления команды для режима тестирования"""
+    spec = BY_OPCODE.get(cmd[0])
+    if spec is None or len(cmd) != len(spec.operands) + 1:
+        return f"{i:3d}: {cmd[0]} {list(cmd[1:])}"
+    return f"{i:3d}: " + spec.listing.format(*cmd[1:])
+
+def source_line(cmd):
+    """Строка исходного текста для команды (обратное к parse_line)"""
+    return " ".join([BY_OPCODE[cmd[0]].mnemonic] + [str(arg) for arg in cmd[1:]])